@@ -0,0 +1,348 @@
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_LIST_PATH_SUFFIX = "/list-all-bots"
+TELEGRAM_PATH_PATTERN = re.compile(r"^(/(?:file/)?bot)\d+:[^/]+")
+BOT_HISTORY_STATUS = 1
+KLINE_PATH = "/v5/market/mark-price-kline"
+SERVER_TIME_PATH = "/v5/market/time"
+SYMBOL_BASE_PRICES = {
+    "BTCUSDT": 60000.0,
+    "ETHUSDT": 3000.0,
+    "SOLUSDT": 150.0
+}
+
+
+def load_fixtures(fixtures_dir):
+    fixtures = {}
+    for file_path in sorted(glob.glob(os.path.join(fixtures_dir, "*.jsonl"))):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 200 <= int(entry.get("status") or 0) < 300:
+                    fixtures.setdefault((entry.get("method"), entry.get("path")), []).append(entry)
+    return fixtures
+
+
+def get_raw_bot_id(bot_data):
+    for section_key, id_key in (("future_grid", "grid_id"), ("fmart", "bot_id"), ("fcombo", "bot_id")):
+        value = (bot_data.get(section_key) or {}).get(id_key)
+        if value not in (None, ""):
+            return str(value)
+    value = (((bot_data.get("grid") or {}).get("info")) or {}).get("grid_id")
+    return str(value) if value not in (None, "") else None
+
+
+def collect_recorded_bots(fixtures):
+    pools = {"active": {}, "history": {}}
+    for (method, path), entries in fixtures.items():
+        if method != "POST" or not (path or "").endswith(BOT_LIST_PATH_SUFFIX):
+            continue
+        for entry in entries:
+            status = (entry.get("json") or {}).get("status")
+            pool = pools["history" if status == BOT_HISTORY_STATUS else "active"]
+            try:
+                bots = ((json.loads(entry["body"]).get("result") or {}).get("bots")) or []
+            except (ValueError, AttributeError):
+                continue
+            for bot_data in bots:
+                bot_id = get_raw_bot_id(bot_data) if isinstance(bot_data, dict) else None
+                if bot_id:
+                    pool[bot_id] = bot_data
+    return {scope: list(pool.values()) for scope, pool in pools.items()}
+
+
+def build_synthetic_bot(index, is_active, now_ms):
+    symbol = list(SYMBOL_BASE_PRICES)[index % len(SYMBOL_BASE_PRICES)]
+    investment = 100.0 + (index % 7) * 25.0
+    pnl = round(math.sin(index) * investment * 0.08, 4)
+    create_time = now_ms - (index + 2) * 3600 * 1000
+    return {
+        "type": "GRID_FUTURES",
+        "future_grid": {
+            "grid_id": str(500000000 + index + (0 if is_active else 100000)),
+            "symbol": symbol,
+            "status": "RUNNING" if is_active else "COMPLETED",
+            "grid_mode": "FUTURE_GRID_MODE_LONG" if index % 2 else "FUTURE_GRID_MODE_NEUTRAL",
+            "leverage": str(3 + index % 5),
+            "total_investment": f"{investment:.4f}",
+            "pnl": f"{pnl:.4f}",
+            "pnl_per": f"{pnl / investment:.6f}",
+            "equity": f"{investment + pnl:.4f}",
+            "cell_num": 20,
+            "grid_type": "FUTURE_GRID_TYPE_ARITHMETIC",
+            "create_time": str(create_time),
+            "end_time": "0" if is_active else str(create_time + 3600 * 1000),
+            "mark_price": f"{SYMBOL_BASE_PRICES[symbol]:.2f}",
+            "close_detail": {} if is_active else {"bot_close_code": "BOT_CLOSE_CODE_CANCELED_MANUALLY"}
+        }
+    }
+
+
+def build_synthetic_klines(symbol, interval, start_ms, end_ms, limit):
+    interval_ms = max(1, int(interval)) * 60 * 1000
+    end_open = end_ms - end_ms % interval_ms
+    first_open = max(start_ms - start_ms % interval_ms, end_open - (limit - 1) * interval_ms)
+    if first_open < start_ms:
+        first_open += interval_ms
+    base_price = SYMBOL_BASE_PRICES.get(symbol, 10.0)
+    rows = []
+    open_time = end_open
+    while open_time >= first_open and len(rows) < limit:
+        # Детерминированная «волна», чтобы повторные прогоны видели одни и те же свечи.
+        close_price = base_price * (1 + 0.01 * math.sin(open_time / interval_ms / 13.0))
+        open_price = base_price * (1 + 0.01 * math.sin((open_time - interval_ms) / interval_ms / 13.0))
+        high_price = max(open_price, close_price) * 1.001
+        low_price = min(open_price, close_price) * 0.999
+        rows.append([str(open_time), f"{open_price:.4f}", f"{high_price:.4f}", f"{low_price:.4f}", f"{close_price:.4f}"])
+        open_time -= interval_ms
+    return rows
+
+
+class ReplayState:
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.fixtures = load_fixtures(options.fixtures) if options.fixtures else {}
+        self.cursors = {}
+        self.stats = {}
+        self.message_id = 0
+        now_ms = int(time.time() * 1000)
+        self.bots = collect_recorded_bots(self.fixtures)
+        if not self.bots["active"] and not self.bots["history"]:
+            self.bots = {
+                "active": [build_synthetic_bot(index, True, now_ms) for index in range(options.active_bots)],
+                "history": [build_synthetic_bot(index, False, now_ms) for index in range(options.history_bots)]
+            }
+
+    def next_fixture(self, method, path):
+        entries = self.fixtures.get((method, path))
+        if not entries:
+            return None
+        with self.lock:
+            cursor = self.cursors.get((method, path), 0)
+            self.cursors[(method, path)] = cursor + 1
+        return entries[cursor % len(entries)]
+
+    def count(self, path, outcome):
+        with self.lock:
+            path_stats = self.stats.setdefault(path, {"ok": 0, "error": 0, "rate_limited": 0})
+            path_stats[outcome] += 1
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    server_version = "BybitReplay/1.0"
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.options.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, payload=None, body=None, content_type="application/json", headers=None):
+        raw_body = body.encode("utf-8") if body is not None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type or "application/json")
+        self.send_header("Content-Length", str(len(raw_body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw_body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            return {}
+
+    def _simulate_network(self, path):
+        options = self.state.options
+        delay_ms = options.latency_ms + random.uniform(0, options.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+        if options.rate_limit_rate and random.random() < options.rate_limit_rate:
+            self.state.count(path, "rate_limited")
+            self._send(429, {"retCode": 10006, "retMsg": "Too many visits"}, headers={"Retry-After": "1"})
+            return False
+        if options.error_rate and random.random() < options.error_rate:
+            self.state.count(path, "error")
+            self._send(503, {"retCode": 10016, "retMsg": "Service unavailable"})
+            return False
+        self.state.count(path, "ok")
+        return True
+
+    def _handle(self, method):
+        parsed_url = urlparse(self.path)
+        path = parsed_url.path
+        query = {key: values[-1] for key, values in parse_qs(parsed_url.query).items()}
+        payload = self._read_json() if method == "POST" else {}
+        if path == "/__replay/stats":
+            self._send(200, {"ok": True, "stats": self.state.stats})
+            return
+        if not self._simulate_network(path):
+            return
+
+        telegram_path = TELEGRAM_PATH_PATTERN.sub(r"\1", path) if TELEGRAM_PATH_PATTERN.match(path) else None
+
+        if path.endswith(BOT_LIST_PATH_SUFFIX):
+            self._send(200, self.build_bot_page(payload))
+            return
+        if path == KLINE_PATH:
+            self._send(200, self.build_kline_response(query))
+            return
+        if path == SERVER_TIME_PATH:
+            now_ts = time.time()
+            self._send(200, {
+                "retCode": 0,
+                "retMsg": "OK",
+                "result": {"timeSecond": str(int(now_ts)), "timeNano": str(int(now_ts * 1e9))},
+                "time": int(now_ts * 1000)
+            })
+            return
+
+        fixture = self.state.next_fixture(method, telegram_path or path)
+        if fixture is not None:
+            self._send(int(fixture.get("status") or 200), body=fixture.get("body") or "", content_type=fixture.get("content_type"))
+            return
+        if telegram_path is not None:
+            self._send(200, self.build_telegram_response(telegram_path.rsplit("/", 1)[-1], query))
+            return
+        synthetic = self.build_synthetic_response(path)
+        if synthetic is not None:
+            self._send(200, synthetic)
+            return
+        self._send(404, {"ok": False, "error": "no_fixture", "path": path})
+
+    def build_bot_page(self, payload):
+        status = payload.get("status")
+        bots = self.state.bots["history" if status == BOT_HISTORY_STATUS else "active"]
+        page_num = max(1, int(payload.get("pageNum") or 1))
+        page_size = max(1, int(payload.get("pageSize") or 50))
+        if self.state.options.bot_page_size:
+            page_size = min(page_size, self.state.options.bot_page_size)
+        start_index = (page_num - 1) * page_size
+        return {
+            "ret_code": 0,
+            "ret_msg": "OK",
+            "result": {"bots": bots[start_index:start_index + page_size], "total": len(bots)}
+        }
+
+    def build_kline_response(self, query):
+        now_ms = int(time.time() * 1000)
+        limit = max(1, min(1000, int(query.get("limit") or 200)))
+        interval = query.get("interval") or "1"
+        end_ms = int(query.get("end") or now_ms)
+        interval_ms = max(1, int(interval)) * 60 * 1000
+        start_ms = int(query.get("start") or end_ms - limit * interval_ms)
+        return {
+            "retCode": 0,
+            "retMsg": "OK",
+            "result": {
+                "symbol": query.get("symbol"),
+                "category": query.get("category"),
+                "list": build_synthetic_klines(query.get("symbol"), interval, start_ms, end_ms, limit)
+            }
+        }
+
+    def build_telegram_response(self, method_name, query):
+        if method_name == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}}
+        if method_name == "getUpdates":
+            time.sleep(min(float(query.get("timeout") or 0), self.state.options.poll_seconds))
+            return {"ok": True, "result": []}
+        if method_name.startswith("send") or method_name.startswith("edit"):
+            return {
+                "ok": True,
+                "result": {
+                    "message_id": self.state.next_message_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": int(query.get("chat_id") or 0), "type": "private"},
+                    "text": query.get("text") or query.get("caption") or ""
+                }
+            }
+        return {"ok": True, "result": True}
+
+    def build_synthetic_response(self, path):
+        if path.endswith("/total-balance"):
+            return {
+                "ret_code": 0,
+                "result": {
+                    "totalBalanceItems": [
+                        {"accountType": "ACCOUNT_TYPE_BOT", "quoteBalance": "1000.00"},
+                        {"accountType": "ACCOUNT_TYPE_FUND", "quoteBalance": "250.00"}
+                    ]
+                }
+            }
+        if path.endswith("/query-asset-summary"):
+            return {
+                "ret_code": 0,
+                "result": {"asset_summary": {"balance_in_usd": "1000.00", "profit_in_usd": "42.00"}}
+            }
+        if path.endswith("/simple/price"):
+            return {"tether": {"rub": 90.0}}
+        if path == "/v5/account/wallet-balance":
+            return {"retCode": 0, "result": {"list": [{"accountType": "UNIFIED", "totalEquity": "1000.00"}]}}
+        if path == "/v5/asset/transfer/query-account-coins-balance":
+            return {"retCode": 0, "result": {"balance": [{"coin": "USDT", "walletBalance": "250.00"}]}}
+        return None
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Локальная подмена Bybit, CoinGecko и Telegram для tgbybit.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--fixtures", default="fixtures", help="каталог с *.jsonl, записанными recorder_settings")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="базовая задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="случайная добавка к задержке")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429 с Retry-After")
+    parser.add_argument("--bot-page-size", type=int, default=0, help="максимальный размер страницы списка ботов")
+    parser.add_argument("--active-bots", type=int, default=12, help="синтетических активных ботов без фикстур")
+    parser.add_argument("--history-bots", type=int, default=120, help="синтетических закрытых ботов без фикстур")
+    parser.add_argument("--poll-seconds", type=float, default=1.0, help="максимальная пауза getUpdates")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def create_server(options):
+    handler = type("BoundReplayHandler", (ReplayHandler,), {"state": ReplayState(options)})
+    return ThreadingHTTPServer((options.host, options.port), handler)
+
+
+if __name__ == '__main__':
+    server = create_server(parse_args())
+    print(f"Replay server listening on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
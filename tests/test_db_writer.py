@@ -0,0 +1,97 @@
+import importlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_tgbybit(work_dir):
+    # Модуль читает config.json и БД рядом с собой, поэтому запускаем его копию во временном каталоге.
+    shutil.copy(os.path.join(ROOT_DIR, "tgbybit.py"), work_dir)
+    with open(os.path.join(ROOT_DIR, "config.example.json"), encoding="utf-8") as f:
+        test_config = json.load(f)
+    test_config["TOKEN"] = "123:test"
+    with open(os.path.join(work_dir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(test_config, f)
+    open(os.path.join(work_dir, "balance_data.db"), "a").close()
+    sys.path.insert(0, work_dir)
+    try:
+        sys.modules.pop("tgbybit", None)
+        return importlib.import_module("tgbybit")
+    finally:
+        sys.path.remove(work_dir)
+
+
+class DbWriterBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        cls.tgbybit = load_tgbybit(cls.work_dir)
+        cls.tgbybit.create_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tgbybit.close_thread_db_connections()
+        sys.modules.pop("tgbybit", None)
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.observer = sqlite3.connect(self.tgbybit.DB_FILE)
+        self.observer.execute("DELETE FROM usdt_rub_rates")
+        self.observer.commit()
+
+    def tearDown(self):
+        self.observer.close()
+
+    def count_rates(self):
+        return self.observer.execute("SELECT COUNT(*) FROM usdt_rub_rates").fetchone()[0]
+
+    def run_batch(self, operations):
+        batch = [(operation, args, Future(), time.perf_counter()) for operation, args in operations]
+        self.tgbybit.apply_db_write_batch(batch)
+        return [future for _, _, future, _ in batch]
+
+    def test_batch_is_invisible_until_single_commit(self):
+        seen_counts = []
+
+        def insert_rate(cursor, index):
+            cursor.execute(
+                "INSERT INTO usdt_rub_rates (date, rate) VALUES (?, ?)",
+                (f"2026-01-01 00:00:{index:02d}", 90.0 + index)
+            )
+            seen_counts.append(self.count_rates())
+
+        futures = self.run_batch([(insert_rate, (index,)) for index in range(5)])
+
+        self.assertEqual(seen_counts, [0] * 5)
+        self.assertEqual(self.count_rates(), 5)
+        self.assertTrue(all(future.exception() is None for future in futures))
+
+    def test_failed_operation_rolls_back_only_itself(self):
+        def insert_rate(cursor, date_str):
+            cursor.execute("INSERT INTO usdt_rub_rates (date, rate) VALUES (?, 90.0)", (date_str,))
+
+        def fail_after_insert(cursor):
+            insert_rate(cursor, "2026-01-01 00:00:30")
+            raise RuntimeError("boom")
+
+        futures = self.run_batch([
+            (insert_rate, ("2026-01-01 00:00:10",)),
+            (fail_after_insert, ()),
+            (insert_rate, ("2026-01-01 00:00:20",))
+        ])
+
+        self.assertIsInstance(futures[1].exception(), RuntimeError)
+        rows = self.observer.execute("SELECT date FROM usdt_rub_rates ORDER BY date").fetchall()
+        self.assertEqual(rows, [("2026-01-01 00:00:10",), ("2026-01-01 00:00:20",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
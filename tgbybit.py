@@ -8,22 +8,35 @@ import shutil
 import statistics
 import atexit
 import functools
+import hashlib
+import hmac
 import math
 import re
-from datetime import datetime, timedelta, timezone
+import random
+import contextlib
+import contextvars
+import queue
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.cookiejar import DefaultCookiePolicy
 from http.cookies import SimpleCookie
 from time import sleep
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, urlencode, urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.patches import FancyBboxPatch
 from matplotlib.ticker import MaxNLocator
 from openpyxl import Workbook, load_workbook
 import telebot
-from telebot import types
+from telebot import apihelper, types
 from telebot.apihelper import ApiTelegramException
 
 
@@ -58,6 +71,7 @@ GRAPH_DIR = os.path.join(CACHE_DIR, "graphs")
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
 INSTANCE_LOCK_FILE = os.path.join(CACHE_DIR, "tgbybit.lock")
 TOP_BOTS_IMAGE_FILE = os.path.join(CACHE_DIR, "top_bots.png")
+KLINE_DB_FILE = os.path.join(CACHE_DIR, "klines.db")
 TOP_BOTS_PAGE_SIZE = 8
 TOP_SORT_MODES = {
     "earnings": {
@@ -117,6 +131,71 @@ API_SETTINGS_DEFAULTS = {
     "port": 8877,
     "token": ""
 }
+HTTP_SETTINGS_DEFAULTS = {
+    "pool_connections": 4,
+    "pool_maxsize": 8,
+    "pool_block": False,
+    "circuit_failure_threshold": 5,
+    "circuit_open_seconds": 60,
+    "rate_limit_per_second": 5.0,
+    "rate_limit_burst": 10
+}
+BYBIT_API_SETTINGS_DEFAULTS = {
+    "base_url": "https://api.bybit.com",
+    "recv_window": 5000,
+    "time_sync_seconds": 600,
+    "fund_coins": "USDT,USDC"
+}
+# Балансы фондового счёта складываются без пересчёта по курсу, поэтому допускаются только стейблкоины.
+BYBIT_API_STABLE_FUND_COINS = {"USDT", "USDC", "FDUSD", "DAI", "TUSD", "USDE", "PYUSD"}
+ENDPOINT_SETTINGS_DEFAULTS = {
+    "base_url": "",
+    "bot_list_url": "",
+    "balance_url": "",
+    "asset_summary_url": "",
+    "mark_price_kline_url": "",
+    "usdt_rub_rate_url": "",
+    "telegram_api_url": ""
+}
+RECORDER_SETTINGS_DEFAULTS = {
+    "enabled": False,
+    "dir": "fixtures",
+    "max_records_per_endpoint": 200
+}
+DB_SETTINGS_DEFAULTS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout_ms": 5000,
+    "mmap_size": 268435456,
+    "cache_size": -16000,
+    "writer_enabled": True,
+    "writer_batch_max": 64,
+    "writer_linger_ms": 5,
+    "raw_retention_days": 0
+}
+
+
+def merge_typed_settings(raw_settings, defaults):
+    merged_settings = dict(defaults)
+    for key, default_value in defaults.items():
+        if key not in (raw_settings or {}):
+            continue
+        raw_value = raw_settings[key]
+        if isinstance(default_value, bool):
+            merged_settings[key] = bool(raw_value)
+        elif isinstance(default_value, int):
+            try:
+                merged_settings[key] = int(raw_value)
+            except (TypeError, ValueError):
+                merged_settings[key] = default_value
+        elif isinstance(default_value, float):
+            try:
+                merged_settings[key] = float(raw_value)
+            except (TypeError, ValueError):
+                merged_settings[key] = default_value
+        else:
+            merged_settings[key] = str(raw_value)
+    return merged_settings
 
 
 def apply_config_defaults(config_data):
@@ -137,21 +216,21 @@ def apply_config_defaults(config_data):
         except (TypeError, ValueError):
             merged_risk_settings[key] = default_value
     normalized["risk_settings"] = merged_risk_settings
-    raw_api_settings = normalized.get("api_settings") or {}
-    merged_api_settings = dict(API_SETTINGS_DEFAULTS)
-    for key, default_value in API_SETTINGS_DEFAULTS.items():
-        if key not in raw_api_settings:
-            continue
-        if isinstance(default_value, bool):
-            merged_api_settings[key] = bool(raw_api_settings[key])
-        elif isinstance(default_value, int):
-            try:
-                merged_api_settings[key] = int(raw_api_settings[key])
-            except (TypeError, ValueError):
-                merged_api_settings[key] = default_value
-        else:
-            merged_api_settings[key] = str(raw_api_settings[key])
-    normalized["api_settings"] = merged_api_settings
+    normalized["api_settings"] = merge_typed_settings(normalized.get("api_settings"), API_SETTINGS_DEFAULTS)
+    normalized["http_settings"] = merge_typed_settings(normalized.get("http_settings"), HTTP_SETTINGS_DEFAULTS)
+    normalized["bybit_api_settings"] = merge_typed_settings(
+        normalized.get("bybit_api_settings"),
+        BYBIT_API_SETTINGS_DEFAULTS
+    )
+    normalized["endpoint_settings"] = merge_typed_settings(
+        normalized.get("endpoint_settings"),
+        ENDPOINT_SETTINGS_DEFAULTS
+    )
+    normalized["recorder_settings"] = merge_typed_settings(
+        normalized.get("recorder_settings"),
+        RECORDER_SETTINGS_DEFAULTS
+    )
+    normalized["db_settings"] = merge_typed_settings(normalized.get("db_settings"), DB_SETTINGS_DEFAULTS)
     if "bot_close_notify_bootstrapped" not in normalized:
         normalized["bot_close_notify_bootstrapped"] = False
     return normalized
@@ -221,6 +300,7 @@ atexit.register(release_instance_lock)
 def handler_guard(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        profile_token = REQUEST_PROFILE.set("interactive")
         try:
             return func(*args, **kwargs)
         except requests.RequestException as e:
@@ -232,6 +312,8 @@ def handler_guard(func):
         except Exception:
             logging.exception("Handler error in %s", func.__name__)
             return None
+        finally:
+            REQUEST_PROFILE.reset(profile_token)
     return wrapper
 
 
@@ -261,26 +343,171 @@ def get_api_settings():
     settings.update(config.get("api_settings") or {})
     return settings
 
+
+def get_http_settings():
+    settings = dict(HTTP_SETTINGS_DEFAULTS)
+    settings.update(config.get("http_settings") or {})
+    return settings
+
+
+def get_bybit_api_settings():
+    settings = dict(BYBIT_API_SETTINGS_DEFAULTS)
+    settings.update(config.get("bybit_api_settings") or {})
+    return settings
+
+
+def get_db_settings():
+    settings = dict(DB_SETTINGS_DEFAULTS)
+    settings.update(config.get("db_settings") or {})
+    return settings
+
+
+def get_endpoint_settings():
+    settings = dict(ENDPOINT_SETTINGS_DEFAULTS)
+    settings.update(config.get("endpoint_settings") or {})
+    return settings
+
+
+def get_recorder_settings():
+    settings = dict(RECORDER_SETTINGS_DEFAULTS)
+    settings.update(config.get("recorder_settings") or {})
+    return settings
+
 REQUEST_TIMEOUT = 60
 MAX_RETRIES = 5
+RETRY_PROFILES = {
+    "interactive": {"deadline_seconds": 15, "timeout": 8, "max_retries": 2, "base_delay": 0.5, "max_delay": 3},
+    "sampling": {"deadline_seconds": 45, "timeout": 20, "max_retries": 3, "base_delay": 1, "max_delay": 10},
+    "background": {
+        "deadline_seconds": 240,
+        "timeout": REQUEST_TIMEOUT,
+        "max_retries": MAX_RETRIES,
+        "base_delay": 2,
+        "max_delay": 30
+    }
+}
+REQUEST_PROFILE = contextvars.ContextVar("request_profile", default="background")
+RATE_LIMIT_LANES = ("interactive", "sampling", "background")
+# Доля ёмкости корзины, которую полоса оставляет более приоритетным полосам.
+RATE_LIMIT_LANE_RESERVE = {
+    "interactive": 0.0,
+    "sampling": 0.2,
+    "background": 0.5
+}
 EXCEL_FILE = os.path.join(BASE_DIR, "balance_data.xlsx")
 DB_FILE = os.path.join(BASE_DIR, "balance_data.db")
 WAITING_FOR_RENEW = False
 BOT_PAGE_SIZE = 50
+BOT_PAGE_FETCH_WORKERS = 4
 BOT_HISTORY_STATUS = 1
 BOT_ARCHIVE_SYNC_INTERVAL_MINUTES = 15
+BOT_ARCHIVE_FULL_SYNC_INTERVAL_MINUTES = 24 * 60
 BOT_DUPLICATE_MATCH_ABS_USDT = 5.0
 BOT_DUPLICATE_MATCH_RATIO = 0.03
 BOT_DUPLICATE_MIN_JUMP_USDT = 30.0
+USDT_RUB_RATE_URL = 'https://api.coingecko.com/api/v3/simple/price?ids=tether&vs_currencies=rub'
+RUB_CACHE_LOCK = threading.Lock()
 RUB_CACHE = {
     "value": None,
     "updated_ts": 0.0,
+    "source": None,
+    "last_error": None,
     "ttl_seconds": 600,
+    "refresh_ahead_seconds": 180,
     "stale_ttl_seconds": 86400
 }
 GRAPH_CACHE_STATE = {
     "last_cleanup_ts": 0.0
 }
+BOT_PAGE_FETCH_STATE = {
+    "last_reports": {}
+}
+ACTIVE_BOTS_SNAPSHOT_MAX_AGE_SECONDS = 45
+ACTIVE_BOTS_SAMPLE_MAX_AGE_SECONDS = 15
+ACTIVE_BOTS_SNAPSHOT_STALE_SECONDS = 300
+ACTIVE_BOTS_SNAPSHOT_LOCK = threading.Lock()
+ACTIVE_BOTS_SNAPSHOT_STATE = {
+    "bots": None,
+    "fetched_ts": 0.0,
+    "inflight": None,
+    "hits": 0,
+    "fetches": 0,
+    "waits": 0
+}
+BOT_PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=BOT_PAGE_FETCH_WORKERS, thread_name_prefix="bot-pages")
+SAMPLE_FETCH_WORKERS = 6
+SAMPLE_STAGE_DEADLINES = {
+    "balance": 25,
+    "bots": 30,
+    "asset_summary": 10
+}
+SAMPLE_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=SAMPLE_FETCH_WORKERS, thread_name_prefix="sample-fetch")
+BOT_CHANGE_LOCK = threading.Lock()
+BOT_CHANGE_STATE = {
+    "records": {},
+    "archived": {},
+    "archived_loaded": False,
+    "last_cycles": {}
+}
+BOT_SNAPSHOT_ROW_FIELDS = (
+    "symbol", "bot_type", "title", "badge", "investment_usdt", "pnl_usdt", "equity_usdt", "pnl_percent_value"
+)
+# Поля payload, из которых строятся строка снимка и запись архива (по разделам get_bot_detail_payload).
+BOT_FINGERPRINT_FIELDS = {
+    "GRID_FUTURES": (
+        ("future_grid", (
+            "grid_id", "symbol", "grid_mode", "leverage", "total_investment", "pnl", "realized_pnl", "pnl_per",
+            "status", "close_detail", "create_time", "end_time"
+        )),
+    ),
+    "MART_FUTURES": (
+        ("fmart", (
+            "bot_id", "symbol", "fmart_mode", "leverage", "total_margin", "total_investment", "total_profit",
+            "realized_pnl", "total_profit_per", "bot_display_status", "close_code", "stop_type",
+            "settlement_assets", "create_time", "end_time"
+        )),
+    ),
+    "GRID_SPOT": (
+        ("grid_info", (
+            "grid_id", "symbol", "grid_mode", "total_investment", "status", "bot_close_code", "close_reason",
+            "create_time", "modify_time"
+        )),
+        ("grid_profit", ("total_profit", "total_apr", "settlement_assets")),
+    ),
+    "COMBO_FUTURES": (
+        ("fcombo", (
+            "bot_id", "symbol", "bot_mode", "leverage", "total_margin", "margin", "total_pnl", "realized_pnl",
+            "total_pnl_per", "bot_display_status", "close_code", "stop_type", "settlement_assets",
+            "create_time", "end_time"
+        )),
+    )
+}
+SAMPLE_TIMINGS_LOCK = threading.Lock()
+SAMPLE_TIMINGS_STATE = {
+    "history": deque(maxlen=120)
+}
+HTTP_CLIENT_LOCK = threading.Lock()
+CIRCUIT_BREAKER_STATE = {
+    "endpoints": {}
+}
+BYBIT_API_TIME_LOCK = threading.Lock()
+BYBIT_API_TIME_STATE = {
+    "offset_ms": 0,
+    "synced_ts": 0.0,
+    "base_url": None
+}
+RATE_LIMIT_CONDITION = threading.Condition()
+RATE_LIMIT_STATE = {
+    "buckets": {}
+}
+RETRY_STATS = {
+    profile_name: {"calls": 0, "retries": 0, "failures": 0, "deadline_exhausted": 0, "short_circuited": 0}
+    for profile_name in RETRY_PROFILES
+}
+HTTP_CLIENT_STATE = {
+    "hosts": {},
+    "settings": get_http_settings()
+}
 BOT_SNAPSHOT_TABLE_SQL = '''
     CREATE TABLE IF NOT EXISTS bot_snapshots (
         snapshot_time TEXT NOT NULL,
@@ -309,6 +536,125 @@ BOT_SNAPSHOT_ID_INDEX_SQL = '''
     CREATE INDEX IF NOT EXISTS idx_bot_snapshots_bot_id
     ON bot_snapshots(bot_id, snapshot_time)
 '''
+BALANCE_TS_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_balances_date_ts
+    ON balances(date_ts)
+'''
+BOT_SNAPSHOT_TS_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_bot_snapshots_ts
+    ON bot_snapshots(snapshot_ts)
+'''
+BOT_DIM_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bot_dim (
+        bot_ref INTEGER PRIMARY KEY,
+        bot_id TEXT,
+        symbol TEXT,
+        bot_type TEXT,
+        title TEXT,
+        badge TEXT,
+        status TEXT,
+        display_status TEXT,
+        is_active INTEGER,
+        close_code TEXT
+    )
+'''
+BOT_DIM_LOOKUP_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_bot_dim_lookup
+    ON bot_dim(bot_id, symbol, bot_type)
+'''
+BOT_DIM_SYMBOL_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_bot_dim_symbol
+    ON bot_dim(symbol, bot_type)
+'''
+BOT_SNAPSHOT_FACTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bot_snapshot_facts (
+        snapshot_ts INTEGER NOT NULL,
+        bot_index INTEGER NOT NULL,
+        bot_ref INTEGER NOT NULL,
+        investment_usdt REAL,
+        pnl_usdt REAL,
+        equity_usdt REAL,
+        pnl_percent REAL,
+        PRIMARY KEY (snapshot_ts, bot_index)
+    ) WITHOUT ROWID
+'''
+BOT_SNAPSHOT_FACTS_REF_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_bot_snapshot_facts_ref
+    ON bot_snapshot_facts(bot_ref, snapshot_ts)
+'''
+# Представление сохраняет прежнюю форму bot_snapshots для ручных запросов и /api/db/query.
+BOT_SNAPSHOTS_VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS bot_snapshots AS
+    SELECT
+        strftime('%Y-%m-%d %H:%M:%S', f.snapshot_ts, 'unixepoch', 'localtime') AS snapshot_time,
+        f.bot_index AS bot_index,
+        d.bot_id AS bot_id,
+        d.symbol AS symbol,
+        d.bot_type AS bot_type,
+        d.title AS title,
+        d.badge AS badge,
+        f.investment_usdt AS investment_usdt,
+        f.pnl_usdt AS pnl_usdt,
+        f.equity_usdt AS equity_usdt,
+        f.pnl_percent AS pnl_percent,
+        d.status AS status,
+        d.display_status AS display_status,
+        d.is_active AS is_active,
+        d.close_code AS close_code,
+        f.snapshot_ts AS snapshot_ts
+    FROM bot_snapshot_facts f
+    JOIN bot_dim d ON d.bot_ref = f.bot_ref
+'''
+BALANCE_ROLLUPS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS balance_rollups (
+        tier TEXT NOT NULL,
+        bucket_ts INTEGER NOT NULL,
+        sample_count INTEGER NOT NULL,
+        value_sum REAL,
+        value_min REAL,
+        value_max REAL,
+        value_first REAL,
+        value_last REAL,
+        first_ts INTEGER,
+        last_ts INTEGER,
+        PRIMARY KEY (tier, bucket_ts)
+    ) WITHOUT ROWID
+'''
+BOT_ROLLUPS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bot_snapshot_rollups (
+        tier TEXT NOT NULL,
+        bot_ref INTEGER NOT NULL,
+        bucket_ts INTEGER NOT NULL,
+        sample_count INTEGER NOT NULL,
+        pnl_sum REAL,
+        pnl_min REAL,
+        pnl_max REAL,
+        pnl_first REAL,
+        pnl_last REAL,
+        equity_sum REAL,
+        equity_min REAL,
+        equity_max REAL,
+        equity_first REAL,
+        equity_last REAL,
+        investment_last REAL,
+        first_ts INTEGER,
+        last_ts INTEGER,
+        PRIMARY KEY (tier, bot_ref, bucket_ts)
+    ) WITHOUT ROWID
+'''
+BOT_ROLLUPS_BUCKET_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_bot_snapshot_rollups_bucket
+    ON bot_snapshot_rollups(tier, bucket_ts)
+'''
+ROLLUP_STATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+'''
+BOT_DIM_FIELDS = (
+    "bot_id", "symbol", "bot_type", "title", "badge", "status", "display_status", "is_active", "close_code"
+)
 BOT_ARCHIVE_TABLE_SQL = '''
     CREATE TABLE IF NOT EXISTS bot_archive (
         bot_id TEXT PRIMARY KEY,
@@ -337,7 +683,8 @@ BOT_ARCHIVE_TABLE_SQL = '''
         is_active INTEGER,
         raw_json TEXT,
         close_notified_at TEXT,
-        close_notify_type TEXT
+        close_notify_type TEXT,
+        payload_fingerprint TEXT
     )
 '''
 BOT_ARCHIVE_TOP_INDEX_SQL = '''
@@ -362,6 +709,13 @@ ALERT_EVENTS_INDEX_SQL = '''
     CREATE INDEX IF NOT EXISTS idx_alert_events_lookup
     ON alert_events(alert_type, created_at)
 '''
+USDT_RUB_RATES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS usdt_rub_rates (
+        date TEXT PRIMARY KEY,
+        rate REAL NOT NULL,
+        source TEXT
+    )
+'''
 
 # Глобальная переменная для остановки потоков
 stop_threads = False
@@ -388,6 +742,18 @@ BALANCE_REPAIR_MAX_BOUNDARY_GAP_PCT = 5.0
 BALANCE_REPAIR_MIN_DROP_PCT = 12.0
 BALANCE_REPAIR_MIN_DROP_USDT = 15.0
 BALANCE_REPAIR_SEGMENT_CEILING_RATIO = 0.92
+# Окно перекрытия: левая граница любого исправляемого сегмента или дубля лежит не дальше него от новой строки.
+BALANCE_REPAIR_OVERLAP_SECONDS = BALANCE_REPAIR_MAX_SPAN_MINUTES * 60 + BALANCE_REPAIR_DUPLICATE_SECONDS
+BALANCE_REPAIR_RESCAN_CHUNK_SECONDS = 86400
+BALANCE_REPAIR_WATERMARK_KEY = "balance_repair_watermark_ts"
+BALANCE_RUB_WATERMARK_KEY = "balance_rub_watermark_date"
+BALANCE_REPAIR_LOCK = threading.Lock()
+BALANCE_REPAIR_STATE = {
+    "incremental_runs": 0,
+    "last_examined_rows": 0,
+    "rescan_running": False,
+    "rescan": None
+}
 
 # Если БД существует, будем использовать её
 USE_DB = os.path.exists(DB_FILE)
@@ -425,40 +791,463 @@ if not USE_DB:
 
 
 # --- Работа с SQLite ---
-def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+DB_JOURNAL_MODES = {"delete", "truncate", "persist", "memory", "wal", "off"}
+DB_SYNCHRONOUS_MODES = {"off", "normal", "full", "extra"}
+DB_CONNECTION_LOCAL = threading.local()
+DB_CONNECTION_LOCK = threading.Lock()
+DB_CONNECTION_STATE = {
+    "connections": {},
+    "opened": 0,
+    "closed": 0,
+    "reused": 0,
+    "stale_rollbacks": 0
+}
 
 
-def create_db():
+class ThreadDbConnection:
+    # Аренда общего соединения потока: close() не закрывает sqlite3-соединение,
+    # а только откатывает незакоммиченное, когда освобождается последняя аренда.
+    def __init__(self, slot):
+        self._slot = slot
+        self._closed = False
+        self.row_factory = None
+        slot["leases"] += 1
+
+    @property
+    def in_transaction(self):
+        return self._slot["conn"].in_transaction
+
+    def cursor(self):
+        cursor = self._slot["conn"].cursor()
+        cursor.row_factory = self.row_factory
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self._slot["conn"].executescript(script)
+
+    def commit(self):
+        self._slot["conn"].commit()
+
+    def rollback(self):
+        self._slot["conn"].rollback()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        slot = self._slot
+        slot["leases"] = max(0, slot["leases"] - 1)
+        if slot["leases"] == 0 and not slot["closed"] and slot["conn"].in_transaction:
+            slot["conn"].rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def apply_db_pragmas(conn, settings):
+    journal_mode = str(settings.get("journal_mode") or "").lower()
+    if journal_mode in DB_JOURNAL_MODES:
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    synchronous = str(settings.get("synchronous") or "").lower()
+    if synchronous in DB_SYNCHRONOUS_MODES:
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute(f"PRAGMA busy_timeout={max(0, int(settings.get('busy_timeout_ms') or 0))}")
+    conn.execute(f"PRAGMA mmap_size={max(0, int(settings.get('mmap_size') or 0))}")
+    cache_size = int(settings.get("cache_size") or 0)
+    if cache_size:
+        conn.execute(f"PRAGMA cache_size={cache_size}")
+
+
+def open_db_slot(db_file, settings):
+    busy_timeout_seconds = max(0, int(settings.get("busy_timeout_ms") or 0)) / 1000
+    conn = sqlite3.connect(db_file, timeout=busy_timeout_seconds, check_same_thread=False)
+    try:
+        apply_db_pragmas(conn, settings)
+    except sqlite3.Error as e:
+        logging.warning(f"Не удалось применить PRAGMA для {db_file}: {e}")
+    slot = {
+        "conn": conn,
+        "db_file": db_file,
+        "settings": settings,
+        "leases": 0,
+        "closed": False,
+        "thread": threading.current_thread(),
+        "opened_at": time.time()
+    }
+    with DB_CONNECTION_LOCK:
+        DB_CONNECTION_STATE["connections"][id(slot)] = slot
+        DB_CONNECTION_STATE["opened"] += 1
+    prune_dead_db_connections()
+    return slot
+
+
+def close_db_slot(slot):
+    if slot["closed"]:
+        return
+    slot["closed"] = True
+    try:
+        if slot["conn"].in_transaction:
+            slot["conn"].rollback()
+        slot["conn"].close()
+    except sqlite3.Error as e:
+        logging.warning(f"Ошибка закрытия соединения {slot['db_file']}: {e}")
+    with DB_CONNECTION_LOCK:
+        if DB_CONNECTION_STATE["connections"].pop(id(slot), None) is not None:
+            DB_CONNECTION_STATE["closed"] += 1
+
+
+def prune_dead_db_connections():
+    with DB_CONNECTION_LOCK:
+        dead_slots = [
+            slot for slot in DB_CONNECTION_STATE["connections"].values()
+            if not slot["thread"].is_alive()
+        ]
+    for slot in dead_slots:
+        close_db_slot(slot)
+
+
+def get_thread_db_connection(db_file):
+    slots = getattr(DB_CONNECTION_LOCAL, "slots", None)
+    if slots is None:
+        slots = {}
+        DB_CONNECTION_LOCAL.slots = slots
+    slot = slots.get(db_file)
+    if slot is not None and slot["leases"] == 0:
+        if slot["closed"] or slot["settings"] != get_db_settings():
+            close_db_slot(slot)
+            slot = None
+        elif slot["conn"].in_transaction:
+            # Транзакция осталась от оборвавшегося исключением вызова — не даём ей держать блокировку.
+            slot["conn"].rollback()
+            with DB_CONNECTION_LOCK:
+                DB_CONNECTION_STATE["stale_rollbacks"] += 1
+    if slot is None:
+        slot = open_db_slot(db_file, get_db_settings())
+        slots[db_file] = slot
+    else:
+        with DB_CONNECTION_LOCK:
+            DB_CONNECTION_STATE["reused"] += 1
+    return ThreadDbConnection(slot)
+
+
+def export_db_copy():
+    # В режиме WAL свежие коммиты лежат в -wal, поэтому отдаём согласованную копию через backup API.
+    export_dir = os.path.join(CACHE_DIR, "db_export")
+    os.makedirs(export_dir, exist_ok=True)
+    export_path = os.path.join(export_dir, os.path.basename(DB_FILE))
+    source = sqlite3.connect(DB_FILE)
+    target = sqlite3.connect(export_path)
+    try:
+        source.backup(target)
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+    return export_path
+
+
+def close_thread_db_connections():
+    slots = getattr(DB_CONNECTION_LOCAL, "slots", None) or {}
+    for slot in list(slots.values()):
+        close_db_slot(slot)
+    slots.clear()
+
+
+def close_all_db_connections():
+    with DB_CONNECTION_LOCK:
+        all_slots = list(DB_CONNECTION_STATE["connections"].values())
+    for slot in all_slots:
+        close_db_slot(slot)
+
+
+def run_with_db_cleanup(func, *args):
+    try:
+        return func(*args)
+    finally:
+        close_thread_db_connections()
+
+
+def get_db_connection_stats():
+    with DB_CONNECTION_LOCK:
+        open_slots = list(DB_CONNECTION_STATE["connections"].values())
+        stats = {
+            "opened": DB_CONNECTION_STATE["opened"],
+            "closed": DB_CONNECTION_STATE["closed"],
+            "reused": DB_CONNECTION_STATE["reused"],
+            "stale_rollbacks": DB_CONNECTION_STATE["stale_rollbacks"]
+        }
+    stats["open"] = [
+        {
+            "db_file": slot["db_file"],
+            "thread": slot["thread"].name,
+            "leases": slot["leases"],
+            "age_seconds": round(time.time() - slot["opened_at"], 1)
+        }
+        for slot in open_slots
+    ]
+    stats["settings"] = get_db_settings()
+    return stats
+
+
+def get_db_connection():
+    return get_thread_db_connection(DB_FILE)
+
+
+DB_WRITE_QUEUE = queue.Queue()
+DB_WRITER_LOCK = threading.Lock()
+DB_WRITER_STATE = {
+    "thread": None,
+    "batches": 0,
+    "operations": 0,
+    "failed_operations": 0,
+    "failed_commits": 0,
+    "inline_operations": 0,
+    "max_batch_size": 0,
+    "commit_ms": deque(maxlen=200),
+    "batch_ms": deque(maxlen=200),
+    "queue_wait_ms": deque(maxlen=200)
+}
+
+
+def ensure_db_writer():
+    with DB_WRITER_LOCK:
+        writer_thread = DB_WRITER_STATE["thread"]
+        if writer_thread is not None and writer_thread.is_alive():
+            return writer_thread
+        writer_thread = threading.Thread(
+            target=run_with_db_cleanup,
+            args=(db_writer_loop,),
+            name="db-writer",
+            daemon=True
+        )
+        DB_WRITER_STATE["thread"] = writer_thread
+        writer_thread.start()
+        return writer_thread
+
+
+def stop_db_writer(timeout=10):
+    with DB_WRITER_LOCK:
+        writer_thread = DB_WRITER_STATE["thread"]
+    if writer_thread is None or not writer_thread.is_alive():
+        return
+    DB_WRITE_QUEUE.put(None)
+    writer_thread.join(timeout)
+
+
+def submit_db_write(operation, *args):
+    future = Future()
+    DB_WRITE_QUEUE.put((operation, args, future, time.perf_counter()))
+    ensure_db_writer()
+    return future
+
+
+def run_db_write(operation, *args):
+    # Все изменения основной БД идут через один поток-писатель; вызывающий ждёт подтверждения коммита.
+    if not get_db_settings().get("writer_enabled") or threading.current_thread() is DB_WRITER_STATE["thread"]:
+        return run_db_write_inline(operation, *args)
+    return submit_db_write(operation, *args).result()
+
+
+def run_db_write_inline(operation, *args):
+    conn = get_db_connection()
+    if conn.in_transaction:
+        # Вложенный вызов из операции пачки: коммитить здесь нельзя, это сделает сама пачка.
+        try:
+            return operation(conn.cursor(), *args)
+        finally:
+            conn.close()
+    try:
+        result = operation(conn.cursor(), *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        reset_bot_dim_cache()
+        discard_balance_history_pending()
+        raise
+    finally:
+        conn.close()
+    apply_balance_history_pending()
+    with DB_WRITER_LOCK:
+        DB_WRITER_STATE["inline_operations"] += 1
+    return result
+
+
+def collect_db_write_batch(first_item):
+    settings = get_db_settings()
+    batch_max = max(1, int(settings.get("writer_batch_max") or 1))
+    linger_seconds = max(0, int(settings.get("writer_linger_ms") or 0)) / 1000
+    batch = [first_item]
+    deadline = time.perf_counter() + linger_seconds
+    while len(batch) < batch_max:
+        remaining = deadline - time.perf_counter()
+        try:
+            item = DB_WRITE_QUEUE.get(timeout=remaining) if remaining > 0 else DB_WRITE_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            DB_WRITE_QUEUE.put(None)
+            break
+        batch.append(item)
+    return batch
+
+
+def apply_db_write_batch(batch):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-       CREATE TABLE IF NOT EXISTS balances (
-         date TEXT PRIMARY KEY,
-         current_balance REAL,
-         balance_rub REAL,
-         change_percent REAL,
-         balance_in_usd REAL,
-         balance_in_btc REAL,
-         profit_in_usd REAL,
-         profit_in_btc REAL,
-         pnl_percentage REAL,
-         current_profit_in_usd REAL,
-         current_profit_in_btc REAL,
-         current_pnl_percentage REAL,
-         origin_balance REAL,
-         bot_balance REAL,
-         funding_balance REAL,
-         non_bot_balance REAL,
-         update_interval INTEGER
-       )
-    ''')
-    cursor.execute(BOT_SNAPSHOT_TABLE_SQL)
-    cursor.execute(BOT_ARCHIVE_TABLE_SQL)
-    cursor.execute(ALERT_EVENTS_TABLE_SQL)
-    conn.commit()
-    conn.close()
-    ensure_db_schema()
+    outcomes = []
+    started = time.perf_counter()
+    commit_ms = None
+    try:
+        # Явная транзакция на всю пачку: без неё первая SAVEPOINT сама открывает транзакцию,
+        # а RELEASE тут же её коммитит — каждая операция фиксировалась бы отдельно.
+        cursor.execute("BEGIN IMMEDIATE")
+        for operation, args, future, submitted in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            DB_WRITER_STATE["queue_wait_ms"].append((started - submitted) * 1000)
+            # Каждая операция в своей точке сохранения: ошибка одной не откатывает остальные в пачке.
+            cursor.execute("SAVEPOINT db_write_op")
+            pending_mark = len(get_balance_history_pending())
+            try:
+                result = operation(cursor, *args)
+                cursor.execute("RELEASE SAVEPOINT db_write_op")
+                outcomes.append((future, result, None))
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT db_write_op")
+                cursor.execute("RELEASE SAVEPOINT db_write_op")
+                reset_bot_dim_cache()
+                del get_balance_history_pending()[pending_mark:]
+                outcomes.append((future, None, e))
+        commit_started = time.perf_counter()
+        conn.commit()
+        commit_ms = (time.perf_counter() - commit_started) * 1000
+        apply_balance_history_pending()
+    except Exception as e:
+        conn.rollback()
+        reset_bot_dim_cache()
+        discard_balance_history_pending()
+        logging.error(f"Ошибка группового коммита БД: {e}")
+        with DB_WRITER_LOCK:
+            DB_WRITER_STATE["failed_commits"] += 1
+        outcomes = [(future, None, e) for future, _, _ in outcomes]
+    finally:
+        conn.close()
+    batch_ms = (time.perf_counter() - started) * 1000
+    with DB_WRITER_LOCK:
+        DB_WRITER_STATE["batches"] += 1
+        DB_WRITER_STATE["operations"] += len(outcomes)
+        DB_WRITER_STATE["failed_operations"] += sum(1 for _, _, error in outcomes if error is not None)
+        DB_WRITER_STATE["max_batch_size"] = max(DB_WRITER_STATE["max_batch_size"], len(outcomes))
+        if commit_ms is not None:
+            DB_WRITER_STATE["commit_ms"].append(commit_ms)
+        DB_WRITER_STATE["batch_ms"].append(batch_ms)
+    for future, result, error in outcomes:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+def db_writer_loop():
+    while True:
+        item = DB_WRITE_QUEUE.get()
+        if item is None:
+            break
+        try:
+            apply_db_write_batch(collect_db_write_batch(item))
+        except Exception:
+            logging.exception("Ошибка потока записи в БД")
+    # Дописываем то, что успели поставить в очередь до остановки.
+    while True:
+        try:
+            item = DB_WRITE_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        if item is not None:
+            apply_db_write_batch([item])
+
+
+def get_db_writer_stats():
+    with DB_WRITER_LOCK:
+        commit_ms = list(DB_WRITER_STATE["commit_ms"])
+        batch_ms = list(DB_WRITER_STATE["batch_ms"])
+        queue_wait_ms = list(DB_WRITER_STATE["queue_wait_ms"])
+        writer_thread = DB_WRITER_STATE["thread"]
+        stats = {
+            "running": bool(writer_thread and writer_thread.is_alive()),
+            "queue_depth": DB_WRITE_QUEUE.qsize(),
+            "batches": DB_WRITER_STATE["batches"],
+            "operations": DB_WRITER_STATE["operations"],
+            "failed_operations": DB_WRITER_STATE["failed_operations"],
+            "failed_commits": DB_WRITER_STATE["failed_commits"],
+            "inline_operations": DB_WRITER_STATE["inline_operations"],
+            "max_batch_size": DB_WRITER_STATE["max_batch_size"]
+        }
+    stats["avg_batch_size"] = round(stats["operations"] / stats["batches"], 2) if stats["batches"] else None
+    stats["commit_ms_avg"] = round(sum(commit_ms) / len(commit_ms), 2) if commit_ms else None
+    stats["commit_ms_p95"] = round(percentile(commit_ms, 0.95), 2) if commit_ms else None
+    stats["batch_ms_avg"] = round(sum(batch_ms) / len(batch_ms), 2) if batch_ms else None
+    stats["queue_wait_ms_avg"] = round(sum(queue_wait_ms) / len(queue_wait_ms), 2) if queue_wait_ms else None
+    return stats
+
+
+atexit.register(close_all_db_connections)
+atexit.register(stop_db_writer)
+
+
+SCHEMA_LOCK = threading.Lock()
+SCHEMA_STATE = {
+    "ready": False,
+    "version": None,
+    "last_run": None
+}
+SCHEMA_VERSION_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+'''
+BALANCES_TABLE_SQL = '''
+   CREATE TABLE IF NOT EXISTS balances (
+     date TEXT PRIMARY KEY,
+     current_balance REAL,
+     balance_rub REAL,
+     change_percent REAL,
+     balance_in_usd REAL,
+     balance_in_btc REAL,
+     profit_in_usd REAL,
+     profit_in_btc REAL,
+     pnl_percentage REAL,
+     current_profit_in_usd REAL,
+     current_profit_in_btc REAL,
+     current_pnl_percentage REAL,
+     origin_balance REAL,
+     bot_balance REAL,
+     funding_balance REAL,
+     non_bot_balance REAL,
+     update_interval INTEGER
+   )
+'''
 
 
 def ensure_table_columns(cursor, table_name, expected_columns):
@@ -473,8 +1262,17 @@ def ensure_table_columns(cursor, table_name, expected_columns):
             logging.error(f"Ошибка при добавлении столбца {column_name} в {table_name}: {e}")
 
 
-def ensure_db_schema():
-    balance_expected = {
+def migrate_base_tables(cursor):
+    cursor.execute(BALANCES_TABLE_SQL)
+    cursor.execute(BOT_SNAPSHOT_TABLE_SQL)
+    cursor.execute(BOT_ARCHIVE_TABLE_SQL)
+    cursor.execute(ALERT_EVENTS_TABLE_SQL)
+    cursor.execute(USDT_RUB_RATES_TABLE_SQL)
+
+
+def migrate_legacy_columns(cursor):
+    # Базы, созданные до появления этих столбцов, дополняются без пересоздания таблиц.
+    ensure_table_columns(cursor, 'balances', {
         'current_balance': 'REAL',
         'balance_rub': 'REAL',
         'change_percent': 'REAL',
@@ -491,15 +1289,15 @@ def ensure_db_schema():
         'funding_balance': 'REAL',
         'non_bot_balance': 'REAL',
         'update_interval': 'INTEGER'
-    }
-    bot_snapshot_expected = {
+    })
+    ensure_table_columns(cursor, 'bot_snapshots', {
         'bot_id': 'TEXT',
         'status': 'TEXT',
         'display_status': 'TEXT',
         'is_active': 'INTEGER',
         'close_code': 'TEXT'
-    }
-    bot_archive_expected = {
+    })
+    ensure_table_columns(cursor, 'bot_archive', {
         'bot_id': 'TEXT',
         'symbol': 'TEXT',
         'bot_type': 'TEXT',
@@ -526,113 +1324,957 @@ def ensure_db_schema():
         'is_active': 'INTEGER',
         'raw_json': 'TEXT',
         'close_notified_at': 'TEXT',
-        'close_notify_type': 'TEXT'
-    }
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    ensure_table_columns(cursor, 'balances', balance_expected)
-    cursor.execute(BOT_SNAPSHOT_TABLE_SQL)
-    ensure_table_columns(cursor, 'bot_snapshots', bot_snapshot_expected)
+        'close_notify_type': 'TEXT',
+        'payload_fingerprint': 'TEXT'
+    })
+
+
+def migrate_indexes(cursor):
     cursor.execute(BOT_SNAPSHOT_INDEX_SQL)
     cursor.execute(BOT_SNAPSHOT_ID_INDEX_SQL)
-    cursor.execute(BOT_ARCHIVE_TABLE_SQL)
-    ensure_table_columns(cursor, 'bot_archive', bot_archive_expected)
     cursor.execute(BOT_ARCHIVE_ID_INDEX_SQL)
     cursor.execute(BOT_ARCHIVE_TOP_INDEX_SQL)
-    cursor.execute(ALERT_EVENTS_TABLE_SQL)
     cursor.execute(ALERT_EVENTS_INDEX_SQL)
-    conn.commit()
-    conn.close()
-
-
-# Миграция данных из Excel в БД (если требуется)
-def migrate_excel_to_db():
-    try:
-        create_db()
-        ensure_db_schema()
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM balances")
-        wb, ws = setup_excel()
-        for row in ws.iter_rows(values_only=True):
-            if row[0] == "Дата":
-                continue
-            date_val = row[0]
-            current_balance = row[1]
-            balance_rub = row[2]
-            change_percent = row[3]
-            # Остальные поля запишем как 0
-            cursor.execute(
-                "INSERT OR REPLACE INTO balances (date, current_balance, balance_rub, change_percent, balance_in_usd, balance_in_btc, profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd, current_profit_in_btc, current_pnl_percentage, origin_balance, bot_balance, funding_balance, non_bot_balance, update_interval) VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, 0, 0, 0, ?, ?, 0, 0, ?)",
-                (date_val, current_balance, balance_rub, change_percent, current_balance, current_balance,
-                 config.get('db_update_interval', 30))
-            )
-        conn.commit()
-        conn.close()
-        global USE_DB
-        USE_DB = True
-        return True
-    except Exception as e:
-        logging.error(f"Ошибка миграции: {e}")
-        return False
 
 
-def get_effective_balance_value(current_balance, balance_in_usd):
-    usd_value = safe_float(balance_in_usd)
-    if usd_value is not None and usd_value > 0:
-        return usd_value
-    current_value = safe_float(current_balance)
-    return current_value if current_value is not None else 0.0
+def migrate_epoch_columns(cursor):
+    # Столбцы заполняются для новых строк сразу, а старые догоняет фоновый run_epoch_backfill.
+    ensure_table_columns(cursor, 'balances', {'date_ts': 'INTEGER'})
+    ensure_table_columns(cursor, 'bot_snapshots', {'snapshot_ts': 'INTEGER'})
+    cursor.execute(BALANCE_TS_INDEX_SQL)
+    cursor.execute(BOT_SNAPSHOT_TS_INDEX_SQL)
+
+
+def migrate_bot_snapshot_facts(cursor):
+    # Повторяющиеся текстовые атрибуты ботов уходят в bot_dim, в фактах остаются время, ссылка и числа.
+    cursor.execute(BOT_DIM_TABLE_SQL)
+    cursor.execute(BOT_SNAPSHOT_FACTS_TABLE_SQL)
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'bot_snapshots'")
+    legacy_row = cursor.fetchone()
+    if legacy_row and legacy_row[0] == 'table':
+        dim_fields = ", ".join(BOT_DIM_FIELDS)
+        cursor.execute(f"INSERT INTO bot_dim ({dim_fields}) SELECT DISTINCT {dim_fields} FROM bot_snapshots")
+        dim_join = " AND ".join(f"d.{field} IS s.{field}" for field in BOT_DIM_FIELDS)
+        epoch_sql = LOCAL_EPOCH_SQL.format(column="s.snapshot_time")
+        cursor.execute(
+            f"""
+            INSERT OR REPLACE INTO bot_snapshot_facts (
+                snapshot_ts, bot_index, bot_ref, investment_usdt, pnl_usdt, equity_usdt, pnl_percent
+            )
+            SELECT COALESCE(s.snapshot_ts, {epoch_sql}), s.bot_index, d.bot_ref,
+                   s.investment_usdt, s.pnl_usdt, s.equity_usdt, s.pnl_percent
+            FROM bot_snapshots s
+            JOIN bot_dim d ON {dim_join}
+            WHERE COALESCE(s.snapshot_ts, {epoch_sql}) IS NOT NULL
+            """
+        )
+        cursor.execute("DROP TABLE bot_snapshots")
+    cursor.execute(BOT_DIM_LOOKUP_INDEX_SQL)
+    cursor.execute(BOT_DIM_SYMBOL_INDEX_SQL)
+    cursor.execute(BOT_SNAPSHOT_FACTS_REF_INDEX_SQL)
+    cursor.execute(BOT_SNAPSHOTS_VIEW_SQL)
+
+
+def migrate_rollup_tables(cursor):
+    cursor.execute(BALANCE_ROLLUPS_TABLE_SQL)
+    cursor.execute(BOT_ROLLUPS_TABLE_SQL)
+    cursor.execute(BOT_ROLLUPS_BUCKET_INDEX_SQL)
+    cursor.execute(ROLLUP_STATE_TABLE_SQL)
+
+
+def migrate_balance_monthly_rollups(cursor):
+    # Уже построенные суточные агрегаты сворачиваем в месячные один раз при обновлении.
+    cursor.execute("SELECT MIN(bucket_ts), MAX(bucket_ts) FROM balance_rollups WHERE tier = '1d'")
+    first_day_ts, last_day_ts = cursor.fetchone()
+    if first_day_ts is not None:
+        refresh_monthly_balance_rollups(cursor, first_day_ts, last_day_ts)
+
+
+# Миграции применяются строго по возрастанию версии и должны быть идемпотентны:
+# база, обновлённая старым ensure_db_schema, проходит их все без ошибок.
+SCHEMA_MIGRATIONS = [
+    (1, "base_tables", migrate_base_tables),
+    (2, "legacy_columns", migrate_legacy_columns),
+    (3, "indexes", migrate_indexes),
+    (4, "epoch_columns", migrate_epoch_columns),
+    (5, "bot_snapshot_facts", migrate_bot_snapshot_facts),
+    (6, "rollup_tables", migrate_rollup_tables),
+    (7, "balance_monthly_rollups", migrate_balance_monthly_rollups)
+]
+# После этих миграций освобождённые страницы возвращаем файлу через VACUUM.
+SCHEMA_VACUUM_VERSIONS = {5}
+
+
+def get_schema_version(cursor):
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else 0
 
 
-def get_effective_balance_history():
-    rows = []
-    if USE_DB:
-        ensure_db_schema()
+def run_schema_migrations():
+    with SCHEMA_LOCK:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(f"SELECT date, {EFFECTIVE_BALANCE_SQL} FROM balances ORDER BY date ASC")
-        raw_rows = cursor.fetchall()
-        conn.close()
-        for date_str, balance_value in raw_rows:
-            if balance_value is None:
-                continue
-            try:
-                rows.append((datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S'), float(balance_value)))
-            except Exception:
-                continue
-        return rows
-
-    worksheet_rows = list(worksheet.iter_rows(values_only=True))[1:]
+        applied = []
+        try:
+            cursor.execute(SCHEMA_VERSION_TABLE_SQL)
+            conn.commit()
+            for version, name, migration in SCHEMA_MIGRATIONS:
+                # BEGIN IMMEDIATE сериализует миграцию между процессами, версию перечитываем под блокировкой.
+                cursor.execute("BEGIN IMMEDIATE")
+                if get_schema_version(cursor) >= version:
+                    conn.rollback()
+                    continue
+                migration(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                    (version, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+                conn.commit()
+                applied.append({"version": version, "name": name})
+                logging.info(f"Применена миграция схемы {version} ({name})")
+            if any(item["version"] in SCHEMA_VACUUM_VERSIONS for item in applied):
+                cursor.execute("VACUUM")
+            current_version = get_schema_version(cursor)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        SCHEMA_STATE["version"] = current_version
+        SCHEMA_STATE["ready"] = current_version >= SCHEMA_MIGRATIONS[-1][0]
+        SCHEMA_STATE["last_run"] = {
+            "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "applied": applied,
+            "version": current_version
+        }
+        return SCHEMA_STATE["last_run"]
+
+
+def create_db():
+    return run_schema_migrations()
+
+
+def ensure_db_schema():
+    if SCHEMA_STATE["ready"]:
+        return
+    run_schema_migrations()
+
+
+def get_schema_stats():
+    return {
+        "ready": SCHEMA_STATE["ready"],
+        "version": SCHEMA_STATE["version"],
+        "target_version": SCHEMA_MIGRATIONS[-1][0],
+        "last_run": SCHEMA_STATE["last_run"]
+    }
+
+
+# Текстовое время хранится как локальное, поэтому переводим его в epoch через 'utc' — как datetime.timestamp().
+LOCAL_EPOCH_SQL = "CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+EPOCH_BACKFILL_CHUNK_ROWS = 5000
+EPOCH_BACKFILL_COLUMNS = (
+    ("balances", "date", "date_ts"),
+)
+EPOCH_BACKFILL_LOCK = threading.Lock()
+EPOCH_BACKFILL_STATE = {
+    "running": False,
+    "complete": False,
+    "rows": {table_name: 0 for table_name, _, _ in EPOCH_BACKFILL_COLUMNS},
+    "finished_at": None
+}
+
+
+def to_epoch_seconds(time_str):
+    return int(datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S').timestamp())
+
+
+def apply_epoch_backfill_chunk(cursor, table_name, text_column, ts_column, chunk_rows):
+    epoch_sql = LOCAL_EPOCH_SQL.format(column=text_column)
+    # Нераспознанное время получает 0, чтобы строка не попадала в следующую пачку бесконечно.
+    cursor.execute(
+        f"UPDATE {table_name} SET {ts_column} = COALESCE({epoch_sql}, 0) "
+        f"WHERE rowid IN (SELECT rowid FROM {table_name} WHERE {ts_column} IS NULL LIMIT ?)",
+        (chunk_rows,)
+    )
+    return cursor.rowcount
+
+
+def has_pending_epoch_backfill():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for table_name, _, ts_column in EPOCH_BACKFILL_COLUMNS:
+            cursor.execute(f"SELECT 1 FROM {table_name} WHERE {ts_column} IS NULL LIMIT 1")
+            if cursor.fetchone():
+                return True
+        return False
+    finally:
+        conn.close()
+
+
+def run_epoch_backfill():
+    for table_name, text_column, ts_column in EPOCH_BACKFILL_COLUMNS:
+        while True:
+            # Каждая пачка — отдельная операция писателя, чтобы поминутные записи не ждали всю миграцию.
+            updated = run_db_write(
+                apply_epoch_backfill_chunk,
+                table_name,
+                text_column,
+                ts_column,
+                EPOCH_BACKFILL_CHUNK_ROWS
+            )
+            with EPOCH_BACKFILL_LOCK:
+                EPOCH_BACKFILL_STATE["rows"][table_name] += updated
+            if updated < EPOCH_BACKFILL_CHUNK_ROWS:
+                break
+
+
+def run_epoch_backfill_job():
+    try:
+        run_epoch_backfill()
+        with EPOCH_BACKFILL_LOCK:
+            EPOCH_BACKFILL_STATE["complete"] = True
+            EPOCH_BACKFILL_STATE["finished_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        logging.info(f"Заполнение epoch-столбцов завершено: {EPOCH_BACKFILL_STATE['rows']}")
+    except Exception:
+        logging.exception("Ошибка заполнения epoch-столбцов")
+    finally:
+        with EPOCH_BACKFILL_LOCK:
+            EPOCH_BACKFILL_STATE["running"] = False
+
+
+def start_epoch_backfill():
+    if not USE_DB:
+        return
+    ensure_db_schema()
+    with EPOCH_BACKFILL_LOCK:
+        if EPOCH_BACKFILL_STATE["running"]:
+            return
+        EPOCH_BACKFILL_STATE["running"] = True
+        EPOCH_BACKFILL_STATE["complete"] = False
+    if not has_pending_epoch_backfill():
+        with EPOCH_BACKFILL_LOCK:
+            EPOCH_BACKFILL_STATE["running"] = False
+            EPOCH_BACKFILL_STATE["complete"] = True
+        return
+    threading.Thread(
+        target=run_with_db_cleanup,
+        args=(run_epoch_backfill_job,),
+        name="epoch-backfill",
+        daemon=True
+    ).start()
+
+
+def get_epoch_backfill_stats():
+    with EPOCH_BACKFILL_LOCK:
+        return {
+            "running": EPOCH_BACKFILL_STATE["running"],
+            "complete": EPOCH_BACKFILL_STATE["complete"],
+            "rows": dict(EPOCH_BACKFILL_STATE["rows"]),
+            "finished_at": EPOCH_BACKFILL_STATE["finished_at"]
+        }
+
+
+# --- Агрегаты истории (rollups) ---
+# Каждый уровень считается прямо из сырых строк; сутки выравниваются по локальной полуночи.
+ROLLUP_MONTH_SECONDS = 31 * 86400
+ROLLUP_TIERS = (
+    ("15m", 900),
+    ("1h", 3600),
+    ("1d", 86400)
+)
+# Месячные корзины баланса при пересчёте собираются из суточных, а не из сырых строк.
+BALANCE_ROLLUP_TIERS = ROLLUP_TIERS + (("1mo", ROLLUP_MONTH_SECONDS),)
+ROLLUP_LOCK = threading.Lock()
+ROLLUP_STATE = {
+    "backfill_running": False,
+    "backfill_complete": False,
+    "backfill_until_ts": None,
+    "rebuilt_ranges": 0,
+    "last_retention": None
+}
+
+
+def build_rollup_upsert_sql(table_name, key_columns, metrics, last_only=()):
+    columns = list(key_columns) + ["sample_count"]
+    updates = ["sample_count = sample_count + excluded.sample_count"]
+    for metric in metrics:
+        columns += [f"{metric}_sum", f"{metric}_min", f"{metric}_max", f"{metric}_first", f"{metric}_last"]
+        updates += [
+            f"{metric}_sum = {metric}_sum + excluded.{metric}_sum",
+            f"{metric}_min = MIN({metric}_min, excluded.{metric}_min)",
+            f"{metric}_max = MAX({metric}_max, excluded.{metric}_max)",
+            f"{metric}_first = CASE WHEN excluded.first_ts < first_ts THEN excluded.{metric}_first ELSE {metric}_first END",
+            f"{metric}_last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.{metric}_last ELSE {metric}_last END"
+        ]
+    for column in last_only:
+        columns.append(column)
+        updates.append(f"{column} = CASE WHEN excluded.last_ts >= last_ts THEN excluded.{column} ELSE {column} END")
+    columns += ["first_ts", "last_ts"]
+    updates += ["first_ts = MIN(first_ts, excluded.first_ts)", "last_ts = MAX(last_ts, excluded.last_ts)"]
+    return (
+        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT({', '.join(key_columns)}) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+BALANCE_ROLLUP_UPSERT_SQL = build_rollup_upsert_sql("balance_rollups", ("tier", "bucket_ts"), ("value",))
+BOT_ROLLUP_UPSERT_SQL = build_rollup_upsert_sql(
+    "bot_snapshot_rollups",
+    ("tier", "bot_ref", "bucket_ts"),
+    ("pnl", "equity"),
+    last_only=("investment_last",)
+)
+
+
+def get_rollup_bucket_ts(ts, tier_seconds):
+    if tier_seconds >= ROLLUP_MONTH_SECONDS:
+        month_start = datetime.fromtimestamp(ts).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return int(month_start.timestamp())
+    if tier_seconds >= 86400:
+        day_start = datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0)
+        return int(day_start.timestamp())
+    offset = time.localtime(ts).tm_gmtoff
+    return ts - ((ts + offset) % tier_seconds)
+
+
+def get_next_day_start_ts(ts):
+    day_start = datetime.fromtimestamp(get_rollup_bucket_ts(ts, 86400))
+    return int((day_start + timedelta(days=1)).timestamp())
+
+
+def aggregate_rollup_points(points, key_func, metric_count, tiers=ROLLUP_TIERS):
+    # points: (ts, key, metric values...) по возрастанию ts; результат — корзины по всем уровням.
+    buckets = {}
+    for point in points:
+        ts = point[0]
+        metric_values = point[2:2 + metric_count]
+        extra_values = point[2 + metric_count:]
+        for tier_name, tier_seconds in tiers:
+            bucket_key = (tier_name, key_func(point), get_rollup_bucket_ts(ts, tier_seconds))
+            bucket = buckets.get(bucket_key)
+            if bucket is None:
+                bucket = {
+                    "count": 0,
+                    "metrics": [[0.0, value, value, value, value] for value in metric_values],
+                    "extra": extra_values,
+                    "first_ts": ts,
+                    "last_ts": ts
+                }
+                buckets[bucket_key] = bucket
+            else:
+                for stats, value in zip(bucket["metrics"], metric_values):
+                    stats[1] = min(stats[1], value)
+                    stats[2] = max(stats[2], value)
+                    stats[4] = value
+                bucket["extra"] = extra_values
+                bucket["last_ts"] = ts
+            bucket["count"] += 1
+            for stats, value in zip(bucket["metrics"], metric_values):
+                stats[0] += value
+    return buckets
+
+
+def build_rollup_params(bucket_key, bucket):
+    tier_name, key, bucket_ts = bucket_key
+    params = [tier_name]
+    if key is not None:
+        params.append(key)
+    params += [bucket_ts, bucket["count"]]
+    for stats in bucket["metrics"]:
+        params += stats
+    params += list(bucket["extra"])
+    params += [bucket["first_ts"], bucket["last_ts"]]
+    return tuple(params)
+
+
+def get_balance_rollup_value(current_balance, balance_in_usd):
+    # То же правило, что и EFFECTIVE_BALANCE_SQL: строки без значения в агрегаты не попадают.
+    if balance_in_usd is not None and balance_in_usd > 0:
+        return balance_in_usd
+    return current_balance
+
+
+def apply_balance_rollup_sample(cursor, date_ts, current_balance, balance_in_usd):
+    value = get_balance_rollup_value(current_balance, balance_in_usd)
+    if value is None or not date_ts:
+        return
+    buckets = aggregate_rollup_points([(date_ts, None, value)], lambda point: None, 1, tiers=BALANCE_ROLLUP_TIERS)
+    cursor.executemany(
+        BALANCE_ROLLUP_UPSERT_SQL,
+        [build_rollup_params(bucket_key, bucket) for bucket_key, bucket in buckets.items()]
+    )
+
+
+def apply_bot_rollup_samples(cursor, fact_rows):
+    points = [
+        (snapshot_ts, bot_ref, pnl_usdt, equity_usdt, investment_usdt)
+        for snapshot_ts, _, bot_ref, investment_usdt, pnl_usdt, equity_usdt, _ in fact_rows
+        if pnl_usdt is not None and equity_usdt is not None
+    ]
+    if not points:
+        return
+    buckets = aggregate_rollup_points(points, lambda point: point[1], 2)
+    cursor.executemany(
+        BOT_ROLLUP_UPSERT_SQL,
+        [build_rollup_params(bucket_key, bucket) for bucket_key, bucket in buckets.items()]
+    )
+
+
+def rebuild_rollup_range(cursor, start_ts, end_ts):
+    # Пересчитываем целые сутки, чтобы корзины всех уровней внутри диапазона были полными.
+    range_start = get_rollup_bucket_ts(start_ts, 86400)
+    range_end = get_next_day_start_ts(end_ts)
+    for tier_name, _ in ROLLUP_TIERS:
+        for table_name in ("balance_rollups", "bot_snapshot_rollups"):
+            cursor.execute(
+                f"DELETE FROM {table_name} WHERE tier = ? AND bucket_ts >= ? AND bucket_ts < ?",
+                (tier_name, range_start, range_end)
+            )
+    cursor.execute(
+        f"SELECT date_ts, NULL, {EFFECTIVE_BALANCE_SQL} FROM balances "
+        f"WHERE date_ts >= ? AND date_ts < ? AND {EFFECTIVE_BALANCE_SQL} IS NOT NULL ORDER BY date_ts",
+        (range_start, range_end)
+    )
+    buckets = aggregate_rollup_points(cursor.fetchall(), lambda point: None, 1)
+    if buckets:
+        cursor.executemany(
+            BALANCE_ROLLUP_UPSERT_SQL,
+            [build_rollup_params(bucket_key, bucket) for bucket_key, bucket in buckets.items()]
+        )
+    cursor.execute(
+        "SELECT snapshot_ts, bot_ref, pnl_usdt, equity_usdt, investment_usdt FROM bot_snapshot_facts "
+        "WHERE snapshot_ts >= ? AND snapshot_ts < ? AND pnl_usdt IS NOT NULL AND equity_usdt IS NOT NULL "
+        "ORDER BY snapshot_ts",
+        (range_start, range_end)
+    )
+    buckets = aggregate_rollup_points(cursor.fetchall(), lambda point: point[1], 2)
+    if buckets:
+        cursor.executemany(
+            BOT_ROLLUP_UPSERT_SQL,
+            [build_rollup_params(bucket_key, bucket) for bucket_key, bucket in buckets.items()]
+        )
+    refresh_monthly_balance_rollups(cursor, range_start, range_end - 1)
+    with ROLLUP_LOCK:
+        ROLLUP_STATE["rebuilt_ranges"] += 1
+    return range_end
+
+
+def refresh_monthly_balance_rollups(cursor, start_ts, end_ts):
+    month_start_ts = get_rollup_bucket_ts(start_ts, ROLLUP_MONTH_SECONDS)
+    while month_start_ts <= end_ts:
+        month_start = datetime.fromtimestamp(month_start_ts)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        next_month_ts = int(next_month.timestamp())
+        cursor.execute("DELETE FROM balance_rollups WHERE tier = '1mo' AND bucket_ts = ?", (month_start_ts,))
+        cursor.execute(
+            """
+            INSERT INTO balance_rollups (
+                tier, bucket_ts, sample_count, value_sum, value_min, value_max,
+                value_first, value_last, first_ts, last_ts
+            )
+            SELECT '1mo', ?, SUM(sample_count), SUM(value_sum), MIN(value_min), MAX(value_max),
+                   (SELECT value_first FROM balance_rollups
+                    WHERE tier = '1d' AND bucket_ts >= ? AND bucket_ts < ? ORDER BY bucket_ts ASC LIMIT 1),
+                   (SELECT value_last FROM balance_rollups
+                    WHERE tier = '1d' AND bucket_ts >= ? AND bucket_ts < ? ORDER BY bucket_ts DESC LIMIT 1),
+                   MIN(first_ts), MAX(last_ts)
+            FROM balance_rollups
+            WHERE tier = '1d' AND bucket_ts >= ? AND bucket_ts < ?
+            HAVING COUNT(*) > 0
+            """,
+            (month_start_ts,) + (month_start_ts, next_month_ts) * 3
+        )
+        month_start_ts = next_month_ts
+
+
+def set_rollup_state_value(cursor, key, value):
+    cursor.execute("INSERT OR REPLACE INTO rollup_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+def load_rollup_state():
+    conn = get_db_connection()
+    try:
+        rows = dict(conn.execute("SELECT key, value FROM rollup_state").fetchall())
+    finally:
+        conn.close()
+    with ROLLUP_LOCK:
+        ROLLUP_STATE["backfill_complete"] = rows.get("backfill_complete") == "1"
+        until_value = rows.get("backfill_until_ts")
+        ROLLUP_STATE["backfill_until_ts"] = int(until_value) if until_value else None
+    return rows
+
+
+def apply_rollup_backfill_day(cursor, day_start_ts):
+    day_end_ts = rebuild_rollup_range(cursor, day_start_ts, day_start_ts)
+    cursor.execute("SELECT MIN(date_ts) FROM balances WHERE date_ts >= ?", (day_end_ts,))
+    next_balance_ts = cursor.fetchone()[0]
+    cursor.execute("SELECT MIN(snapshot_ts) FROM bot_snapshot_facts WHERE snapshot_ts >= ?", (day_end_ts,))
+    next_fact_ts = cursor.fetchone()[0]
+    candidates = [value for value in (next_balance_ts, next_fact_ts) if value]
+    # Пустые дни пропускаем сразу к следующему дню с данными.
+    next_day_ts = get_rollup_bucket_ts(min(candidates), 86400) if candidates else None
+    set_rollup_state_value(cursor, "backfill_until_ts", next_day_ts or day_end_ts)
+    return next_day_ts
+
+
+def apply_rollup_backfill_start(cursor):
+    cursor.execute("SELECT MIN(date_ts) FROM balances WHERE date_ts > 0")
+    first_balance_ts = cursor.fetchone()[0]
+    cursor.execute("SELECT MIN(snapshot_ts) FROM bot_snapshot_facts WHERE snapshot_ts > 0")
+    first_fact_ts = cursor.fetchone()[0]
+    candidates = [value for value in (first_balance_ts, first_fact_ts) if value]
+    return get_rollup_bucket_ts(min(candidates), 86400) if candidates else None
+
+
+def mark_rollup_backfill_complete(cursor):
+    set_rollup_state_value(cursor, "backfill_complete", 1)
+
+
+def run_rollup_backfill_job():
+    try:
+        # Агрегаты строятся по epoch-столбцам, поэтому ждём их заполнения.
+        while EPOCH_BACKFILL_STATE["running"]:
+            time.sleep(1)
+        load_rollup_state()
+        day_ts = ROLLUP_STATE["backfill_until_ts"] or run_db_write(apply_rollup_backfill_start)
+        while day_ts is not None:
+            day_ts = run_db_write(apply_rollup_backfill_day, day_ts)
+            with ROLLUP_LOCK:
+                ROLLUP_STATE["backfill_until_ts"] = day_ts
+        # Текущие сутки пересчитываем целиком: до миграции их начало не попадало в инкрементальные агрегаты.
+        now_ts = int(time.time())
+        run_db_write(rebuild_rollup_range, now_ts, now_ts)
+        run_db_write(mark_rollup_backfill_complete)
+        with ROLLUP_LOCK:
+            ROLLUP_STATE["backfill_complete"] = True
+        logging.info("Построение агрегатов истории завершено")
+    except Exception:
+        logging.exception("Ошибка построения агрегатов истории")
+    finally:
+        with ROLLUP_LOCK:
+            ROLLUP_STATE["backfill_running"] = False
+
+
+def start_rollup_backfill():
+    if not USE_DB:
+        return
+    ensure_db_schema()
+    load_rollup_state()
+    with ROLLUP_LOCK:
+        if ROLLUP_STATE["backfill_running"] or ROLLUP_STATE["backfill_complete"]:
+            return
+        ROLLUP_STATE["backfill_running"] = True
+    threading.Thread(
+        target=run_with_db_cleanup,
+        args=(run_rollup_backfill_job,),
+        name="rollup-backfill",
+        daemon=True
+    ).start()
+
+
+def apply_raw_history_prune(cursor, cutoff_ts, table_name, ts_column):
+    # Удаляем по одним суткам за операцию, чтобы не держать писатель надолго.
+    cursor.execute(f"SELECT MIN({ts_column}) FROM {table_name}")
+    oldest_ts = cursor.fetchone()[0]
+    if oldest_ts is None or oldest_ts >= cutoff_ts:
+        return 0
+    chunk_end_ts = min(cutoff_ts, get_next_day_start_ts(max(oldest_ts, 1)))
+    cursor.execute(f"DELETE FROM {table_name} WHERE {ts_column} < ?", (chunk_end_ts,))
+    if table_name == "balances":
+        queue_balance_history_invalidation(oldest_ts, chunk_end_ts - 1)
+    return cursor.rowcount
+
+
+def prune_raw_history():
+    retention_days = int(get_db_settings().get("raw_retention_days") or 0)
+    if not USE_DB or retention_days <= 0:
+        return None
+    if not ROLLUP_STATE["backfill_complete"] or not EPOCH_BACKFILL_STATE["complete"]:
+        return None
+    # Граница — начало суток: все корзины до неё закрыты на всех уровнях.
+    cutoff_ts = get_rollup_bucket_ts(int(time.time()) - retention_days * 86400, 86400)
+    report = {"cutoff_ts": cutoff_ts, "balances": 0, "bot_snapshot_facts": 0}
+    for table_name, ts_column in (("balances", "date_ts"), ("bot_snapshot_facts", "snapshot_ts")):
+        while True:
+            deleted = run_db_write(apply_raw_history_prune, cutoff_ts, table_name, ts_column)
+            if not deleted:
+                break
+            report[table_name] += deleted
+    report["finished_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with ROLLUP_LOCK:
+        ROLLUP_STATE["last_retention"] = report
+    return report
+
+
+def get_balance_rollups(tier_name, start_ts, end_ts):
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            "SELECT bucket_ts, sample_count, value_sum, value_min, value_max, value_first, value_last "
+            "FROM balance_rollups WHERE tier = ? AND bucket_ts >= ? AND bucket_ts < ? ORDER BY bucket_ts",
+            (tier_name, start_ts, end_ts)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def get_rollup_stats():
+    with ROLLUP_LOCK:
+        stats = dict(ROLLUP_STATE)
+    stats["tiers"] = [tier_name for tier_name, _ in BALANCE_ROLLUP_TIERS]
+    stats["raw_retention_days"] = int(get_db_settings().get("raw_retention_days") or 0)
+    return stats
+
+
+# Миграция данных из Excel в БД (если требуется)
+def migrate_excel_to_db():
+    try:
+        create_db()
+        ensure_db_schema()
+        wb, ws = setup_excel()
+        balance_params = []
+        for row in ws.iter_rows(values_only=True):
+            if row[0] == "Дата":
+                continue
+            date_val = row[0]
+            current_balance = row[1]
+            balance_rub = row[2]
+            change_percent = row[3]
+            # Остальные поля запишем как 0
+            balance_params.append(
+                (date_val, current_balance, balance_rub, change_percent, current_balance, current_balance,
+                 config.get('db_update_interval', 30))
+            )
+        run_db_write(apply_excel_migration, balance_params)
+        global USE_DB
+        USE_DB = True
+        reset_balance_history_cache()
+        with ROLLUP_LOCK:
+            ROLLUP_STATE["backfill_complete"] = False
+            ROLLUP_STATE["backfill_until_ts"] = None
+        start_epoch_backfill()
+        start_rollup_backfill()
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка миграции: {e}")
+        return False
+
+
+def apply_excel_migration(cursor, balance_params):
+    cursor.execute("DELETE FROM balances")
+    cursor.executemany(
+        "INSERT OR REPLACE INTO balances (date, current_balance, balance_rub, change_percent, balance_in_usd, balance_in_btc, profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd, current_profit_in_btc, current_pnl_percentage, origin_balance, bot_balance, funding_balance, non_bot_balance, update_interval) VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, 0, 0, 0, ?, ?, 0, 0, ?)",
+        balance_params
+    )
+    # История заменена целиком: агрегаты и отметки проверок строим заново.
+    cursor.execute("DELETE FROM balance_rollups")
+    cursor.execute("DELETE FROM bot_snapshot_rollups")
+    cursor.execute(
+        "DELETE FROM rollup_state WHERE key IN (?, ?, ?, ?)",
+        ("backfill_complete", "backfill_until_ts", BALANCE_REPAIR_WATERMARK_KEY, BALANCE_RUB_WATERMARK_KEY)
+    )
+    return len(balance_params)
+
+
+def get_effective_balance_value(current_balance, balance_in_usd):
+    usd_value = safe_float(balance_in_usd)
+    if usd_value is not None and usd_value > 0:
+        return usd_value
+    current_value = safe_float(current_balance)
+    return current_value if current_value is not None else 0.0
+
+
+BALANCE_HISTORY_LOCK = threading.Lock()
+BALANCE_HISTORY_CACHE = {
+    "loaded": False,
+    "ts": array("q"),
+    "values": array("d"),
+    "loads": 0,
+    "appends": 0,
+    "invalidated_ranges": 0,
+    "loaded_at": None
+}
+BALANCE_HISTORY_PENDING = threading.local()
+BALANCE_HISTORY_API_MAX_HOURS = 366 * 24
+
+
+def get_balance_history_pending():
+    # Изменения истории копятся в потоке записи и применяются к кэшу только после коммита.
+    pending = getattr(BALANCE_HISTORY_PENDING, "items", None)
+    if pending is None:
+        pending = []
+        BALANCE_HISTORY_PENDING.items = pending
+    return pending
+
+
+def queue_balance_history_append(date_ts, balance_value):
+    if date_ts and balance_value is not None:
+        get_balance_history_pending().append(("append", int(date_ts), float(balance_value)))
+
+
+def queue_balance_history_invalidation(start_ts, end_ts):
+    get_balance_history_pending().append(("invalidate", int(start_ts), int(end_ts)))
+
+
+def discard_balance_history_pending():
+    pending = get_balance_history_pending()
+    if pending:
+        del pending[:]
+        # Коммит не прошёл: непонятно, что осталось в БД, проще перечитать историю целиком.
+        reset_balance_history_cache()
+
+
+def apply_balance_history_pending():
+    pending = get_balance_history_pending()
+    if not pending:
+        return
+    items = list(pending)
+    del pending[:]
+    for kind, first_value, second_value in items:
+        try:
+            if kind == "append":
+                append_balance_history_cache(first_value, second_value)
+            else:
+                refresh_balance_history_range(first_value, second_value)
+        except Exception as e:
+            logging.error(f"Ошибка обновления кэша истории баланса: {e}")
+            reset_balance_history_cache()
+            return
+
+
+def reset_balance_history_cache():
+    with BALANCE_HISTORY_LOCK:
+        BALANCE_HISTORY_CACHE["loaded"] = False
+        BALANCE_HISTORY_CACHE["ts"] = array("q")
+        BALANCE_HISTORY_CACHE["values"] = array("d")
+
+
+def fetch_balance_history_arrays(start_ts=None, end_ts=None):
+    ts_values, balance_values = array("q"), array("d")
+    conn = get_db_connection()
+    try:
+        if start_ts is None:
+            rows = conn.execute(
+                f"SELECT COALESCE(date_ts, {LOCAL_EPOCH_SQL.format(column='date')}) AS row_ts, "
+                f"{EFFECTIVE_BALANCE_SQL} FROM balances ORDER BY row_ts ASC"
+            )
+        else:
+            rows = conn.execute(
+                f"SELECT date_ts, {EFFECTIVE_BALANCE_SQL} FROM balances "
+                "WHERE date_ts >= ? AND date_ts <= ? ORDER BY date_ts ASC",
+                (int(start_ts), int(end_ts))
+            )
+        for date_ts, balance_value in rows:
+            if balance_value is None or not date_ts:
+                continue
+            ts_values.append(int(date_ts))
+            balance_values.append(float(balance_value))
+    finally:
+        conn.close()
+    return ts_values, balance_values
+
+
+def ensure_balance_history_cache():
+    # Кэш держит блокировку на время загрузки, чтобы параллельные дозаписи не потерялись.
+    with BALANCE_HISTORY_LOCK:
+        if BALANCE_HISTORY_CACHE["loaded"]:
+            return
+        ensure_db_schema()
+        ts_values, balance_values = fetch_balance_history_arrays()
+        BALANCE_HISTORY_CACHE["ts"] = ts_values
+        BALANCE_HISTORY_CACHE["values"] = balance_values
+        BALANCE_HISTORY_CACHE["loaded"] = True
+        BALANCE_HISTORY_CACHE["loads"] += 1
+        BALANCE_HISTORY_CACHE["loaded_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def append_balance_history_cache(date_ts, balance_value):
+    with BALANCE_HISTORY_LOCK:
+        if not BALANCE_HISTORY_CACHE["loaded"]:
+            return
+        ts_values = BALANCE_HISTORY_CACHE["ts"]
+        balance_values = BALANCE_HISTORY_CACHE["values"]
+        BALANCE_HISTORY_CACHE["appends"] += 1
+        if not ts_values or date_ts > ts_values[-1]:
+            ts_values.append(date_ts)
+            balance_values.append(balance_value)
+            return
+        # Строка с тем же временем заменяется (INSERT OR REPLACE), более ранняя встаёт на своё место.
+        position = bisect_left(ts_values, date_ts)
+        if position < len(ts_values) and ts_values[position] == date_ts:
+            balance_values[position] = balance_value
+        else:
+            ts_values.insert(position, date_ts)
+            balance_values.insert(position, balance_value)
+
+
+def refresh_balance_history_range(start_ts, end_ts):
+    if not EPOCH_BACKFILL_STATE["complete"]:
+        reset_balance_history_cache()
+        return
+    with BALANCE_HISTORY_LOCK:
+        if not BALANCE_HISTORY_CACHE["loaded"]:
+            return
+        ts_values, balance_values = fetch_balance_history_arrays(start_ts, end_ts)
+        cached_ts = BALANCE_HISTORY_CACHE["ts"]
+        left = bisect_left(cached_ts, start_ts)
+        right = bisect_right(cached_ts, end_ts)
+        cached_ts[left:right] = ts_values
+        BALANCE_HISTORY_CACHE["values"][left:right] = balance_values
+        BALANCE_HISTORY_CACHE["invalidated_ranges"] += 1
+
+
+def get_balance_history_arrays(start_ts=None, end_ts=None):
+    ensure_balance_history_cache()
+    with BALANCE_HISTORY_LOCK:
+        ts_values = BALANCE_HISTORY_CACHE["ts"]
+        left = 0 if start_ts is None else bisect_left(ts_values, start_ts)
+        right = len(ts_values) if end_ts is None else bisect_right(ts_values, end_ts)
+        return ts_values[left:right], BALANCE_HISTORY_CACHE["values"][left:right]
+
+
+def get_balance_history_cache_stats():
+    with BALANCE_HISTORY_LOCK:
+        ts_values = BALANCE_HISTORY_CACHE["ts"]
+        balance_values = BALANCE_HISTORY_CACHE["values"]
+        return {
+            "loaded": BALANCE_HISTORY_CACHE["loaded"],
+            "rows": len(ts_values),
+            "memory_bytes": (
+                ts_values.buffer_info()[1] * ts_values.itemsize
+                + balance_values.buffer_info()[1] * balance_values.itemsize
+            ),
+            "first_ts": ts_values[0] if ts_values else None,
+            "last_ts": ts_values[-1] if ts_values else None,
+            "loads": BALANCE_HISTORY_CACHE["loads"],
+            "appends": BALANCE_HISTORY_CACHE["appends"],
+            "invalidated_ranges": BALANCE_HISTORY_CACHE["invalidated_ranges"],
+            "loaded_at": BALANCE_HISTORY_CACHE["loaded_at"]
+        }
+
+
+def get_effective_balance_history(start_ts=None, end_ts=None):
+    rows = []
+    if USE_DB:
+        ts_values, balance_values = get_balance_history_arrays(start_ts, end_ts)
+        return [
+            (datetime.fromtimestamp(date_ts), balance_value)
+            for date_ts, balance_value in zip(ts_values, balance_values)
+        ]
+
+    start_dt = datetime.fromtimestamp(start_ts) if start_ts is not None else None
+    end_dt = datetime.fromtimestamp(end_ts) if end_ts is not None else None
+    worksheet_rows = list(worksheet.iter_rows(values_only=True))[1:]
     for row in worksheet_rows:
         if row[1] is None:
             continue
         try:
-            rows.append((datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S'), float(row[1])))
+            row_dt = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S')
+            if (start_dt is not None and row_dt < start_dt) or (end_dt is not None and row_dt > end_dt):
+                continue
+            rows.append((row_dt, float(row[1])))
         except Exception:
             continue
     return rows
 
 
+class RowKeyView:
+    # Последовательность ключей поверх списка строк, чтобы bisect работал без копирования.
+    def __init__(self, rows, index=0):
+        self.rows = rows
+        self.index = index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, position):
+        return self.rows[position][self.index]
+
+
+def find_at_or_before_index(keys, target):
+    position = bisect_right(keys, target) - 1
+    return position if position >= 0 else None
+
+
+def find_closest_index(keys, target):
+    # При равном расстоянии выигрывает более ранняя точка, как и при линейном проходе.
+    position = bisect_left(keys, target)
+    if position >= len(keys):
+        return position - 1 if position else None
+    if position == 0:
+        return 0
+    if target - keys[position - 1] <= keys[position] - target:
+        return position - 1
+    return position
+
+
 def get_balance_at_or_before(rows, target_dt):
-    chosen_value = None
-    for row_dt, balance_value in rows:
-        if row_dt <= target_dt:
-            chosen_value = balance_value
-        else:
-            break
-    return chosen_value
+    position = find_at_or_before_index(RowKeyView(rows), target_dt)
+    return rows[position][1] if position is not None else None
 
 
 def get_closest_balance_value(rows, target_dt):
-    closest_value = None
-    closest_diff = None
-    for row_dt, balance_value in rows:
-        diff = abs((row_dt - target_dt).total_seconds())
-        if closest_diff is None or diff < closest_diff:
-            closest_diff = diff
-            closest_value = balance_value
-    return closest_value
+    position = find_closest_index(RowKeyView(rows), target_dt)
+    return rows[position][1] if position is not None else None
+
+
+def query_balance_at_or_before(cursor, target_ts):
+    cursor.execute(
+        f"SELECT {EFFECTIVE_BALANCE_SQL} FROM balances "
+        f"WHERE date_ts > 0 AND date_ts <= ? AND {EFFECTIVE_BALANCE_SQL} IS NOT NULL "
+        "ORDER BY date_ts DESC LIMIT 1",
+        (int(target_ts),)
+    )
+    row = cursor.fetchone()
+    return float(row[0]) if row else None
+
+
+def query_closest_balance(cursor, target_ts):
+    # Две выборки по индексу date_ts: ближайшая точка слева и справа от цели.
+    cursor.execute(
+        f"SELECT date_ts, {EFFECTIVE_BALANCE_SQL} FROM balances "
+        f"WHERE date_ts > 0 AND date_ts <= ? AND {EFFECTIVE_BALANCE_SQL} IS NOT NULL "
+        "ORDER BY date_ts DESC LIMIT 1",
+        (int(target_ts),)
+    )
+    before_row = cursor.fetchone()
+    cursor.execute(
+        f"SELECT date_ts, {EFFECTIVE_BALANCE_SQL} FROM balances "
+        f"WHERE date_ts > ? AND {EFFECTIVE_BALANCE_SQL} IS NOT NULL "
+        "ORDER BY date_ts ASC LIMIT 1",
+        (int(target_ts),)
+    )
+    after_row = cursor.fetchone()
+    if before_row is None and after_row is None:
+        return None
+    if after_row is None or (before_row is not None and target_ts - before_row[0] <= after_row[0] - target_ts):
+        return float(before_row[1])
+    return float(after_row[1])
+
+
+def lookup_balance_history(target_dt, cached_finder, sql_finder):
+    target_ts = int(target_dt.timestamp())
+    # Пока кэш не загружен и эпохи проставлены, не тянем всю историю ради одной точки.
+    if not BALANCE_HISTORY_CACHE["loaded"] and EPOCH_BACKFILL_STATE["complete"]:
+        conn = get_db_connection()
+        try:
+            return sql_finder(conn.cursor(), target_ts)
+        finally:
+            conn.close()
+    ensure_balance_history_cache()
+    with BALANCE_HISTORY_LOCK:
+        position = cached_finder(BALANCE_HISTORY_CACHE["ts"], target_ts)
+        return BALANCE_HISTORY_CACHE["values"][position] if position is not None else None
+
+
+def lookup_balance_at_or_before(target_dt):
+    return lookup_balance_history(target_dt, find_at_or_before_index, query_balance_at_or_before)
+
+
+def lookup_closest_balance(target_dt):
+    return lookup_balance_history(target_dt, find_closest_index, query_closest_balance)
 
 
 def get_interval_slot_key(minutes, dt=None):
@@ -652,36 +2294,55 @@ def claim_schedule_slot(slot_name, minutes, dt=None):
     return True
 
 
-def repair_balance_history(limit_rows=None):
+def repair_balance_history():
     if not USE_DB:
         return {"deleted": 0, "updated": 0}
 
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if limit_rows is None:
-        cursor.execute(
-            "SELECT date, current_balance, balance_in_usd, balance_rub "
-            "FROM balances ORDER BY date ASC"
-        )
-    else:
-        cursor.execute(
-            "SELECT date, current_balance, balance_in_usd, balance_rub "
-            "FROM (SELECT date, current_balance, balance_in_usd, balance_rub "
-            "FROM balances ORDER BY date DESC LIMIT ?) ORDER BY date ASC",
-            (int(limit_rows),)
-        )
+    return run_db_write(apply_balance_history_repair)
+
+
+def get_balance_repair_watermark(cursor):
+    cursor.execute("SELECT value FROM rollup_state WHERE key = ?", (BALANCE_REPAIR_WATERMARK_KEY,))
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] else None
+
+
+def apply_balance_history_repair(cursor, start_ts=None, end_ts=None):
+    # Без границ — инкрементальный режим: только строки после водяной отметки плюс окно перекрытия.
+    incremental = start_ts is None and end_ts is None
+    if incremental:
+        watermark_ts = get_balance_repair_watermark(cursor)
+        if watermark_ts is not None:
+            start_ts = watermark_ts - BALANCE_REPAIR_OVERLAP_SECONDS
+    date_ts_sql = (
+        "date_ts" if EPOCH_BACKFILL_STATE["complete"]
+        else f"COALESCE(date_ts, {LOCAL_EPOCH_SQL.format(column='date')})"
+    )
+    conditions, params = [], []
+    if start_ts is not None:
+        conditions.append(f"{date_ts_sql} >= ?")
+        params.append(int(start_ts))
+    if end_ts is not None:
+        conditions.append(f"{date_ts_sql} < ?")
+        params.append(int(end_ts))
+    where_sql = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    cursor.execute(
+        f"SELECT date, {date_ts_sql} AS row_ts, current_balance, balance_in_usd, balance_rub "
+        f"FROM balances {where_sql}ORDER BY row_ts ASC",
+        params
+    )
     raw_rows = cursor.fetchall()
 
     parsed_rows = []
-    for date_str, current_balance, balance_in_usd, balance_rub in raw_rows:
-        try:
-            row_dt = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-        except Exception:
+    for date_str, date_ts, current_balance, balance_in_usd, balance_rub in raw_rows:
+        if not date_ts:
             continue
+        row_dt = datetime.fromtimestamp(date_ts)
         effective_balance = get_effective_balance_value(current_balance, balance_in_usd)
         parsed_rows.append({
             "date": date_str,
+            "ts": date_ts,
             "dt": row_dt,
             "current_balance": safe_float(current_balance),
             "balance_in_usd": safe_float(balance_in_usd),
@@ -747,9 +2408,10 @@ def repair_balance_history(limit_rows=None):
         if not repaired_segment:
             i += 1
 
+    row_ts_by_date = {row["date"]: row["ts"] for row in parsed_rows}
     for date_str in deleted_dates:
         cursor.execute("DELETE FROM balances WHERE date = ?", (date_str,))
-        cursor.execute("DELETE FROM bot_snapshots WHERE snapshot_time = ?", (date_str,))
+        cursor.execute("DELETE FROM bot_snapshot_facts WHERE snapshot_ts = ?", (row_ts_by_date[date_str],))
 
     for row in parsed_rows:
         corrected_value = updated_values.get(row["date"])
@@ -768,9 +2430,108 @@ def repair_balance_history(limit_rows=None):
             (corrected_value, corrected_value, corrected_rub, row["date"])
         )
 
-    conn.commit()
-    conn.close()
-    return {"deleted": len(deleted_dates), "updated": len(updated_values)}
+    touched_ts = [row_ts_by_date[date_str] for date_str in deleted_dates + list(updated_values)]
+    if touched_ts:
+        rebuild_rollup_range(cursor, min(touched_ts), max(touched_ts))
+        queue_balance_history_invalidation(min(touched_ts), max(touched_ts))
+    if incremental:
+        if parsed_rows:
+            set_rollup_state_value(cursor, BALANCE_REPAIR_WATERMARK_KEY, max(row["ts"] for row in parsed_rows))
+        with BALANCE_REPAIR_LOCK:
+            BALANCE_REPAIR_STATE["incremental_runs"] += 1
+            BALANCE_REPAIR_STATE["last_examined_rows"] = len(parsed_rows)
+    return {"deleted": len(deleted_dates), "updated": len(updated_values), "examined": len(parsed_rows)}
+
+
+def run_balance_repair_rescan_job():
+    progress = BALANCE_REPAIR_STATE["rescan"]
+    try:
+        conn = get_db_connection()
+        try:
+            first_ts, last_ts, total_rows = conn.execute(
+                f"SELECT MIN(row_ts), MAX(row_ts), COUNT(*) FROM (SELECT COALESCE(date_ts, "
+                f"{LOCAL_EPOCH_SQL.format(column='date')}) AS row_ts FROM balances)"
+            ).fetchone()
+        finally:
+            conn.close()
+        with BALANCE_REPAIR_LOCK:
+            progress["total_rows"] = total_rows
+        chunk_start_ts = first_ts
+        # Каждый кусок — отдельная операция писателя, чтобы не блокировать сэмплы на всё время прохода.
+        while chunk_start_ts is not None and chunk_start_ts <= last_ts:
+            chunk_end_ts = chunk_start_ts + BALANCE_REPAIR_RESCAN_CHUNK_SECONDS
+            result = run_db_write(
+                apply_balance_history_repair,
+                chunk_start_ts - BALANCE_REPAIR_OVERLAP_SECONDS,
+                chunk_end_ts
+            )
+            with BALANCE_REPAIR_LOCK:
+                progress["chunks"] += 1
+                progress["examined_rows"] += result["examined"]
+                progress["deleted"] += result["deleted"]
+                progress["updated"] += result["updated"]
+                progress["current_ts"] = min(chunk_end_ts, last_ts)
+                progress["progress_pct"] = round(
+                    min(100.0, (chunk_end_ts - first_ts) / max(1, last_ts - first_ts) * 100.0), 1
+                )
+            chunk_start_ts = chunk_end_ts
+        with BALANCE_REPAIR_LOCK:
+            progress["progress_pct"] = 100.0
+        logging.info(
+            f"Полная проверка истории баланса завершена: удалено {progress['deleted']}, "
+            f"исправлено {progress['updated']}"
+        )
+    except Exception as e:
+        logging.exception("Ошибка полной проверки истории баланса")
+        with BALANCE_REPAIR_LOCK:
+            progress["error"] = str(e)
+    finally:
+        with BALANCE_REPAIR_LOCK:
+            progress["finished_at"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            BALANCE_REPAIR_STATE["rescan_running"] = False
+
+
+def start_balance_repair_rescan():
+    if not USE_DB:
+        return None
+    ensure_db_schema()
+    with BALANCE_REPAIR_LOCK:
+        if BALANCE_REPAIR_STATE["rescan_running"]:
+            return False
+        BALANCE_REPAIR_STATE["rescan_running"] = True
+        BALANCE_REPAIR_STATE["rescan"] = {
+            "started_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "finished_at": None,
+            "total_rows": None,
+            "examined_rows": 0,
+            "chunks": 0,
+            "current_ts": None,
+            "progress_pct": 0.0,
+            "deleted": 0,
+            "updated": 0,
+            "error": None
+        }
+    threading.Thread(
+        target=run_with_db_cleanup,
+        args=(run_balance_repair_rescan_job,),
+        name="balance-repair-rescan",
+        daemon=True
+    ).start()
+    return True
+
+
+def get_balance_repair_stats():
+    with BALANCE_REPAIR_LOCK:
+        stats = dict(BALANCE_REPAIR_STATE)
+        stats["rescan"] = dict(stats["rescan"]) if stats["rescan"] else None
+    stats["watermark_ts"] = None
+    if USE_DB and SCHEMA_STATE["ready"]:
+        conn = get_db_connection()
+        try:
+            stats["watermark_ts"] = get_balance_repair_watermark(conn.cursor())
+        finally:
+            conn.close()
+    return stats
 
 
 # ------------------ ФУНКЦИИ ЗАПРОСА ДАННЫХ ------------------
@@ -780,6 +2541,17 @@ BOT_LIST_XAPI_URL = 'https://www.bybit.com/x-api/s1/bot/tradingbot/v1/list-all-b
 BALANCE_URL = 'https://api2.bybit.com/v3/private/cht/asset-common/total-balance?quoteCoin=USDT&balanceType=1'
 ASSET_SUMMARY_URL = "https://api2.bybit.com/bot-api-summary/v5/private/query-asset-summary"
 MARK_PRICE_KLINE_URL = "https://api.bybit.com/v5/market/mark-price-kline"
+ENDPOINT_DEFAULTS = {
+    "bot_list_url": BOT_LIST_XAPI_URL,
+    "balance_url": BALANCE_URL,
+    "asset_summary_url": ASSET_SUMMARY_URL,
+    "mark_price_kline_url": MARK_PRICE_KLINE_URL,
+    "usdt_rub_rate_url": USDT_RUB_RATE_URL
+}
+FIXTURE_RECORDER_LOCK = threading.Lock()
+FIXTURE_RECORDER_STATE = {
+    "counts": {}
+}
 MARKET_ALERT_WINDOW_SPECS = {
     30: {
         "calibration_interval": "30",
@@ -809,10 +2581,25 @@ MARKET_ALERT_WINDOW_SPECS = {
 MARKET_ALERT_STATE = {
     "mute_until_ts": 0.0,
     "last_sent_minute_key": None,
-    "calibration_cache": {}
+    "calibration_cache": {},
+    "calibration_loaded": False
 }
 MARKET_ALERT_MUTE_SECONDS = 1800
 MARKET_ALERT_CALIBRATION_TTL_SECONDS = 6 * 3600
+MARKET_ALERT_MINUTE_LOOKBACK = 150
+MARKET_ALERT_CALIBRATION_DAYS = 30
+MARKET_ALERT_CALIBRATION_BASE_INTERVAL = "30"
+KLINE_FETCH_LIMIT = 1000
+KLINE_RETENTION_MARGIN_MINUTES = 24 * 60
+KLINE_STORE_LOCK = threading.Lock()
+KLINE_SYNC_LOCKS = {}
+KLINE_STORE_STATE = {
+    "ready": False,
+    "syncs": 0,
+    "requests": 0,
+    "rows_fetched": 0,
+    "incomplete_syncs": 0
+}
 RISK_ALERT_STATE = {
     "mute_until_by_type": {}
 }
@@ -893,66 +2680,590 @@ def expire_mode_notify():
             pass
 
 
-def retry_request(url, method='GET', headers=None, params=None, json_arg=None, cookies_arg=None, timeout=REQUEST_TIMEOUT,
+def create_http_session(settings):
+    session = requests.Session()
+    # Cookies передаются явно в каждом запросе, ответы не должны подмешивать свои в общий пул.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(
+        pool_connections=max(1, int(settings.get("pool_connections", 4))),
+        pool_maxsize=max(1, int(settings.get("pool_maxsize", 8))),
+        pool_block=bool(settings.get("pool_block", False))
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_session(url):
+    host = urlparse(url).netloc.lower() or "default"
+    with HTTP_CLIENT_LOCK:
+        host_state = HTTP_CLIENT_STATE["hosts"].get(host)
+        if host_state is None:
+            host_state = {
+                "session": create_http_session(get_http_settings()),
+                "requests": 0,
+                "errors": 0
+            }
+            HTTP_CLIENT_STATE["hosts"][host] = host_state
+        host_state["requests"] += 1
+    return host_state["session"], host_state
+
+
+def record_http_error(host_state):
+    with HTTP_CLIENT_LOCK:
+        host_state["errors"] += 1
+
+
+def reset_http_sessions():
+    with HTTP_CLIENT_LOCK:
+        host_states = list(HTTP_CLIENT_STATE["hosts"].values())
+        HTTP_CLIENT_STATE["hosts"] = {}
+        HTTP_CLIENT_STATE["settings"] = get_http_settings()
+    with RATE_LIMIT_CONDITION:
+        RATE_LIMIT_STATE["buckets"] = {}
+        RATE_LIMIT_CONDITION.notify_all()
+    for host_state in host_states:
+        try:
+            host_state["session"].close()
+        except Exception:
+            pass
+
+
+def refresh_http_sessions():
+    if HTTP_CLIENT_STATE["settings"] != get_http_settings():
+        reset_http_sessions()
+
+
+def get_http_client_stats():
+    stats = {}
+    with HTTP_CLIENT_LOCK:
+        host_items = list(HTTP_CLIENT_STATE["hosts"].items())
+    for host, host_state in host_items:
+        opened_connections = 0
+        for adapter in host_state["session"].adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    opened_connections += getattr(pool, "num_connections", 0)
+        requests_sent = host_state["requests"]
+        stats[host] = {
+            "requests": requests_sent,
+            "errors": host_state["errors"],
+            "connections_opened": opened_connections,
+            "connections_reused": max(0, requests_sent - opened_connections)
+        }
+    return stats
+
+
+def rebase_url(url, base_url):
+    parsed_url = urlparse(url)
+    return f"{base_url.rstrip('/')}{parsed_url.path}" + (f"?{parsed_url.query}" if parsed_url.query else "")
+
+
+def resolve_endpoint_url(setting_key, settings=None):
+    settings = settings or get_endpoint_settings()
+    if settings.get(setting_key):
+        return settings[setting_key]
+    if settings.get("base_url"):
+        return rebase_url(ENDPOINT_DEFAULTS[setting_key], settings["base_url"])
+    return ENDPOINT_DEFAULTS[setting_key]
+
+
+def apply_endpoint_overrides():
+    global BOT_LIST_XAPI_URL, BALANCE_URL, ASSET_SUMMARY_URL, MARK_PRICE_KLINE_URL, USDT_RUB_RATE_URL
+    settings = get_endpoint_settings()
+    BOT_LIST_XAPI_URL = resolve_endpoint_url("bot_list_url", settings)
+    BALANCE_URL = resolve_endpoint_url("balance_url", settings)
+    ASSET_SUMMARY_URL = resolve_endpoint_url("asset_summary_url", settings)
+    MARK_PRICE_KLINE_URL = resolve_endpoint_url("mark_price_kline_url", settings)
+    USDT_RUB_RATE_URL = resolve_endpoint_url("usdt_rub_rate_url", settings)
+
+    telegram_api_url = (settings.get("telegram_api_url") or settings.get("base_url") or "").rstrip("/")
+    apihelper.API_URL = f"{telegram_api_url}/bot{{0}}/{{1}}" if telegram_api_url else None
+    apihelper.FILE_URL = f"{telegram_api_url}/file/bot{{0}}/{{1}}" if telegram_api_url else None
+    apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request if get_recorder_settings()["enabled"] else None
+
+
+def get_fixture_target(url):
+    parsed_url = urlparse(url)
+    # Токен Telegram-бота не должен попадать в имена и содержимое фикстур.
+    path = re.sub(r"^(/(?:file/)?bot)\d+:[^/]+", r"\1", parsed_url.path)
+    file_name = re.sub(r"[^A-Za-z0-9]+", "_", f"{parsed_url.netloc}{path}").strip("_") or "root"
+    return file_name, path
+
+
+def record_http_fixture(method, url, response, params=None, json_arg=None):
+    settings = get_recorder_settings()
+    if not settings["enabled"] or response is None:
+        return
+    file_name, path = get_fixture_target(url)
+    query = urlparse(url).query
+    if isinstance(params, dict) and method.upper() == "GET":
+        query = "&".join(part for part in (query, urlencode(sorted(params.items()))) if part)
+    entry = {
+        "recorded_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "method": method.upper(),
+        "host": urlparse(url).netloc,
+        "path": path,
+        "query": query if path == urlparse(url).path else "",
+        "json": json_arg,
+        "status": response.status_code,
+        "content_type": response.headers.get("Content-Type"),
+        "elapsed_ms": round(response.elapsed.total_seconds() * 1000.0, 1),
+        "body": response.text
+    }
+    fixtures_dir = settings["dir"] if os.path.isabs(settings["dir"]) else os.path.join(BASE_DIR, settings["dir"])
+    with FIXTURE_RECORDER_LOCK:
+        recorded = FIXTURE_RECORDER_STATE["counts"].get(file_name, 0)
+        if recorded >= settings["max_records_per_endpoint"]:
+            return
+        try:
+            os.makedirs(fixtures_dir, exist_ok=True)
+            with open(os.path.join(fixtures_dir, f"{file_name}.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            FIXTURE_RECORDER_STATE["counts"][file_name] = recorded + 1
+        except OSError as e:
+            logging.error(f"Ошибка записи фикстуры {file_name}: {e}")
+
+
+def send_telegram_request(method, url, **kwargs):
+    session, host_state = get_http_session(url)
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        record_http_error(host_state)
+        raise
+    record_http_fixture(method, url, response)
+    return response
+
+
+@contextlib.contextmanager
+def request_profile(profile_name):
+    profile_token = REQUEST_PROFILE.set(profile_name)
+    try:
+        yield
+    finally:
+        REQUEST_PROFILE.reset(profile_token)
+
+
+def submit_in_context(executor, func, *args):
+    # Профиль запросов хранится в contextvars, пул потоков сам его не переносит.
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def get_retry_profile():
+    profile_name = REQUEST_PROFILE.get()
+    if profile_name not in RETRY_PROFILES:
+        profile_name = "background"
+    return profile_name, RETRY_PROFILES[profile_name]
+
+
+def get_circuit_key(url):
+    parsed_url = urlparse(url)
+    return f"{parsed_url.netloc.lower()}{parsed_url.path}"
+
+
+def acquire_circuit(circuit_key):
+    now_ts = time.time()
+    with HTTP_CLIENT_LOCK:
+        circuit = CIRCUIT_BREAKER_STATE["endpoints"].setdefault(
+            circuit_key,
+            {"state": "closed", "failures": 0, "opened_ts": 0.0, "probe_inflight": False, "trips": 0}
+        )
+        if circuit["state"] == "closed":
+            return True
+        open_seconds = HTTP_CLIENT_STATE["settings"].get("circuit_open_seconds", 60)
+        if circuit["state"] == "open" and now_ts - circuit["opened_ts"] >= open_seconds:
+            circuit["state"] = "half_open"
+            circuit["probe_inflight"] = False
+        if circuit["state"] == "half_open" and not circuit["probe_inflight"]:
+            circuit["probe_inflight"] = True
+            return True
+        return False
+
+
+def record_circuit_result(circuit_key, success):
+    with HTTP_CLIENT_LOCK:
+        circuit = CIRCUIT_BREAKER_STATE["endpoints"].get(circuit_key)
+        if circuit is None:
+            return
+        circuit["probe_inflight"] = False
+        if success is None:
+            return
+        if success:
+            circuit["state"] = "closed"
+            circuit["failures"] = 0
+            return
+        circuit["failures"] += 1
+        threshold = HTTP_CLIENT_STATE["settings"].get("circuit_failure_threshold", 5)
+        if circuit["state"] == "half_open" or circuit["failures"] >= threshold:
+            if circuit["state"] != "open":
+                circuit["trips"] += 1
+                logging.warning(f"Circuit breaker открыт для {circuit_key} после {circuit['failures']} ошибок")
+            circuit["state"] = "open"
+            circuit["opened_ts"] = time.time()
+
+
+def get_rate_limit_bucket(host):
+    bucket = RATE_LIMIT_STATE["buckets"].get(host)
+    if bucket is None:
+        settings = HTTP_CLIENT_STATE["settings"]
+        burst = max(1.0, float(settings.get("rate_limit_burst", 10)))
+        bucket = {
+            "rate": max(0.1, float(settings.get("rate_limit_per_second", 5.0))),
+            "burst": burst,
+            "tokens": burst,
+            "updated_ts": time.time(),
+            "waiting": {lane: 0 for lane in RATE_LIMIT_LANES},
+            "lanes": {
+                lane: {"acquired": 0, "waited": 0, "timeouts": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+                for lane in RATE_LIMIT_LANES
+            }
+        }
+        RATE_LIMIT_STATE["buckets"][host] = bucket
+    return bucket
+
+
+def acquire_rate_limit_token(url, lane, max_wait_seconds):
+    host = urlparse(url).netloc.lower()
+    if "bybit" not in host:
+        return True
+    if lane not in RATE_LIMIT_LANES:
+        lane = "background"
+    higher_lanes = RATE_LIMIT_LANES[:RATE_LIMIT_LANES.index(lane)]
+    started_ts = time.time()
+    with RATE_LIMIT_CONDITION:
+        bucket = get_rate_limit_bucket(host)
+        lane_stats = bucket["lanes"][lane]
+        bucket["waiting"][lane] += 1
+        acquired = False
+        try:
+            while True:
+                now_ts = time.time()
+                bucket["tokens"] = min(
+                    bucket["burst"],
+                    bucket["tokens"] + (now_ts - bucket["updated_ts"]) * bucket["rate"]
+                )
+                bucket["updated_ts"] = now_ts
+                required_tokens = 1.0 + bucket["burst"] * RATE_LIMIT_LANE_RESERVE[lane]
+                higher_waiting = any(bucket["waiting"][higher_lane] for higher_lane in higher_lanes)
+                if not higher_waiting and bucket["tokens"] >= min(required_tokens, bucket["burst"]):
+                    bucket["tokens"] -= 1.0
+                    acquired = True
+                    break
+                remaining = started_ts + max_wait_seconds - now_ts
+                if remaining <= 0:
+                    break
+                refill_wait = max(0.0, min(required_tokens, bucket["burst"]) - bucket["tokens"]) / bucket["rate"]
+                RATE_LIMIT_CONDITION.wait(timeout=min(remaining, max(0.01, refill_wait)))
+        finally:
+            bucket["waiting"][lane] -= 1
+            RATE_LIMIT_CONDITION.notify_all()
+
+        wait_ms = (time.time() - started_ts) * 1000.0
+        if acquired:
+            lane_stats["acquired"] += 1
+        else:
+            lane_stats["timeouts"] += 1
+        if wait_ms >= 1.0:
+            lane_stats["waited"] += 1
+            lane_stats["total_wait_ms"] += wait_ms
+            lane_stats["max_wait_ms"] = max(lane_stats["max_wait_ms"], wait_ms)
+    return acquired
+
+
+def get_rate_limit_stats():
+    stats = {}
+    with RATE_LIMIT_CONDITION:
+        for host, bucket in RATE_LIMIT_STATE["buckets"].items():
+            stats[host] = {
+                "rate": bucket["rate"],
+                "burst": bucket["burst"],
+                "tokens": round(bucket["tokens"], 2),
+                "lanes": {
+                    lane: {
+                        "acquired": lane_stats["acquired"],
+                        "waited": lane_stats["waited"],
+                        "timeouts": lane_stats["timeouts"],
+                        "avg_wait_ms": round(lane_stats["total_wait_ms"] / lane_stats["waited"], 1)
+                        if lane_stats["waited"] else 0.0,
+                        "max_wait_ms": round(lane_stats["max_wait_ms"], 1)
+                    }
+                    for lane, lane_stats in bucket["lanes"].items()
+                }
+            }
+    return stats
+
+
+def parse_retry_after(response):
+    value = ((response.headers if response is not None else None) or {}).get("Retry-After")
+    if not value:
+        return None
+    seconds = safe_float(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        retry_dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_dt.timestamp() - time.time())
+
+
+def is_transient_status(status_code):
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def record_retry_stat(profile_name, key):
+    with HTTP_CLIENT_LOCK:
+        RETRY_STATS[profile_name][key] += 1
+
+
+def get_retry_stats():
+    with HTTP_CLIENT_LOCK:
+        return {
+            "profiles": {profile_name: dict(stats) for profile_name, stats in RETRY_STATS.items()},
+            "circuits": {
+                circuit_key: {
+                    "state": circuit["state"],
+                    "failures": circuit["failures"],
+                    "trips": circuit["trips"]
+                }
+                for circuit_key, circuit in CIRCUIT_BREAKER_STATE["endpoints"].items()
+            }
+        }
+
+
+def retry_request(url, method='GET', headers=None, params=None, json_arg=None, cookies_arg=None, timeout=None,
                   notify_expire_on_fail=None, max_retries=None):
     if notify_expire_on_fail is None:
         notify_expire_on_fail = "bybit.com" in url
+    profile_name, profile = get_retry_profile()
     if max_retries is None:
-        max_retries = MAX_RETRIES
+        max_retries = profile["max_retries"]
+    if timeout is None:
+        timeout = profile["timeout"]
+    deadline_ts = time.time() + profile["deadline_seconds"]
+    circuit_key = get_circuit_key(url)
+    record_retry_stat(profile_name, "calls")
 
     attempts = 0
+    delay = profile["base_delay"]
+    http_response_received = False
     while attempts < max_retries:
+        if not acquire_circuit(circuit_key):
+            record_retry_stat(profile_name, "short_circuited")
+            logging.warning(f"Запрос к {circuit_key} пропущен: circuit breaker открыт")
+            return None
+        if not acquire_rate_limit_token(url, profile_name, max(0.0, deadline_ts - time.time())):
+            # Локальный лимитер — не ответ Bybit, об истечении cookies тут не сообщаем.
+            record_circuit_result(circuit_key, None)
+            record_retry_stat(profile_name, "deadline_exhausted")
+            logging.warning(f"Запрос к {circuit_key} пропущен: не дождались токена лимитера")
+            return None
+        remaining = deadline_ts - time.time()
+        session, host_state = get_http_session(url)
         try:
+            attempt_timeout = max(1.0, min(timeout, remaining))
             if method == 'GET':
-                response = requests.get(url, headers=headers, params=params, cookies=cookies_arg, timeout=timeout)
+                response = session.get(url, headers=headers, params=params, cookies=cookies_arg, timeout=attempt_timeout)
             else:
                 if json_arg is not None:
-                    response = requests.post(url, headers=headers, json=json_arg, cookies=cookies_arg, timeout=timeout)
+                    response = session.post(
+                        url, headers=headers, json=json_arg, cookies=cookies_arg, timeout=attempt_timeout
+                    )
                 else:
-                    response = requests.post(url, headers=headers, data=params, cookies=cookies_arg, timeout=timeout)
+                    response = session.post(
+                        url, headers=headers, data=params, cookies=cookies_arg, timeout=attempt_timeout
+                    )
             response.raise_for_status()
+            record_circuit_result(circuit_key, True)
+            record_http_fixture(method, url, response, params=params, json_arg=json_arg)
             return response
         except requests.RequestException as e:
-            status_code = getattr(getattr(e, "response", None), "status_code", None)
+            record_http_error(host_state)
+            error_response = getattr(e, "response", None)
+            status_code = getattr(error_response, "status_code", None)
+            http_response_received = http_response_received or error_response is not None
+            transient = is_transient_status(status_code)
+            record_circuit_result(circuit_key, not transient)
             if status_code == 429 and not notify_expire_on_fail:
                 logging.warning(f"Rate limit for {url}: {e}")
             else:
                 logging.error(f"Ошибка запроса: {e}")
             attempts += 1
-            sleep(2 ** attempts)
-    if notify_expire_on_fail:
+            if not transient or attempts >= max_retries:
+                break
+            # Decorrelated jitter: следующая пауза случайна между базовой и утроенной предыдущей.
+            delay = min(profile["max_delay"], random.uniform(profile["base_delay"], delay * 3))
+            if status_code == 429:
+                retry_after = parse_retry_after(error_response)
+                if retry_after is not None:
+                    delay = retry_after
+            if time.time() + delay >= deadline_ts:
+                record_retry_stat(profile_name, "deadline_exhausted")
+                break
+            record_retry_stat(profile_name, "retries")
+            sleep(delay)
+    record_retry_stat(profile_name, "failures")
+    # Сетевые сбои без HTTP-ответа не означают истёкшие cookies.
+    if notify_expire_on_fail and http_response_received:
         expire_mode_notify()
     return None
 
 
-def get_usdt_to_rub():
-    now_ts = time.time()
-    cached_value = RUB_CACHE["value"]
-    updated_ts = RUB_CACHE["updated_ts"]
+def store_usdt_to_rub(value, updated_ts, source):
+    with RUB_CACHE_LOCK:
+        if updated_ts < RUB_CACHE["updated_ts"]:
+            return
+        RUB_CACHE["value"] = value
+        RUB_CACHE["updated_ts"] = updated_ts
+        RUB_CACHE["source"] = source
 
-    if cached_value is not None and (now_ts - updated_ts) < RUB_CACHE["ttl_seconds"]:
-        return cached_value
 
-    response = retry_request(
-        'https://api.coingecko.com/api/v3/simple/price?ids=tether&vs_currencies=rub',
-        notify_expire_on_fail=False,
-        max_retries=1
+def insert_usdt_to_rub_rate(cursor, date_str, rate, source):
+    cursor.execute(
+        "INSERT OR REPLACE INTO usdt_rub_rates (date, rate, source) VALUES (?, ?, ?)",
+        (date_str, rate, source)
     )
+
+
+def refresh_usdt_to_rub():
+    now_ts = time.time()
+    response = retry_request(USDT_RUB_RATE_URL, notify_expire_on_fail=False, max_retries=1)
+    value = None
     if response:
-        data = response.json()
         try:
-            value = float(data['tether']['rub'])
-            RUB_CACHE["value"] = value
-            RUB_CACHE["updated_ts"] = now_ts
-            return value
+            value = float(response.json()['tether']['rub'])
         except (KeyError, ValueError, TypeError):
-            pass
+            value = None
+    if value is None:
+        with RUB_CACHE_LOCK:
+            RUB_CACHE["last_error"] = datetime.fromtimestamp(now_ts).strftime('%Y-%m-%d %H:%M:%S')
+        return None
+
+    store_usdt_to_rub(value, now_ts, "coingecko")
+    if USE_DB:
+        try:
+            ensure_db_schema()
+            run_db_write(
+                insert_usdt_to_rub_rate,
+                datetime.fromtimestamp(now_ts).strftime('%Y-%m-%d %H:%M:%S'),
+                value,
+                "coingecko"
+            )
+        except Exception as e:
+            logging.error(f"Ошибка сохранения курса USDT/RUB: {e}")
+    return value
+
+
+def load_last_usdt_to_rub():
+    if not USE_DB:
+        return None
+    ensure_db_schema()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT date, rate, source FROM usdt_rub_rates ORDER BY date DESC LIMIT 1")
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    updated_ts = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S').timestamp()
+    store_usdt_to_rub(row[1], updated_ts, f"{row[2] or 'history'} (db)")
+    return row[1]
+
 
-    if cached_value is not None and (now_ts - updated_ts) < RUB_CACHE["stale_ttl_seconds"]:
+def get_historical_usdt_to_rub(date_str):
+    if not USE_DB:
+        return None
+    ensure_db_schema()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT rate FROM usdt_rub_rates WHERE date <= ? ORDER BY date DESC LIMIT 1",
+        (date_str,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    # Курс из будущего не подставляем: до первого известного курса рублёвое значение остаётся пустым.
+    return row[0] if row else None
+
+
+def get_usdt_to_rub():
+    now_ts = time.time()
+    with RUB_CACHE_LOCK:
+        cached_value = RUB_CACHE["value"]
+        updated_ts = RUB_CACHE["updated_ts"]
+
+    if cached_value is None:
+        try:
+            cached_value = load_last_usdt_to_rub()
+        except Exception as e:
+            logging.error(f"Ошибка чтения истории курса USDT/RUB: {e}")
+        with RUB_CACHE_LOCK:
+            updated_ts = RUB_CACHE["updated_ts"]
+        if cached_value is None:
+            # Холодный старт без истории: курс ещё негде взять, кроме сети.
+            return refresh_usdt_to_rub()
+
+    if (now_ts - updated_ts) < RUB_CACHE["stale_ttl_seconds"]:
         return cached_value
     return None
 
 
+def get_usdt_to_rub_info():
+    with RUB_CACHE_LOCK:
+        value = RUB_CACHE["value"]
+        updated_ts = RUB_CACHE["updated_ts"]
+        return {
+            "value": value,
+            "source": RUB_CACHE["source"],
+            "updated_at": datetime.fromtimestamp(updated_ts).strftime('%Y-%m-%d %H:%M:%S') if updated_ts else None,
+            "age_seconds": round(time.time() - updated_ts, 1) if updated_ts else None,
+            "last_error": RUB_CACHE["last_error"]
+        }
+
+
+def usdt_to_rub_needs_refresh():
+    with RUB_CACHE_LOCK:
+        age_seconds = time.time() - RUB_CACHE["updated_ts"]
+        return RUB_CACHE["value"] is None or age_seconds >= (
+            RUB_CACHE["ttl_seconds"] - RUB_CACHE["refresh_ahead_seconds"]
+        )
+
+
+def recompute_missing_balance_rub():
+    if not USE_DB:
+        return 0
+    ensure_db_schema()
+    return run_db_write(apply_missing_balance_rub)
+
+
+def apply_missing_balance_rub(cursor):
+    # Строки до отметки уже проверены: те, что остались пустыми, заполнить нечем (курса тогда не было).
+    cursor.execute("SELECT value FROM rollup_state WHERE key = ?", (BALANCE_RUB_WATERMARK_KEY,))
+    watermark_row = cursor.fetchone()
+    watermark_date = watermark_row[0] if watermark_row else ""
+    cursor.execute(
+        "SELECT date, current_balance FROM balances "
+        "WHERE (balance_rub IS NULL OR balance_rub = 0) AND current_balance > 0 AND date > ?",
+        (watermark_date,)
+    )
+    rows = cursor.fetchall()
+    updated = 0
+    for date_str, current_balance in rows:
+        rate = get_historical_usdt_to_rub(date_str)
+        if not rate:
+            continue
+        cursor.execute("UPDATE balances SET balance_rub = ? WHERE date = ?", (current_balance * rate, date_str))
+        updated += 1
+    cursor.execute("SELECT MAX(date) FROM balances")
+    last_date = cursor.fetchone()[0]
+    if last_date and last_date > watermark_date:
+        set_rollup_state_value(cursor, BALANCE_RUB_WATERMARK_KEY, last_date)
+    return updated
+
+
 def get_bybit_browser_headers(referer='https://www.bybit.com/'):
     return {
         'User-Agent': ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
@@ -969,12 +3280,14 @@ def get_bybit_browser_headers(referer='https://www.bybit.com/'):
     }
 
 
-def fetch_bot_list_page(page_num=1, page_size=BOT_PAGE_SIZE, status=None):
+def request_bot_list_page(page_num=1, page_size=BOT_PAGE_SIZE, status=None):
     global WAITING_FOR_RENEW
+    page_result = {"page": int(page_num), "bots": [], "total": 0, "error": None}
     cookie_jar = get_bybit_cookie_jar()
     if not cookie_jar.get("secure-token"):
         expire_mode_notify()
-        return [], 0
+        page_result["error"] = "missing_secure_token"
+        return page_result
 
     payload = {
         "pageNum": int(page_num),
@@ -990,44 +3303,188 @@ def fetch_bot_list_page(page_num=1, page_size=BOT_PAGE_SIZE, status=None):
         json_arg=payload,
         cookies_arg=cookie_jar
     )
-    if response:
-        data = response.json()
-        if data.get("ret_code") == 0:
-            WAITING_FOR_RENEW = False
-            result = data.get("result") or {}
-            bots = result.get("bots") or []
-            total = safe_int(result.get("total"))
-            return bots, total if total is not None else len(bots)
-        if data.get("ret_code") == 10007:
-            expire_mode_notify()
-    return [], 0
+    if not response:
+        page_result["error"] = "request_failed"
+        return page_result
+    data = response.json()
+    if data.get("ret_code") == 0:
+        WAITING_FOR_RENEW = False
+        result = data.get("result") or {}
+        bots = result.get("bots") or []
+        total = safe_int(result.get("total"))
+        page_result["bots"] = bots
+        page_result["total"] = total if total is not None else len(bots)
+        return page_result
+    if data.get("ret_code") == 10007:
+        expire_mode_notify()
+    page_result["error"] = f"ret_code:{data.get('ret_code')}"
+    return page_result
 
 
-def fetch_all_bot_pages(status=None, page_size=BOT_PAGE_SIZE, max_pages=None):
-    page_num = 1
-    total = None
+def fetch_bot_list_page(page_num=1, page_size=BOT_PAGE_SIZE, status=None):
+    page_result = request_bot_list_page(page_num=page_num, page_size=page_size, status=status)
+    return page_result["bots"], page_result["total"]
+
+
+def get_raw_bot_id(bot_data):
+    _, future_grid, futures_mart, spot_grid, _, combo = get_bot_detail_payload(bot_data)
+    for payload, key in ((future_grid, "grid_id"), (futures_mart, "bot_id"), (spot_grid, "grid_id"), (combo, "bot_id")):
+        value = payload.get(key)
+        if value not in (None, ""):
+            return str(value)
+    return None
+
+
+def get_raw_bot_ended_ts(bot_data):
+    bot_type, future_grid, futures_mart, spot_grid, _, combo = get_bot_detail_payload(bot_data)
+    payload, key = {
+        "GRID_FUTURES": (future_grid, "end_time"),
+        "MART_FUTURES": (futures_mart, "end_time"),
+        "GRID_SPOT": (spot_grid, "modify_time"),
+        "COMBO_FUTURES": (combo, "end_time")
+    }.get(bot_type, ({}, None))
+    return normalize_epoch_timestamp(payload.get(key)) if key else None
+
+
+def collect_bot_pages(status=None, page_size=BOT_PAGE_SIZE, max_pages=None):
+    started_ts = time.time()
+    first_page = request_bot_list_page(page_num=1, page_size=page_size, status=status)
+    page_results = [first_page]
+    total = first_page["total"]
+    # Сервер может урезать pageSize; тогда листаем страницами того размера, который он реально отдаёт.
+    served_page_size = min(page_size, len(first_page["bots"]))
+    if not first_page["error"] and served_page_size and (total or 0) > served_page_size:
+        page_count = max(1, math.ceil((total or 0) / served_page_size))
+        if max_pages is not None:
+            page_count = min(page_count, max(1, int(max_pages)))
+        futures = [
+            submit_in_context(BOT_PAGE_EXECUTOR, request_bot_list_page, page_num, served_page_size, status)
+            for page_num in range(2, page_count + 1)
+        ]
+        for page_num, future in enumerate(futures, start=2):
+            try:
+                page_results.append(future.result())
+            except Exception as e:
+                page_results.append({"page": page_num, "bots": [], "total": 0, "error": str(e)})
+
     all_bots = []
+    seen_bot_ids = set()
+    duplicates = 0
+    failed_pages = []
+    for page_result in page_results:
+        if page_result["error"]:
+            failed_pages.append({"page": page_result["page"], "error": page_result["error"]})
+            continue
+        for bot_data in page_result["bots"]:
+            bot_id = get_raw_bot_id(bot_data) if isinstance(bot_data, dict) else None
+            if bot_id is not None:
+                if bot_id in seen_bot_ids:
+                    duplicates += 1
+                    continue
+                seen_bot_ids.add(bot_id)
+            all_bots.append(bot_data)
+
+    report = {
+        "status": status,
+        "total": total,
+        "pages": len(page_results),
+        "bots": len(all_bots),
+        "duplicates": duplicates,
+        "failed_pages": failed_pages,
+        "elapsed_ms": round((time.time() - started_ts) * 1000.0, 1),
+        "finished_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    BOT_PAGE_FETCH_STATE["last_reports"]["history" if status == BOT_HISTORY_STATUS else "active"] = report
+    if failed_pages:
+        logging.warning(
+            "Bot list pages failed (status=%s): %s",
+            status,
+            ", ".join(f"{item['page']}:{item['error']}" for item in failed_pages)
+        )
+    return all_bots, report
 
-    while True:
-        page_bots, page_total = fetch_bot_list_page(page_num=page_num, page_size=page_size, status=status)
-        if total is None:
-            total = page_total
-        if not page_bots:
-            break
-        all_bots.extend(page_bots)
-        if max_pages is not None and page_num >= max_pages:
-            break
-        if total is not None and len(all_bots) >= total:
-            break
-        if len(page_bots) < page_size:
-            break
-        page_num += 1
 
+def fetch_all_bot_pages(status=None, page_size=BOT_PAGE_SIZE, max_pages=None):
+    all_bots, _ = collect_bot_pages(status=status, page_size=page_size, max_pages=max_pages)
     return all_bots
 
 
-def fetch_bot_list_data():
-    return fetch_all_bot_pages()
+def build_active_bots_snapshot(bots, fetched_ts, stale=False):
+    return {
+        "bots": list(bots or []),
+        "fetched_ts": fetched_ts,
+        "fetched_at": datetime.fromtimestamp(fetched_ts).strftime('%Y-%m-%d %H:%M:%S') if fetched_ts else None,
+        "stale": stale
+    }
+
+
+def get_active_bots_snapshot(max_age_seconds=None):
+    if max_age_seconds is None:
+        max_age_seconds = ACTIVE_BOTS_SNAPSHOT_MAX_AGE_SECONDS
+    with ACTIVE_BOTS_SNAPSHOT_LOCK:
+        state = ACTIVE_BOTS_SNAPSHOT_STATE
+        if state["bots"] is not None and (time.time() - state["fetched_ts"]) <= max_age_seconds:
+            state["hits"] += 1
+            return build_active_bots_snapshot(state["bots"], state["fetched_ts"])
+        inflight = state["inflight"]
+        is_leader = inflight is None
+        if is_leader:
+            inflight = {"event": threading.Event(), "snapshot": None}
+            state["inflight"] = inflight
+            state["fetches"] += 1
+        else:
+            state["waits"] += 1
+
+    if not is_leader:
+        inflight["event"].wait()
+        return inflight["snapshot"] or build_active_bots_snapshot([], 0.0, stale=True)
+
+    bots, report = [], None
+    try:
+        bots, report = collect_bot_pages()
+    except Exception:
+        logging.exception("Ошибка загрузки списка активных ботов")
+    finally:
+        fetched_ts = time.time()
+        with ACTIVE_BOTS_SNAPSHOT_LOCK:
+            state = ACTIVE_BOTS_SNAPSHOT_STATE
+            if report is not None and not report["failed_pages"]:
+                state["bots"] = bots
+                state["fetched_ts"] = fetched_ts
+                snapshot = build_active_bots_snapshot(bots, fetched_ts)
+            elif (
+                state["bots"] is not None
+                and (fetched_ts - state["fetched_ts"]) <= ACTIVE_BOTS_SNAPSHOT_STALE_SECONDS
+            ):
+                snapshot = build_active_bots_snapshot(state["bots"], state["fetched_ts"], stale=True)
+            else:
+                snapshot = build_active_bots_snapshot(bots, fetched_ts, stale=True)
+            inflight["snapshot"] = snapshot
+            state["inflight"] = None
+        inflight["event"].set()
+    return snapshot
+
+
+def get_active_bots_snapshot_stats():
+    with ACTIVE_BOTS_SNAPSHOT_LOCK:
+        state = ACTIVE_BOTS_SNAPSHOT_STATE
+        return {
+            "bots": len(state["bots"] or []),
+            "fetched_ts": state["fetched_ts"],
+            "age_seconds": round(time.time() - state["fetched_ts"], 1) if state["fetched_ts"] else None,
+            "hits": state["hits"],
+            "fetches": state["fetches"],
+            "waits": state["waits"]
+        }
+
+
+def get_cached_active_bots():
+    with ACTIVE_BOTS_SNAPSHOT_LOCK:
+        return list(ACTIVE_BOTS_SNAPSHOT_STATE["bots"] or [])
+
+
+def fetch_bot_list_data(max_age_seconds=None):
+    return get_active_bots_snapshot(max_age_seconds=max_age_seconds)["bots"]
 
 
 def fetch_historical_bot_list_data():
@@ -1056,17 +3513,347 @@ def parse_total_balance_items(balance_items):
     return account_balances, total_balance, has_total_balance
 
 
-def fetch_balance_cookies(add_to_db=True):
-    global WAITING_FOR_RENEW
+def use_bybit_api():
+    return bool(config.get("USE_API")) and bool(config.get("API_KEY")) and bool(config.get("API_SECRET"))
+
+
+def get_balance_transport():
+    return "api" if use_bybit_api() else "cookies"
+
+
+def sync_bybit_server_time(force=False):
+    settings = get_bybit_api_settings()
+    base_url = settings["base_url"].rstrip("/")
+    with BYBIT_API_TIME_LOCK:
+        if (
+            not force
+            and BYBIT_API_TIME_STATE["base_url"] == base_url
+            and (time.time() - BYBIT_API_TIME_STATE["synced_ts"]) < settings["time_sync_seconds"]
+        ):
+            return BYBIT_API_TIME_STATE["offset_ms"]
+
+    request_started_ms = time.time() * 1000.0
+    response = retry_request(f"{base_url}/v5/market/time", notify_expire_on_fail=False, max_retries=2)
+    request_finished_ms = time.time() * 1000.0
+    if not response:
+        return BYBIT_API_TIME_STATE["offset_ms"]
+    data = response.json()
+    server_ms = safe_int(data.get("time"))
+    if server_ms is None:
+        server_seconds = safe_int((data.get("result") or {}).get("timeSecond"))
+        server_ms = server_seconds * 1000 if server_seconds is not None else None
+    if server_ms is None:
+        return BYBIT_API_TIME_STATE["offset_ms"]
+
+    # Сервер отвечает примерно в середине запроса.
+    offset_ms = int(server_ms - (request_started_ms + request_finished_ms) / 2)
+    with BYBIT_API_TIME_LOCK:
+        BYBIT_API_TIME_STATE["offset_ms"] = offset_ms
+        BYBIT_API_TIME_STATE["synced_ts"] = time.time()
+        BYBIT_API_TIME_STATE["base_url"] = base_url
+    return offset_ms
+
+
+def sign_bybit_api_payload(api_secret, timestamp_ms, api_key, recv_window, payload):
+    message = f"{timestamp_ms}{api_key}{recv_window}{payload}"
+    return hmac.new(api_secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def request_bybit_api(path, params=None):
+    settings = get_bybit_api_settings()
+    base_url = settings["base_url"].rstrip("/")
+    api_key = str(config.get("API_KEY") or "")
+    api_secret = str(config.get("API_SECRET") or "")
+    recv_window = settings["recv_window"]
+    query_string = urlencode(sorted((params or {}).items()))
+
+    for attempt in range(2):
+        timestamp_ms = int(time.time() * 1000) + sync_bybit_server_time(force=attempt > 0)
+        headers = {
+            "X-BAPI-API-KEY": api_key,
+            "X-BAPI-TIMESTAMP": str(timestamp_ms),
+            "X-BAPI-RECV-WINDOW": str(recv_window),
+            "X-BAPI-SIGN": sign_bybit_api_payload(api_secret, timestamp_ms, api_key, recv_window, query_string)
+        }
+        response = retry_request(
+            f"{base_url}{path}?{query_string}" if query_string else f"{base_url}{path}",
+            headers=headers,
+            notify_expire_on_fail=False
+        )
+        if not response:
+            return None
+        data = response.json()
+        ret_code = data.get("retCode")
+        # 10002: метка времени вне recv_window, пересинхронизируем часы и повторяем один раз.
+        if ret_code == 10002 and attempt == 0:
+            continue
+        if ret_code != 0:
+            logging.error(f"Bybit API {path} вернул {ret_code}: {data.get('retMsg')}")
+            return None
+        return data.get("result") or {}
+    return None
+
+
+def request_api_total_balance(cookie_jar=None):
+    settings = get_bybit_api_settings()
+    unified = request_bybit_api("/v5/account/wallet-balance", {"accountType": "UNIFIED"})
+    if unified is None:
+        return None
+    balance_items = []
+    for account in unified.get("list") or []:
+        balance_items.append({
+            "accountType": f"ACCOUNT_TYPE_{account.get('accountType') or 'UNIFIED'}",
+            "quoteBalance": account.get("totalEquity")
+        })
+
+    fund_coins = []
+    for coin in settings["fund_coins"].split(","):
+        coin = coin.strip().upper()
+        if not coin:
+            continue
+        if coin not in BYBIT_API_STABLE_FUND_COINS:
+            logging.warning(f"Монета {coin} в fund_coins пропущена: поддерживаются только стейблкоины")
+            continue
+        fund_coins.append(coin)
+    if fund_coins:
+        # Один запрос на все монеты фондового счёта вместо запроса на каждую.
+        fund = request_bybit_api(
+            "/v5/asset/transfer/query-account-coins-balance",
+            {"accountType": "FUND", "coin": ",".join(fund_coins)}
+        )
+        fund_total = sum(
+            safe_float(item.get("walletBalance")) or 0.0
+            for item in ((fund or {}).get("balance") or [])
+        )
+        if fund is not None:
+            balance_items.append({"accountType": "ACCOUNT_TYPE_FUND", "quoteBalance": str(fund_total)})
+
+    return {"ret_code": 0, "result": {"totalBalanceItems": balance_items}}
+
+
+def request_cookie_total_balance(cookie_jar):
+    return request_bybit_json(BALANCE_URL, cookie_jar)
+
+
+BALANCE_TRANSPORTS = {
+    "cookies": request_cookie_total_balance,
+    "api": request_api_total_balance
+}
+
+
+def get_bybit_api_stats():
+    with BYBIT_API_TIME_LOCK:
+        synced_ts = BYBIT_API_TIME_STATE["synced_ts"]
+        return {
+            "enabled": use_bybit_api(),
+            "transport": get_balance_transport(),
+            "time_offset_ms": BYBIT_API_TIME_STATE["offset_ms"],
+            "time_synced_at": datetime.fromtimestamp(synced_ts).strftime('%Y-%m-%d %H:%M:%S') if synced_ts else None
+        }
+
+
+def request_bybit_json(url, cookie_jar):
+    response = retry_request(url, cookies_arg=cookie_jar)
+    if response is None:
+        return None
+    return response.json()
+
+
+def run_timed_stage(func, *args):
+    started_ts = time.time()
+    try:
+        return func(*args), None, (time.time() - started_ts) * 1000.0
+    except Exception as e:
+        return None, e, (time.time() - started_ts) * 1000.0
+
+
+def collect_sample_stage(stage_futures, stage_name, sample_timings, fallback=None):
+    if stage_name not in stage_futures:
+        sample_timings["stages"][stage_name] = {"ms": 0.0, "status": "skipped"}
+        return fallback
+    deadline_ts = sample_timings["started_ts"] + SAMPLE_STAGE_DEADLINES[stage_name]
+    try:
+        result, error, elapsed_ms = stage_futures[stage_name].result(timeout=max(0.0, deadline_ts - time.time()))
+    except FuturesTimeoutError:
+        sample_timings["stages"][stage_name] = {
+            "ms": round((time.time() - sample_timings["started_ts"]) * 1000.0, 1),
+            "status": "timeout"
+        }
+        logging.warning(
+            f"Этап {stage_name} не уложился в {SAMPLE_STAGE_DEADLINES[stage_name]} с, используется запасное значение"
+        )
+        return fallback
+    if error is not None:
+        logging.error(f"Ошибка этапа {stage_name}: {error}")
+        status = "error"
+    elif result is None:
+        status = "empty"
+    else:
+        status = "ok"
+    sample_timings["stages"][stage_name] = {"ms": round(elapsed_ms, 1), "status": status}
+    return result if status == "ok" else fallback
+
+
+@contextlib.contextmanager
+def time_sample_stage(sample_timings, stage_name):
+    started_ts = time.time()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        sample_timings["stages"][stage_name] = {
+            "ms": round((time.time() - started_ts) * 1000.0, 1),
+            "status": status
+        }
+
+
+def record_sample_timings(sample_timings):
+    entry = {
+        "started_at": datetime.fromtimestamp(sample_timings["started_ts"]).strftime('%Y-%m-%d %H:%M:%S'),
+        "total_ms": round((time.time() - sample_timings["started_ts"]) * 1000.0, 1),
+        "transport": sample_timings.get("transport"),
+        "stages": sample_timings["stages"]
+    }
+    with SAMPLE_TIMINGS_LOCK:
+        SAMPLE_TIMINGS_STATE["history"].append(entry)
+    return entry
+
+
+def get_sample_timing_stats():
+    with SAMPLE_TIMINGS_LOCK:
+        history = list(SAMPLE_TIMINGS_STATE["history"])
+    stage_names = []
+    for entry in history:
+        for stage_name in entry["stages"]:
+            if stage_name not in stage_names:
+                stage_names.append(stage_name)
+    stage_stats = {}
+    for stage_name in stage_names:
+        stage_entries = [entry["stages"][stage_name] for entry in history if stage_name in entry["stages"]]
+        durations = [stage_entry["ms"] for stage_entry in stage_entries]
+        stage_stats[stage_name] = {
+            "samples": len(stage_entries),
+            "avg_ms": round(statistics.mean(durations), 1),
+            "max_ms": max(durations),
+            "degraded": sum(1 for stage_entry in stage_entries if stage_entry["status"] not in ("ok", "skipped"))
+        }
+    return {
+        "last": history[-1] if history else None,
+        "samples": len(history),
+        "stages": stage_stats
+    }
 
+
+def fetch_balance_sample(add_to_db=True):
+    transport = get_balance_transport()
     cookie_jar = get_bybit_cookie_jar()
-    if not cookie_jar.get("secure-token"):
+    has_cookies = bool(cookie_jar.get("secure-token"))
+    if transport == "cookies" and not has_cookies:
         expire_mode_notify()
         return "Не найден secure-token. Обновите cookies."
 
-    response = retry_request(BALANCE_URL, cookies_arg=cookie_jar)
-    if response:
-        data = response.json()
+    sample_timings = {"started_ts": time.time(), "stages": {}, "transport": transport}
+    stage_futures = {
+        "balance": submit_in_context(
+            SAMPLE_FETCH_EXECUTOR,
+            run_timed_stage,
+            BALANCE_TRANSPORTS[transport],
+            cookie_jar
+        )
+    }
+    # Список ботов и сводка бот-счёта есть только в веб-API, v5 их не отдаёт.
+    if has_cookies:
+        stage_futures["bots"] = submit_in_context(
+            SAMPLE_FETCH_EXECUTOR,
+            run_timed_stage,
+            get_active_bots_snapshot,
+            ACTIVE_BOTS_SAMPLE_MAX_AGE_SECONDS
+        )
+        stage_futures["asset_summary"] = submit_in_context(
+            SAMPLE_FETCH_EXECUTOR,
+            run_timed_stage,
+            request_bybit_json,
+            ASSET_SUMMARY_URL,
+            cookie_jar
+        )
+    try:
+        return build_balance_sample(stage_futures, sample_timings, add_to_db=add_to_db)
+    finally:
+        record_sample_timings(sample_timings)
+
+
+BALANCE_REPLACE_SQL = (
+    "REPLACE INTO balances (date, current_balance, balance_rub, change_percent, balance_in_usd, balance_in_btc, "
+    "profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd, current_profit_in_btc, "
+    "current_pnl_percentage, origin_balance, bot_balance, funding_balance, non_bot_balance, update_interval, "
+    "date_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def write_balance_sample(balance_row, entries, rebuilt=0):
+    # Строка баланса, снимки и архив ботов и ремонт хвоста истории уходят одним коммитом:
+    # читатели видят либо весь сэмпл, либо ничего.
+    ensure_db_schema()
+    if entries:
+        load_archived_bot_fingerprints()
+    history_saved, saved_fingerprints, unchanged = run_db_write(apply_balance_sample, balance_row, entries)
+    if entries and history_saved:
+        commit_bot_archive_fingerprints(saved_fingerprints, unchanged, rebuilt, True)
+
+
+def apply_balance_sample(cursor, balance_row, entries):
+    snapshot_time = balance_row[0]
+    saved_fingerprints, unchanged = {}, 0
+    date_ts = balance_row[-1]
+    # REPLACE поверх существующей строки нельзя добавлять к агрегатам: сумма и счётчик удвоятся.
+    cursor.execute("SELECT 1 FROM balances WHERE date = ?", (snapshot_time,))
+    replaced = cursor.fetchone() is not None
+    cursor.execute(BALANCE_REPLACE_SQL, balance_row)
+    if not replaced:
+        apply_balance_rollup_sample(cursor, date_ts, balance_row[1], balance_row[4])
+    queue_balance_history_append(date_ts, get_balance_rollup_value(balance_row[1], balance_row[4]))
+    history_saved = True
+    cursor.execute("SAVEPOINT bot_history")
+    try:
+        if entries:
+            fact_rows = write_bot_snapshot_rows(cursor, snapshot_time, entries)
+            if not replaced:
+                apply_bot_rollup_samples(cursor, fact_rows)
+            saved_fingerprints, unchanged = write_bot_archive_rows(cursor, snapshot_time, entries)
+        apply_balance_history_repair(cursor)
+        apply_duplicate_bot_balance_repair(cursor, limit_rows=720)
+        cursor.execute("RELEASE SAVEPOINT bot_history")
+    except Exception as e:
+        # Сбой истории ботов не должен терять саму строку баланса.
+        cursor.execute("ROLLBACK TO SAVEPOINT bot_history")
+        cursor.execute("RELEASE SAVEPOINT bot_history")
+        reset_bot_dim_cache()
+        logging.error(f"Ошибка сохранения истории ботов: {e}")
+        history_saved, saved_fingerprints, unchanged = False, {}, 0
+    if replaced:
+        rebuild_rollup_range(cursor, date_ts, date_ts)
+    return history_saved, saved_fingerprints, unchanged
+
+
+def get_last_known_bot_balance():
+    if not USE_DB:
+        return None
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT bot_balance FROM balances WHERE bot_balance > 0 ORDER BY date_ts DESC LIMIT 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    return safe_float(row[0]) if row else None
+
+
+def build_balance_sample(stage_futures, sample_timings, add_to_db=True):
+    global WAITING_FOR_RENEW
+
+    data = collect_sample_stage(stage_futures, "balance", sample_timings)
+    if data is not None:
         if data.get("ret_code") == 0:
             WAITING_FOR_RENEW = False
         if data.get("ret_code") == 10007:
@@ -1086,8 +3873,17 @@ def fetch_balance_cookies(add_to_db=True):
             if has_fallback_total else 0.0
         )
         base_balance = fallback_total_balance if has_fallback_total else bot_wallet_balance
-        active_bots = fetch_bot_list_data()
-        active_bot_records = build_bot_archive_records(active_bots, is_active=True)
+        bots_snapshot = collect_sample_stage(
+            stage_futures,
+            "bots",
+            sample_timings,
+            fallback=build_active_bots_snapshot(get_cached_active_bots(), 0.0, stale=True)
+        )
+        active_bots = bots_snapshot["bots"]
+        # Устаревший снимок годится для сообщения, но не как история ботов за текущую минуту.
+        persist_bots = not bots_snapshot["stale"]
+        active_bot_entries, rebuilt_bot_entries = build_bot_sample_entries(active_bots, is_active=True)
+        active_bot_records = [entry["record"] for entry in active_bot_entries]
 
         bot_balance = bot_wallet_balance
         balance_in_usd = base_balance
@@ -1099,15 +3895,22 @@ def fetch_balance_cookies(add_to_db=True):
         current_profit_in_btc = 0.0
         current_pnl_percentage = 0.0
 
-        response2 = retry_request(ASSET_SUMMARY_URL, method='GET', cookies_arg=cookie_jar)
-        if response2 is not None:
-            data2 = response2.json()
+        # В v5 API бот-счёта нет среди счетов, его баланс приходит только из сводки по cookies;
+        # без cookies сводка не запрашивается, и бот-счёт в режиме API не учитывается вовсе.
+        bot_balance_known = (
+            'ACCOUNT_TYPE_BOT' in account_balances
+            or sample_timings.get("transport") != "api"
+            or "asset_summary" not in stage_futures
+        )
+        data2 = collect_sample_stage(stage_futures, "asset_summary", sample_timings)
+        if data2 is not None:
             if data2.get("ret_code") == 0:
                 asset_summary = data2["result"]["asset_summary"]
                 try:
                     summary_balance = float(asset_summary.get("balance_in_usd", bot_wallet_balance))
                     if summary_balance > 0:
                         bot_balance = summary_balance
+                    bot_balance_known = True
                 except Exception:
                     bot_balance = bot_wallet_balance
                 try:
@@ -1155,6 +3958,15 @@ def fetch_balance_cookies(add_to_db=True):
                 non_bot_balance = corrected_non_bot_balance
                 funding_balance = min(funding_balance, non_bot_balance)
 
+        if not bot_balance_known:
+            # Без бот-счёта сумма выглядела бы как обвал баланса: берём последний известный и не пишем сэмпл.
+            last_bot_balance = get_last_known_bot_balance()
+            if last_bot_balance is not None:
+                bot_balance = last_bot_balance
+            if add_to_db:
+                logging.warning("Баланс бот-счёта недоступен, сэмпл не сохраняется в историю")
+                add_to_db = False
+
         if has_fallback_total:
             balance_in_usd = non_bot_balance + bot_balance
         else:
@@ -1162,11 +3974,19 @@ def fetch_balance_cookies(add_to_db=True):
 
         current_balance = get_effective_balance_value(base_balance, balance_in_usd)
         origin_balance = bot_balance
-        usdt_to_rub = get_usdt_to_rub()
+        with time_sample_stage(sample_timings, "rub_rate"):
+            usdt_to_rub = get_usdt_to_rub()
         rub_balance = current_balance * usdt_to_rub if usdt_to_rub else 0.0
         now = datetime.now()
-        history_rows = get_effective_balance_history()
-        closest_balance_24h_ago = get_closest_balance_value(history_rows, now - timedelta(hours=24))
+        previous_message_dt = now - timedelta(minutes=max(1, int(balance_send_interval)))
+        with time_sample_stage(sample_timings, "history"):
+            if USE_DB:
+                closest_balance_24h_ago = lookup_closest_balance(now - timedelta(hours=24))
+                previous_message_balance = lookup_balance_at_or_before(previous_message_dt)
+            else:
+                history_rows = get_effective_balance_history()
+                closest_balance_24h_ago = get_closest_balance_value(history_rows, now - timedelta(hours=24))
+                previous_message_balance = get_balance_at_or_before(history_rows, previous_message_dt)
 
         if closest_balance_24h_ago is not None and closest_balance_24h_ago != 0:
             change_percent = ((current_balance - closest_balance_24h_ago) / closest_balance_24h_ago) * 100
@@ -1175,41 +3995,25 @@ def fetch_balance_cookies(add_to_db=True):
 
         now_str = now.strftime('%Y-%m-%d %H:%M:%S')
         if add_to_db:
-            if USE_DB:
-                ensure_db_schema()
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute(
-                    "REPLACE INTO balances (date, current_balance, balance_rub, change_percent, balance_in_usd, balance_in_btc, profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd, current_profit_in_btc, current_pnl_percentage, origin_balance, bot_balance, funding_balance, non_bot_balance, update_interval) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (now_str, current_balance, rub_balance, change_percent, balance_in_usd, balance_in_btc,
-                     profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd,
-                     current_profit_in_btc, current_pnl_percentage, origin_balance,
-                     bot_balance, funding_balance, non_bot_balance,
-                     config.get('db_update_interval', 30))
-                )
-                conn.commit()
-                conn.close()
-            else:
-                worksheet.append([now_str, current_balance, rub_balance, change_percent])
-                workbook.save(EXCEL_FILE)
-
-            if USE_DB:
-                try:
-                    persist_bot_snapshots(now_str, active_bots)
-                    persist_bot_archive_records(now_str, active_bots, is_active=True)
-                    repair_balance_history(limit_rows=720)
-                    repair_duplicate_bot_balance_spikes(limit_rows=720)
-                except Exception as e:
-                    logging.error(f"Ошибка сохранения истории ботов: {e}")
+            with time_sample_stage(sample_timings, "db_write"):
+                if USE_DB:
+                    write_balance_sample(
+                        (now_str, current_balance, rub_balance, change_percent, balance_in_usd, balance_in_btc,
+                         profit_in_usd, profit_in_btc, pnl_percentage, current_profit_in_usd,
+                         current_profit_in_btc, current_pnl_percentage, origin_balance,
+                         bot_balance, funding_balance, non_bot_balance,
+                         config.get('db_update_interval', 30), int(now.timestamp())),
+                        active_bot_entries if persist_bots else [],
+                        rebuilt_bot_entries
+                    )
+                else:
+                    worksheet.append([now_str, current_balance, rub_balance, change_percent])
+                    workbook.save(EXCEL_FILE)
 
         sign = '🟢 +' if change_percent >= 0 else '🔴 '
         arrow = "📈" if change_percent >= 0 else "📉"
         change_str = f"{arrow} Изменение за 24ч: {sign}{change_percent:.2f}%"
 
-        previous_message_balance = get_balance_at_or_before(
-            history_rows,
-            now - timedelta(minutes=max(1, int(balance_send_interval)))
-        )
         if previous_message_balance is not None:
             diff_val = current_balance - previous_message_balance
             diff_sign = '🟢 +' if diff_val >= 0 else '🔴 '
@@ -1232,7 +4036,7 @@ def fetch_balance_cookies(add_to_db=True):
 
 
 def fetch_balance(add_to_db=True, bot_obj=None):
-    return fetch_balance_cookies(add_to_db=add_to_db)
+    return fetch_balance_sample(add_to_db=add_to_db)
 
 
 # ------------------ ФУНКЦИИ ДЛЯ ГРАФИКОВ ------------------
@@ -1259,7 +4063,7 @@ def format_market_price(value):
     return format_decimal(number, digits=6)
 
 
-def fetch_public_mark_price_klines(symbol, interval, limit=200, start_ms=None, end_ms=None):
+def request_mark_price_kline_rows(symbol, interval, limit=200, start_ms=None, end_ms=None):
     params = {
         "category": "linear",
         "symbol": symbol,
@@ -1278,47 +4082,321 @@ def fetch_public_mark_price_klines(symbol, interval, limit=200, start_ms=None, e
         max_retries=2
     )
     if not response:
-        return []
+        return None
+
+    data = response.json()
+    ret_code = data.get("retCode", data.get("ret_code"))
+    if ret_code not in (0, None):
+        return None
+
+    rows = data.get("result", {}).get("list", []) or []
+    kline_rows = []
+    for row in reversed(rows):
+        try:
+            kline_rows.append((int(row[0]), float(row[1]), float(row[2]), float(row[3]), float(row[4])))
+        except Exception:
+            continue
+    return kline_rows
+
+
+def build_kline_points(kline_rows):
+    return [
+        {
+            "ts": datetime.fromtimestamp(open_time / 1000),
+            "open": open_price,
+            "high": high_price,
+            "low": low_price,
+            "close": close_price
+        }
+        for open_time, open_price, high_price, low_price, close_price in kline_rows
+    ]
+
+
+def get_kline_db_connection():
+    return get_thread_db_connection(KLINE_DB_FILE)
+
+
+def ensure_kline_store():
+    if KLINE_STORE_STATE["ready"]:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = get_kline_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS klines (
+            symbol TEXT NOT NULL,
+            interval TEXT NOT NULL,
+            open_time INTEGER NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            PRIMARY KEY (symbol, interval, open_time)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS market_calibration (
+            symbol TEXT NOT NULL,
+            window_minutes INTEGER NOT NULL,
+            threshold_pct REAL,
+            median_down_pct REAL,
+            q95_down_pct REAL,
+            q98_down_pct REAL,
+            computed_ts REAL NOT NULL,
+            source_interval TEXT,
+            source_start_ms INTEGER,
+            source_end_ms INTEGER,
+            source_candles INTEGER,
+            PRIMARY KEY (symbol, window_minutes)
+        )
+        """
+    )
+    conn.commit()
+    conn.close()
+    KLINE_STORE_STATE["ready"] = True
+
+
+def get_kline_interval_ms(interval):
+    return int(interval) * 60 * 1000
+
+
+def sync_kline_store(symbol, interval, lookback_minutes):
+    ensure_kline_store()
+    interval = str(interval)
+    now_ms = int(time.time() * 1000)
+    window_start_ms = now_ms - lookback_minutes * 60 * 1000
+    retention_start_ms = window_start_ms - KLINE_RETENTION_MARGIN_MINUTES * 60 * 1000
+
+    # Один символ синхронизирует один поток; сетевые запросы разных символов не ждут друг друга.
+    with KLINE_STORE_LOCK:
+        sync_lock = KLINE_SYNC_LOCKS.setdefault((symbol, interval), threading.Lock())
+    with sync_lock:
+        conn = get_kline_db_connection()
+        try:
+            last_open_time = conn.execute(
+                "SELECT MAX(open_time) FROM klines WHERE symbol = ? AND interval = ?",
+                (symbol, interval)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        # Последняя сохранённая свеча могла быть ещё не закрыта, поэтому запрашиваем её повторно.
+        start_ms = window_start_ms if last_open_time is None else max(window_start_ms, last_open_time)
+        end_ms = now_ms
+        fetched_rows = []
+        complete = True
+        requests_made = 0
+        # Bybit отдаёт последние свечи диапазона, поэтому длинный пропуск догружаем страницами назад.
+        while end_ms >= start_ms:
+            kline_rows = request_mark_price_kline_rows(
+                symbol,
+                interval,
+                limit=KLINE_FETCH_LIMIT,
+                start_ms=start_ms,
+                end_ms=end_ms
+            )
+            requests_made += 1
+            if kline_rows is None:
+                complete = False
+                break
+            fetched_rows.extend(kline_rows)
+            if len(kline_rows) < KLINE_FETCH_LIMIT:
+                break
+            end_ms = kline_rows[0][0] - get_kline_interval_ms(interval)
+
+        # Неполную догрузку не сохраняем: иначе MAX(open_time) перескочит дыру и она останется навсегда.
+        if not complete:
+            fetched_rows = []
+        with KLINE_STORE_LOCK:
+            conn = get_kline_db_connection()
+            try:
+                if fetched_rows:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO klines (symbol, interval, open_time, open, high, low, close) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(symbol, interval) + kline_row for kline_row in fetched_rows]
+                    )
+                conn.execute(
+                    "DELETE FROM klines WHERE symbol = ? AND interval = ? AND open_time < ?",
+                    (symbol, interval, retention_start_ms)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            KLINE_STORE_STATE["syncs"] += 1
+            KLINE_STORE_STATE["requests"] += requests_made
+            KLINE_STORE_STATE["rows_fetched"] += len(fetched_rows)
+            if not complete:
+                KLINE_STORE_STATE["incomplete_syncs"] += 1
+    return complete
+
+
+def load_stored_klines(symbol, interval, start_ms):
+    ensure_kline_store()
+    conn = get_kline_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT open_time, open, high, low, close FROM klines "
+        "WHERE symbol = ? AND interval = ? AND open_time >= ? ORDER BY open_time ASC",
+        (symbol, str(interval), int(start_ms))
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def get_stored_kline_rows(symbol, interval, lookback_minutes):
+    try:
+        if not sync_kline_store(symbol, interval, lookback_minutes):
+            logging.warning(f"Свечи {symbol}/{interval} догружены не полностью, повторим при следующем запросе")
+    except Exception as e:
+        logging.error(f"Ошибка обновления хранилища свечей {symbol}/{interval}: {e}")
+    start_ms = int(time.time() * 1000) - lookback_minutes * 60 * 1000
+    return load_stored_klines(symbol, interval, start_ms)
+
+
+def get_stored_klines(symbol, interval, lookback_minutes):
+    return build_kline_points(get_stored_kline_rows(symbol, interval, lookback_minutes))
+
+
+def resample_kline_rows(kline_rows, base_interval, target_interval):
+    base_ms = get_kline_interval_ms(base_interval)
+    target_ms = get_kline_interval_ms(target_interval)
+    if target_ms == base_ms:
+        return list(kline_rows)
+    if target_ms % base_ms:
+        raise ValueError(f"Интервал {target_interval} не кратен базовому {base_interval}")
+
+    candles_per_bucket = target_ms // base_ms
+    buckets = []
+    for open_time, open_price, high_price, low_price, close_price in kline_rows:
+        bucket_open_time = open_time - open_time % target_ms
+        if buckets and buckets[-1][0] == bucket_open_time:
+            bucket = buckets[-1]
+            bucket[2] = max(bucket[2], high_price)
+            bucket[3] = min(bucket[3], low_price)
+            bucket[4] = close_price
+            bucket[5] += 1
+        else:
+            buckets.append([bucket_open_time, open_price, high_price, low_price, close_price, 1])
+
+    resampled_rows = []
+    for index, bucket in enumerate(buckets):
+        # Неполные корзины внутри ряда означают пропуск в данных; последняя может быть ещё открыта.
+        if bucket[5] < candles_per_bucket and index != len(buckets) - 1:
+            continue
+        resampled_rows.append(tuple(bucket[:5]))
+    return resampled_rows
+
+
+def get_kline_store_stats():
+    return {
+        "syncs": KLINE_STORE_STATE["syncs"],
+        "requests": KLINE_STORE_STATE["requests"],
+        "rows_fetched": KLINE_STORE_STATE["rows_fetched"],
+        "incomplete_syncs": KLINE_STORE_STATE["incomplete_syncs"]
+    }
+
+
+def load_persisted_calibrations():
+    ensure_kline_store()
+    conn = get_kline_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT symbol, window_minutes, threshold_pct, median_down_pct, q95_down_pct, q98_down_pct, "
+        "computed_ts, source_start_ms, source_end_ms FROM market_calibration"
+    )
+    rows = cursor.fetchall()
+    conn.close()
+
+    calibration_cache = {}
+    for (
+        symbol, window_minutes, threshold_pct, median_down_pct, q95_down_pct, q98_down_pct,
+        computed_ts, source_start_ms, source_end_ms
+    ) in rows:
+        cached = calibration_cache.setdefault(
+            symbol,
+            {"updated_ts": computed_ts, "source_start_ms": source_start_ms, "source_end_ms": source_end_ms, "windows": {}}
+        )
+        cached["updated_ts"] = min(cached["updated_ts"], computed_ts)
+        cached["windows"][int(window_minutes)] = {
+            "threshold_pct": threshold_pct,
+            "median_down_pct": median_down_pct,
+            "q95_down_pct": q95_down_pct,
+            "q98_down_pct": q98_down_pct
+        }
+    for symbol, cached in calibration_cache.items():
+        MARKET_ALERT_STATE["calibration_cache"].setdefault(symbol, cached)
+    MARKET_ALERT_STATE["calibration_loaded"] = True
+    return len(calibration_cache)
+
+
+def persist_symbol_calibration(symbol, calibration):
+    ensure_kline_store()
+    conn = get_kline_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO market_calibration (
+            symbol, window_minutes, threshold_pct, median_down_pct, q95_down_pct, q98_down_pct,
+            computed_ts, source_interval, source_start_ms, source_end_ms, source_candles
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                symbol,
+                window_minutes,
+                window["threshold_pct"],
+                window["median_down_pct"],
+                window["q95_down_pct"],
+                window["q98_down_pct"],
+                calibration["updated_ts"],
+                MARKET_ALERT_CALIBRATION_BASE_INTERVAL,
+                calibration["source_start_ms"],
+                calibration["source_end_ms"],
+                calibration["source_candles"]
+            )
+            for window_minutes, window in calibration["windows"].items()
+        ]
+    )
+    cursor.execute(
+        f"DELETE FROM market_calibration WHERE symbol = ? AND window_minutes NOT IN "
+        f"({', '.join('?' for _ in calibration['windows'])})",
+        [symbol] + list(calibration["windows"])
+    )
+    conn.commit()
+    conn.close()
 
-    data = response.json()
-    ret_code = data.get("retCode", data.get("ret_code"))
-    if ret_code not in (0, None):
-        return []
 
-    rows = data.get("result", {}).get("list", []) or []
-    klines = []
-    for row in reversed(rows):
+def get_symbol_monthly_calibration(symbol):
+    if not MARKET_ALERT_STATE["calibration_loaded"]:
         try:
-            klines.append({
-                "ts": datetime.fromtimestamp(int(row[0]) / 1000),
-                "open": float(row[1]),
-                "high": float(row[2]),
-                "low": float(row[3]),
-                "close": float(row[4])
-            })
-        except Exception:
-            continue
-    return klines
-
+            load_persisted_calibrations()
+        except Exception as e:
+            MARKET_ALERT_STATE["calibration_loaded"] = True
+            logging.error(f"Ошибка загрузки сохранённой калибровки: {e}")
 
-def get_symbol_monthly_calibration(symbol):
     now_ts = time.time()
     cached = MARKET_ALERT_STATE["calibration_cache"].get(symbol)
-    if cached and (now_ts - cached["updated_ts"]) < MARKET_ALERT_CALIBRATION_TTL_SECONDS:
+    if (
+        cached
+        and (now_ts - cached["updated_ts"]) < MARKET_ALERT_CALIBRATION_TTL_SECONDS
+        and set(cached["windows"]) == set(MARKET_ALERT_WINDOW_SPECS)
+    ):
         return cached["windows"]
 
-    now_utc = datetime.now(timezone.utc)
-    start_ms = int((now_utc - timedelta(days=30)).timestamp() * 1000)
-    end_ms = int(now_utc.timestamp() * 1000)
     windows = {}
+    base_rows = get_stored_kline_rows(
+        symbol,
+        MARKET_ALERT_CALIBRATION_BASE_INTERVAL,
+        MARKET_ALERT_CALIBRATION_DAYS * 24 * 60
+    )
 
     for window_minutes, spec in MARKET_ALERT_WINDOW_SPECS.items():
-        points = fetch_public_mark_price_klines(
-            symbol,
-            spec["calibration_interval"],
-            limit=1000,
-            start_ms=start_ms,
-            end_ms=end_ms
+        points = build_kline_points(
+            resample_kline_rows(base_rows, MARKET_ALERT_CALIBRATION_BASE_INTERVAL, spec["calibration_interval"])
         )
         closes = [item["close"] for item in points if item.get("close")]
         down_moves = []
@@ -1340,10 +4418,21 @@ def get_symbol_monthly_calibration(symbol):
             "q98_down_pct": q98_down
         }
 
-    MARKET_ALERT_STATE["calibration_cache"][symbol] = {
+    if not base_rows:
+        return cached["windows"] if cached else windows
+
+    calibration = {
         "updated_ts": now_ts,
+        "source_start_ms": base_rows[0][0],
+        "source_end_ms": base_rows[-1][0],
+        "source_candles": len(base_rows),
         "windows": windows
     }
+    MARKET_ALERT_STATE["calibration_cache"][symbol] = calibration
+    try:
+        persist_symbol_calibration(symbol, calibration)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения калибровки {symbol}: {e}")
     return windows
 
 
@@ -1359,7 +4448,7 @@ def compute_peak_drop(prices):
 
 def analyze_symbol_market_state(symbol):
     calibration = get_symbol_monthly_calibration(symbol)
-    minute_points = fetch_public_mark_price_klines(symbol, "1", limit=150)
+    minute_points = get_stored_klines(symbol, "1", MARKET_ALERT_MINUTE_LOOKBACK)
     closes = [item["close"] for item in minute_points if item.get("close")]
     if len(closes) < 121:
         return None
@@ -1553,7 +4642,8 @@ def check_market_alerts():
 def market_alert_loop(run_token):
     while not stop_threads and run_token == thread_run_token:
         try:
-            check_market_alerts()
+            with request_profile("sampling"):
+                check_market_alerts()
         except Exception as e:
             logging.error(f"Ошибка цикла market alert: {e}")
         if not wait_until_next_interval(1, run_token=run_token):
@@ -1576,17 +4666,17 @@ def get_all_dates():
         ensure_db_schema()
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT date FROM balances ORDER BY date ASC")
+        # Разбираем только уникальные дни, а не каждую минутную строку.
+        cursor.execute("SELECT DISTINCT substr(date, 1, 10) FROM balances")
         rows = cursor.fetchall()
         conn.close()
         dates = []
         for r in rows:
             try:
-                d = datetime.strptime(r[0], '%Y-%m-%d %H:%M:%S').date()
-                dates.append(d)
+                dates.append(datetime.strptime(r[0], '%Y-%m-%d').date())
             except Exception:
                 continue
-        return sorted(list(set(dates)))
+        return sorted(dates)
     else:
         rows = list(worksheet.iter_rows(values_only=True))[1:]
         dates = sorted(list(set(datetime.strptime(r[0], '%Y-%m-%d %H:%M:%S').date() for r in rows)))
@@ -1751,8 +4841,9 @@ def calculate_profit_percent(profit_value, investment_value):
     return profit_number / investment_number * 100.0
 
 
-def build_bot_archive_record(bot_data, is_active=None):
-    snapshot = build_bot_snapshot(bot_data, 0)
+def build_bot_archive_record(bot_data, is_active=None, include_raw_json=True, snapshot=None):
+    if snapshot is None:
+        snapshot = build_bot_snapshot(bot_data, 0)
     bot_type, future_grid, futures_mart, spot_grid, spot_profit, combo = get_bot_detail_payload(bot_data)
 
     bot_id = None
@@ -1848,7 +4939,7 @@ def build_bot_archive_record(bot_data, is_active=None):
         "created_ts": created_ts,
         "ended_ts": ended_ts,
         "is_active": active_flag,
-        "raw_json": json.dumps(bot_data, ensure_ascii=False)
+        "raw_json": json.dumps(bot_data, ensure_ascii=False) if include_raw_json else None
     }
 
 
@@ -1861,87 +4952,291 @@ def build_bot_archive_records(bots_data, is_active=None):
     return records
 
 
-def persist_bot_archive_records(snapshot_time, bots_data, is_active=None):
-    if not USE_DB or not bots_data:
-        return 0
-    ensure_db_schema()
-    records = build_bot_archive_records(bots_data, is_active=is_active)
+def get_bot_payload_fingerprint(bot_data, is_active=None):
+    # В отпечаток входят только поля снимка и записи архива: mark_price, текущие цены и прочие
+    # поля, меняющиеся каждую минуту, не должны заставлять пересобирать запись.
+    bot_type, future_grid, futures_mart, spot_grid, spot_profit, combo = get_bot_detail_payload(bot_data)
+    sections = {
+        "future_grid": future_grid,
+        "fmart": futures_mart,
+        "grid_info": spot_grid,
+        "grid_profit": spot_profit,
+        "fcombo": combo
+    }
+    relevant_payload = [is_active, bot_type]
+    for section_name, fields in BOT_FINGERPRINT_FIELDS.get(bot_type, ()):
+        payload = sections[section_name]
+        relevant_payload.append((bool(payload),) + tuple(payload.get(field) for field in fields))
+    if bot_type == "COMBO_FUTURES":
+        relevant_payload.append(tuple(
+            ((item or {}).get("symbol"), (item or {}).get("base_token"), (item or {}).get("coin"))
+            for item in combo.get("symbol_settings") or []
+        ))
+    return hashlib.blake2b(repr(relevant_payload).encode("utf-8"), digest_size=12).hexdigest()
+
+
+def build_bot_sample_entries(bots_data, is_active=None):
+    entries = []
+    seen_bot_ids = set()
+    rebuilt = 0
+    for bot_data in bots_data or []:
+        if not isinstance(bot_data, dict):
+            continue
+        bot_id = get_raw_bot_id(bot_data)
+        fingerprint = get_bot_payload_fingerprint(bot_data, is_active=is_active)
+        with BOT_CHANGE_LOCK:
+            cached = BOT_CHANGE_STATE["records"].get(bot_id) if bot_id else None
+        if cached is None or cached["fingerprint"] != fingerprint:
+            snapshot = build_bot_snapshot(bot_data, 0)
+            cached = {
+                "fingerprint": fingerprint,
+                "record": build_bot_archive_record(
+                    bot_data,
+                    is_active=is_active,
+                    include_raw_json=False,
+                    snapshot=snapshot
+                ),
+                "snapshot_row": {field: snapshot.get(field) for field in BOT_SNAPSHOT_ROW_FIELDS}
+            }
+            rebuilt += 1
+            if bot_id:
+                with BOT_CHANGE_LOCK:
+                    BOT_CHANGE_STATE["records"][bot_id] = cached
+        if bot_id:
+            seen_bot_ids.add(bot_id)
+        entries.append({"bot_data": bot_data, **cached})
+
+    if is_active:
+        with BOT_CHANGE_LOCK:
+            # Кэш построенных записей держим только для текущего набора активных ботов.
+            for bot_id in list(BOT_CHANGE_STATE["records"]):
+                if bot_id not in seen_bot_ids:
+                    BOT_CHANGE_STATE["records"].pop(bot_id, None)
+    return entries, rebuilt
+
+
+def load_archived_bot_fingerprints():
+    with BOT_CHANGE_LOCK:
+        if BOT_CHANGE_STATE["archived_loaded"]:
+            return
     conn = get_db_connection()
     cursor = conn.cursor()
-    saved = 0
-    for record in records:
-        bot_id = record.get("bot_id")
+    cursor.execute("SELECT bot_id, payload_fingerprint FROM bot_archive WHERE payload_fingerprint IS NOT NULL")
+    rows = cursor.fetchall()
+    conn.close()
+    with BOT_CHANGE_LOCK:
+        for bot_id, fingerprint in rows:
+            BOT_CHANGE_STATE["archived"].setdefault(str(bot_id), fingerprint)
+        BOT_CHANGE_STATE["archived_loaded"] = True
+
+
+def record_bot_change_cycle(scope, changed, unchanged, rebuilt):
+    with BOT_CHANGE_LOCK:
+        BOT_CHANGE_STATE["last_cycles"][scope] = {
+            "changed": changed,
+            "unchanged": unchanged,
+            "rebuilt": rebuilt,
+            "finished_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+
+def get_bot_change_stats():
+    with BOT_CHANGE_LOCK:
+        return {
+            "cached_records": len(BOT_CHANGE_STATE["records"]),
+            "archived_fingerprints": len(BOT_CHANGE_STATE["archived"]),
+            "last_cycles": dict(BOT_CHANGE_STATE["last_cycles"])
+        }
+
+
+BOT_ARCHIVE_TOUCH_CHUNK = 500
+BOT_ARCHIVE_UPSERT_SQL = """
+INSERT INTO bot_archive (
+    bot_id, symbol, bot_type, title, badge, status, display_status, close_code, close_reason,
+    investment_usdt, pnl_usdt, equity_usdt, pnl_percent, final_profit_usdt,
+    settlement_assets_text, settlement_assets_usdt, leverage, mode,
+    created_ts, ended_ts, first_seen_at, last_seen_at, last_snapshot_time, is_active, raw_json,
+    payload_fingerprint
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(bot_id) DO UPDATE SET
+    symbol = excluded.symbol,
+    bot_type = excluded.bot_type,
+    title = excluded.title,
+    badge = excluded.badge,
+    status = excluded.status,
+    display_status = excluded.display_status,
+    close_code = COALESCE(excluded.close_code, bot_archive.close_code),
+    close_reason = COALESCE(excluded.close_reason, bot_archive.close_reason),
+    investment_usdt = excluded.investment_usdt,
+    pnl_usdt = excluded.pnl_usdt,
+    equity_usdt = excluded.equity_usdt,
+    pnl_percent = excluded.pnl_percent,
+    final_profit_usdt = COALESCE(excluded.final_profit_usdt, bot_archive.final_profit_usdt),
+    settlement_assets_text = COALESCE(excluded.settlement_assets_text, bot_archive.settlement_assets_text),
+    settlement_assets_usdt = COALESCE(excluded.settlement_assets_usdt, bot_archive.settlement_assets_usdt),
+    leverage = COALESCE(excluded.leverage, bot_archive.leverage),
+    mode = COALESCE(excluded.mode, bot_archive.mode),
+    created_ts = COALESCE(excluded.created_ts, bot_archive.created_ts),
+    ended_ts = COALESCE(excluded.ended_ts, bot_archive.ended_ts),
+    first_seen_at = COALESCE(bot_archive.first_seen_at, excluded.first_seen_at),
+    last_seen_at = excluded.last_seen_at,
+    last_snapshot_time = excluded.last_snapshot_time,
+    is_active = excluded.is_active,
+    raw_json = excluded.raw_json,
+    payload_fingerprint = excluded.payload_fingerprint
+"""
+
+
+def build_bot_archive_params(snapshot_time, entry):
+    record = entry["record"]
+    return (
+        record.get("bot_id"),
+        record.get("symbol"),
+        record.get("bot_type"),
+        record.get("title"),
+        record.get("badge"),
+        record.get("status"),
+        record.get("display_status"),
+        record.get("close_code"),
+        record.get("close_reason"),
+        record.get("investment_usdt"),
+        record.get("pnl_usdt"),
+        record.get("equity_usdt"),
+        record.get("pnl_percent"),
+        record.get("final_profit_usdt"),
+        record.get("settlement_assets_text"),
+        record.get("settlement_assets_usdt"),
+        record.get("leverage"),
+        record.get("mode"),
+        record.get("created_ts"),
+        record.get("ended_ts"),
+        snapshot_time,
+        snapshot_time,
+        snapshot_time,
+        record.get("is_active"),
+        json.dumps(entry["bot_data"], ensure_ascii=False),
+        entry["fingerprint"]
+    )
+
+
+def write_bot_archive_rows(cursor, snapshot_time, entries):
+    params = []
+    saved_fingerprints = {}
+    unchanged = 0
+    unchanged_ids = []
+    with BOT_CHANGE_LOCK:
+        archived_fingerprints = dict(BOT_CHANGE_STATE["archived"])
+    for entry in entries:
+        bot_id = entry["record"].get("bot_id")
         if not bot_id:
             continue
+        if archived_fingerprints.get(bot_id) == entry["fingerprint"]:
+            unchanged += 1
+            unchanged_ids.append(bot_id)
+            continue
+        params.append(build_bot_archive_params(snapshot_time, entry))
+        saved_fingerprints[bot_id] = entry["fingerprint"]
+    if params:
+        cursor.executemany(BOT_ARCHIVE_UPSERT_SQL, params)
+    # Неизменившимся ботам обновляем только отметки времени: last_snapshot_time — запасное время закрытия.
+    for offset in range(0, len(unchanged_ids), BOT_ARCHIVE_TOUCH_CHUNK):
+        chunk_ids = unchanged_ids[offset:offset + BOT_ARCHIVE_TOUCH_CHUNK]
         cursor.execute(
-            """
-            INSERT INTO bot_archive (
-                bot_id, symbol, bot_type, title, badge, status, display_status, close_code, close_reason,
-                investment_usdt, pnl_usdt, equity_usdt, pnl_percent, final_profit_usdt,
-                settlement_assets_text, settlement_assets_usdt, leverage, mode,
-                created_ts, ended_ts, first_seen_at, last_seen_at, last_snapshot_time, is_active, raw_json
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(bot_id) DO UPDATE SET
-                symbol = excluded.symbol,
-                bot_type = excluded.bot_type,
-                title = excluded.title,
-                badge = excluded.badge,
-                status = excluded.status,
-                display_status = excluded.display_status,
-                close_code = COALESCE(excluded.close_code, bot_archive.close_code),
-                close_reason = COALESCE(excluded.close_reason, bot_archive.close_reason),
-                investment_usdt = excluded.investment_usdt,
-                pnl_usdt = excluded.pnl_usdt,
-                equity_usdt = excluded.equity_usdt,
-                pnl_percent = excluded.pnl_percent,
-                final_profit_usdt = COALESCE(excluded.final_profit_usdt, bot_archive.final_profit_usdt),
-                settlement_assets_text = COALESCE(excluded.settlement_assets_text, bot_archive.settlement_assets_text),
-                settlement_assets_usdt = COALESCE(excluded.settlement_assets_usdt, bot_archive.settlement_assets_usdt),
-                leverage = COALESCE(excluded.leverage, bot_archive.leverage),
-                mode = COALESCE(excluded.mode, bot_archive.mode),
-                created_ts = COALESCE(excluded.created_ts, bot_archive.created_ts),
-                ended_ts = COALESCE(excluded.ended_ts, bot_archive.ended_ts),
-                first_seen_at = COALESCE(bot_archive.first_seen_at, excluded.first_seen_at),
-                last_seen_at = excluded.last_seen_at,
-                last_snapshot_time = excluded.last_snapshot_time,
-                is_active = excluded.is_active,
-                raw_json = excluded.raw_json
-            """,
-            (
-                bot_id,
-                record.get("symbol"),
-                record.get("bot_type"),
-                record.get("title"),
-                record.get("badge"),
-                record.get("status"),
-                record.get("display_status"),
-                record.get("close_code"),
-                record.get("close_reason"),
-                record.get("investment_usdt"),
-                record.get("pnl_usdt"),
-                record.get("equity_usdt"),
-                record.get("pnl_percent"),
-                record.get("final_profit_usdt"),
-                record.get("settlement_assets_text"),
-                record.get("settlement_assets_usdt"),
-                record.get("leverage"),
-                record.get("mode"),
-                record.get("created_ts"),
-                record.get("ended_ts"),
-                snapshot_time,
-                snapshot_time,
-                snapshot_time,
-                record.get("is_active"),
-                record.get("raw_json")
-            )
+            "UPDATE bot_archive SET last_seen_at = ?, last_snapshot_time = ? "
+            f"WHERE bot_id IN ({', '.join('?' for _ in chunk_ids)})",
+            [snapshot_time, snapshot_time] + chunk_ids
         )
-        saved += 1
-    conn.commit()
+    return saved_fingerprints, unchanged
+
+
+def commit_bot_archive_fingerprints(saved_fingerprints, unchanged, rebuilt, is_active):
+    with BOT_CHANGE_LOCK:
+        BOT_CHANGE_STATE["archived"].update(saved_fingerprints)
+    record_bot_change_cycle("active" if is_active else "history", len(saved_fingerprints), unchanged, rebuilt)
+
+
+def persist_bot_archive_records(snapshot_time, bots_data, is_active=None):
+    if not USE_DB or not bots_data:
+        return 0
+    ensure_db_schema()
+    load_archived_bot_fingerprints()
+    entries, rebuilt = build_bot_sample_entries(bots_data, is_active=is_active)
+    saved_fingerprints, unchanged = run_db_write(write_bot_archive_rows, snapshot_time, entries)
+    commit_bot_archive_fingerprints(saved_fingerprints, unchanged, rebuilt, is_active)
+    return len(saved_fingerprints)
+
+
+def load_archived_closed_bot_ends(bot_ids):
+    bot_ids = [bot_id for bot_id in bot_ids if bot_id]
+    if not bot_ids:
+        return {}
+    ensure_db_schema()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ", ".join("?" for _ in bot_ids)
+    cursor.execute(
+        f"SELECT bot_id, ended_ts FROM bot_archive WHERE is_active = 0 AND bot_id IN ({placeholders})",
+        bot_ids
+    )
+    rows = cursor.fetchall()
     conn.close()
-    return saved
+    return {str(bot_id): ended_ts for bot_id, ended_ts in rows}
+
+
+def collect_new_history_bots(page_size=BOT_PAGE_SIZE, max_pages=None):
+    started_ts = time.time()
+    new_bots = []
+    seen_bot_ids = set()
+    page_num = 0
+    stop_reason = "end_of_history"
+    failed_pages = []
+    while max_pages is None or page_num < max_pages:
+        page_num += 1
+        page_result = request_bot_list_page(page_num=page_num, page_size=page_size, status=BOT_HISTORY_STATUS)
+        if page_result["error"]:
+            failed_pages.append({"page": page_num, "error": page_result["error"]})
+            stop_reason = "page_failed"
+            break
+        page_records = []
+        for bot_data in page_result["bots"]:
+            if not isinstance(bot_data, dict):
+                continue
+            # Для сверки с архивом нужны только id и время закрытия, полную запись здесь не строим.
+            bot_id = get_raw_bot_id(bot_data)
+            if bot_id in seen_bot_ids:
+                continue
+            seen_bot_ids.add(bot_id)
+            page_records.append((bot_data, bot_id, get_raw_bot_ended_ts(bot_data)))
+        archived_ends = load_archived_closed_bot_ends([bot_id for _, bot_id, _ in page_records])
+        page_new_bots = [
+            bot_data for bot_data, bot_id, ended_ts in page_records
+            if bot_id not in archived_ends
+            or ended_ts not in (None, archived_ends[bot_id])
+        ]
+        new_bots.extend(page_new_bots)
+        if not page_new_bots and page_records:
+            stop_reason = "reached_archived"
+            break
+        if len(page_result["bots"]) < page_size:
+            break
+    else:
+        stop_reason = "max_pages"
+
+    report = {
+        "status": BOT_HISTORY_STATUS,
+        "mode": "incremental",
+        "pages": page_num,
+        "bots": len(new_bots),
+        "stop_reason": stop_reason,
+        "failed_pages": failed_pages,
+        "elapsed_ms": round((time.time() - started_ts) * 1000.0, 1),
+        "finished_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    BOT_PAGE_FETCH_STATE["last_reports"]["history_incremental"] = report
+    return new_bots, report
 
 
-def sync_bot_archive(force=False, include_active=False, include_history=True):
+def sync_bot_archive(force=False, include_active=False, include_history=True, full_history=False):
     if not USE_DB:
         return 0
     if not force and not claim_schedule_slot("bot_archive_slot", BOT_ARCHIVE_SYNC_INTERVAL_MINUTES):
@@ -1958,7 +5253,10 @@ def sync_bot_archive(force=False, include_active=False, include_history=True):
             active_bots = fetch_bot_list_data()
             saved += persist_bot_archive_records(snapshot_time, active_bots, is_active=True)
         if include_history:
-            history_bots = fetch_historical_bot_list_data()
+            if full_history or claim_schedule_slot("bot_archive_full_slot", BOT_ARCHIVE_FULL_SYNC_INTERVAL_MINUTES):
+                history_bots = fetch_historical_bot_list_data()
+            else:
+                history_bots, _ = collect_new_history_bots()
             saved += persist_bot_archive_records(snapshot_time, history_bots, is_active=False)
     except Exception as e:
         logging.error(f"Ошибка синхронизации архива ботов: {e}")
@@ -1970,8 +5268,10 @@ def repair_bot_archive_metrics():
         return 0
 
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return run_db_write(apply_bot_archive_metrics_repair)
+
+
+def apply_bot_archive_metrics_repair(cursor):
     cursor.execute(
         """
         SELECT bot_id, investment_usdt, pnl_usdt, final_profit_usdt, settlement_assets_usdt, is_active, pnl_percent
@@ -2026,8 +5326,6 @@ def repair_bot_archive_metrics():
         )
         updated += 1
 
-    conn.commit()
-    conn.close()
     return updated
 
 
@@ -2050,27 +5348,31 @@ def mark_bot_close_notified(bot_id, notify_type):
     if not USE_DB or not bot_id:
         return
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    run_db_write(apply_bot_close_notified, str(bot_id), notify_type)
+
+
+def apply_bot_close_notified(cursor, bot_id, notify_type):
     cursor.execute(
         """
         UPDATE bot_archive
         SET close_notified_at = ?, close_notify_type = ?
         WHERE bot_id = ?
         """,
-        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), notify_type, str(bot_id))
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), notify_type, bot_id)
     )
-    conn.commit()
-    conn.close()
 
 
 def bootstrap_bot_close_notifications():
     if not USE_DB or config.get("bot_close_notify_bootstrapped"):
         return 0
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    updated = run_db_write(apply_bot_close_notify_bootstrap, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    config["bot_close_notify_bootstrapped"] = True
+    save_config(config)
+    return updated
+
+
+def apply_bot_close_notify_bootstrap(cursor, now_str):
     cursor.execute(
         """
         UPDATE bot_archive
@@ -2081,12 +5383,7 @@ def bootstrap_bot_close_notifications():
         """,
         (now_str,)
     )
-    updated = cursor.rowcount
-    conn.commit()
-    conn.close()
-    config["bot_close_notify_bootstrapped"] = True
-    save_config(config)
-    return updated
+    return cursor.rowcount
 
 
 def build_bot_close_notification_message(record, notify_type):
@@ -2199,13 +5496,8 @@ def record_alert_event(alert_key, alert_type, bot_id=None, symbol=None, payload=
     if not USE_DB:
         return
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT OR REPLACE INTO alert_events (alert_key, alert_type, bot_id, symbol, created_at, payload_json)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
+    run_db_write(
+        insert_alert_event,
         (
             str(alert_key),
             alert_type,
@@ -2215,8 +5507,16 @@ def record_alert_event(alert_key, alert_type, bot_id=None, symbol=None, payload=
             json.dumps(payload or {}, ensure_ascii=False)
         )
     )
-    conn.commit()
-    conn.close()
+
+
+def insert_alert_event(cursor, alert_row):
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO alert_events (alert_key, alert_type, bot_id, symbol, created_at, payload_json)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        alert_row
+    )
 
 
 def get_bot_initial_snapshot_metrics(bot_id):
@@ -2227,10 +5527,10 @@ def get_bot_initial_snapshot_metrics(bot_id):
     cursor = conn.cursor()
     cursor.execute(
         """
-        SELECT snapshot_time, investment_usdt, pnl_usdt
-        FROM bot_snapshots
-        WHERE bot_id = ?
-        ORDER BY snapshot_time ASC
+        SELECT f.snapshot_ts, f.investment_usdt, f.pnl_usdt
+        FROM bot_snapshot_facts f
+        WHERE f.bot_ref IN (SELECT bot_ref FROM bot_dim WHERE bot_id = ?)
+        ORDER BY f.snapshot_ts ASC
         LIMIT 1
         """,
         (str(bot_id),)
@@ -2240,7 +5540,7 @@ def get_bot_initial_snapshot_metrics(bot_id):
     if not row:
         return None
     return {
-        "snapshot_time": row[0],
+        "snapshot_time": datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S'),
         "investment_usdt": safe_float(row[1]),
         "pnl_usdt": safe_float(row[2])
     }
@@ -2636,20 +5936,21 @@ def get_latest_balance_breakdown_row():
 
 def get_snapshot_rows_at_or_before(cursor, target_time):
     cursor.execute(
-        "SELECT MAX(snapshot_time) FROM bot_snapshots WHERE snapshot_time <= ?",
-        (target_time,)
+        "SELECT MAX(snapshot_ts) FROM bot_snapshot_facts WHERE snapshot_ts <= ?",
+        (to_epoch_seconds(target_time),)
     )
-    snapshot_time_row = cursor.fetchone()
-    snapshot_time = snapshot_time_row[0] if snapshot_time_row else None
-    if not snapshot_time:
+    snapshot_ts_row = cursor.fetchone()
+    snapshot_ts = snapshot_ts_row[0] if snapshot_ts_row else None
+    if not snapshot_ts:
         return []
     cursor.execute(
         """
-        SELECT bot_id, symbol, bot_type, investment_usdt
-        FROM bot_snapshots
-        WHERE snapshot_time = ?
+        SELECT d.bot_id, d.symbol, d.bot_type, f.investment_usdt
+        FROM bot_snapshot_facts f
+        JOIN bot_dim d ON d.bot_ref = f.bot_ref
+        WHERE f.snapshot_ts = ?
         """,
-        (snapshot_time,)
+        (snapshot_ts,)
     )
     rows = []
     for bot_id, symbol, bot_type, investment_usdt in cursor.fetchall():
@@ -2713,8 +6014,10 @@ def repair_duplicate_bot_balance_spikes(limit_rows=1440):
         return 0
 
     ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return run_db_write(apply_duplicate_bot_balance_repair, limit_rows)
+
+
+def apply_duplicate_bot_balance_repair(cursor, limit_rows=1440):
     if limit_rows is None:
         cursor.execute(
             """
@@ -2739,6 +6042,7 @@ def repair_duplicate_bot_balance_spikes(limit_rows=1440):
         )
     rows = cursor.fetchall()
     repaired_rows = 0
+    touched_ts = []
 
     for idx in range(1, len(rows)):
         date_str, current_balance, balance_in_usd, balance_rub, bot_balance, funding_balance, non_bot_balance = rows[idx]
@@ -2786,9 +6090,11 @@ def repair_duplicate_bot_balance_spikes(limit_rows=1440):
             )
         )
         repaired_rows += 1
+        touched_ts.append(to_epoch_seconds(date_str))
 
-    conn.commit()
-    conn.close()
+    if touched_ts:
+        rebuild_rollup_range(cursor, min(touched_ts), max(touched_ts))
+        queue_balance_history_invalidation(min(touched_ts), max(touched_ts))
     return repaired_rows
 
 
@@ -3443,54 +6749,79 @@ def build_bot_snapshot(bot_data, index):
     }
 
 
-def persist_bot_snapshots(snapshot_time, bots_data):
-    if not USE_DB or not bots_data:
-        return
+BOT_SNAPSHOT_FACT_REPLACE_SQL = """
+REPLACE INTO bot_snapshot_facts (
+    snapshot_ts, bot_index, bot_ref, investment_usdt, pnl_usdt, equity_usdt, pnl_percent
+) VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+BOT_DIM_LOCK = threading.Lock()
+BOT_DIM_CACHE = {}
 
-    ensure_db_schema()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        archive_records = build_bot_archive_records(bots_data, is_active=True)
-        for index, bot_data in enumerate(bots_data):
-            snapshot = build_bot_snapshot(bot_data, index)
-            archive_record = archive_records[index] if index < len(archive_records) else {}
-            if (
-                snapshot["symbol"] is None
-                and snapshot["investment_usdt"] is None
-                and snapshot["pnl_usdt"] is None
-            ):
-                continue
 
-            cursor.execute(
-                """
-                REPLACE INTO bot_snapshots (
-                    snapshot_time, bot_index, bot_id, symbol, bot_type, title, badge,
-                    investment_usdt, pnl_usdt, equity_usdt, pnl_percent,
-                    status, display_status, is_active, close_code
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    snapshot_time,
-                    snapshot["index"],
-                    archive_record.get("bot_id"),
-                    snapshot["symbol"],
-                    snapshot["bot_type"],
-                    snapshot["title"],
-                    snapshot["badge"],
-                    snapshot["investment_usdt"],
-                    snapshot["pnl_usdt"],
-                    snapshot["equity_usdt"],
-                    snapshot["pnl_percent_value"],
-                    archive_record.get("status"),
-                    archive_record.get("display_status"),
-                    archive_record.get("is_active"),
-                    archive_record.get("close_code")
-                )
-            )
-        conn.commit()
-    finally:
-        conn.close()
+# Строки bot_dim из откатившейся транзакции исчезают, поэтому при любом откате кэш ссылок сбрасывается.
+def reset_bot_dim_cache():
+    with BOT_DIM_LOCK:
+        BOT_DIM_CACHE.clear()
+
+
+def resolve_bot_dim_ref(cursor, dim_values):
+    with BOT_DIM_LOCK:
+        bot_ref = BOT_DIM_CACHE.get(dim_values)
+    if bot_ref is not None:
+        return bot_ref
+    cursor.execute(
+        "SELECT bot_ref FROM bot_dim WHERE " + " AND ".join(f"{field} IS ?" for field in BOT_DIM_FIELDS),
+        dim_values
+    )
+    row = cursor.fetchone()
+    if row:
+        bot_ref = row[0]
+    else:
+        cursor.execute(
+            f"INSERT INTO bot_dim ({', '.join(BOT_DIM_FIELDS)}) VALUES ({', '.join('?' for _ in BOT_DIM_FIELDS)})",
+            dim_values
+        )
+        bot_ref = cursor.lastrowid
+    with BOT_DIM_LOCK:
+        BOT_DIM_CACHE[dim_values] = bot_ref
+    return bot_ref
+
+
+def write_bot_snapshot_rows(cursor, snapshot_time, entries):
+    snapshot_ts = to_epoch_seconds(snapshot_time)
+    params = []
+    for index, entry in enumerate(entries):
+        snapshot = entry["snapshot_row"]
+        archive_record = entry["record"]
+        if (
+            snapshot["symbol"] is None
+            and snapshot["investment_usdt"] is None
+            and snapshot["pnl_usdt"] is None
+        ):
+            continue
+        dim_values = (
+            archive_record.get("bot_id"),
+            snapshot["symbol"],
+            snapshot["bot_type"],
+            snapshot["title"],
+            snapshot["badge"],
+            archive_record.get("status"),
+            archive_record.get("display_status"),
+            archive_record.get("is_active"),
+            archive_record.get("close_code")
+        )
+        params.append((
+            snapshot_ts,
+            index,
+            resolve_bot_dim_ref(cursor, dim_values),
+            snapshot["investment_usdt"],
+            snapshot["pnl_usdt"],
+            snapshot["equity_usdt"],
+            snapshot["pnl_percent_value"]
+        ))
+    if params:
+        cursor.executemany(BOT_SNAPSHOT_FACT_REPLACE_SQL, params)
+    return params
 
 
 def get_bot_day_history(selected_date, snapshot):
@@ -3498,7 +6829,8 @@ def get_bot_day_history(selected_date, snapshot):
         return []
 
     ensure_db_schema()
-    day_prefix = selected_date.strftime('%Y-%m-%d')
+    day_start = datetime.combine(selected_date, datetime.min.time())
+    range_params = (int(day_start.timestamp()), int((day_start + timedelta(days=1)).timestamp()))
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
@@ -3508,37 +6840,36 @@ def get_bot_day_history(selected_date, snapshot):
         if symbol:
             cursor.execute(
                 """
-                SELECT snapshot_time, investment_usdt, pnl_usdt, equity_usdt
-                FROM bot_snapshots
-                WHERE snapshot_time LIKE ? AND symbol = ? AND bot_type = ?
-                ORDER BY snapshot_time ASC
+                SELECT f.snapshot_ts, f.investment_usdt, f.pnl_usdt, f.equity_usdt
+                FROM bot_snapshot_facts f
+                WHERE f.bot_ref IN (SELECT bot_ref FROM bot_dim WHERE symbol = ? AND bot_type = ?)
+                  AND f.snapshot_ts >= ? AND f.snapshot_ts < ?
+                ORDER BY f.snapshot_ts ASC
                 """,
-                (f"{day_prefix}%", symbol, bot_type)
+                (symbol, bot_type, *range_params)
             )
             rows = cursor.fetchall()
 
         if not rows:
             cursor.execute(
                 """
-                SELECT snapshot_time, investment_usdt, pnl_usdt, equity_usdt
-                FROM bot_snapshots
-                WHERE snapshot_time LIKE ? AND bot_index = ?
-                ORDER BY snapshot_time ASC
+                SELECT snapshot_ts, investment_usdt, pnl_usdt, equity_usdt
+                FROM bot_snapshot_facts
+                WHERE snapshot_ts >= ? AND snapshot_ts < ? AND bot_index = ?
+                ORDER BY snapshot_ts ASC
                 """,
-                (f"{day_prefix}%", snapshot["index"])
+                (*range_params, snapshot["index"])
             )
             rows = cursor.fetchall()
     finally:
         conn.close()
 
     history = []
-    for snapshot_time, investment_usdt, pnl_usdt, equity_usdt in rows:
-        try:
-            point_time = datetime.strptime(snapshot_time, '%Y-%m-%d %H:%M:%S')
-        except Exception:
+    for snapshot_ts, investment_usdt, pnl_usdt, equity_usdt in rows:
+        if not snapshot_ts:
             continue
         history.append({
-            "time": point_time,
+            "time": datetime.fromtimestamp(snapshot_ts),
             "investment_usdt": safe_float(investment_usdt),
             "pnl_usdt": safe_float(pnl_usdt),
             "equity_usdt": safe_float(equity_usdt)
@@ -4579,21 +7910,96 @@ def build_bot_card_markup(selected_date, active_index, bots_data=None, viewer_us
     return markup
 
 
-def generate_graph_for_date(selected_date=None, bot_obj=None, force_refresh=False, bots_data=None):
-    if bots_data is None:
-        bots_data = fetch_bot_list_data()[:6]
+def split_overview_stats(stats_rows):
+    return (
+        [row[0] for row in stats_rows],
+        [row[1] for row in stats_rows],
+        [row[2] for row in stats_rows],
+        [row[3] for row in stats_rows]
+    )
+
+
+def load_overview_series_from_rollups(selected_date):
+    # День берём из кэша истории, панели 30 дней и года — из суточных и месячных агрегатов.
+    ensure_balance_history_cache()
+    latest_ts = get_balance_history_cache_stats()["last_ts"]
+    if latest_ts is None:
+        return None
+    latest_date = datetime.fromtimestamp(latest_ts).date()
+    ref_date = selected_date or latest_date
+
+    def load_day_rows(day):
+        day_start = datetime.combine(day, datetime.min.time())
+        return get_effective_balance_history(
+            int(day_start.timestamp()),
+            int((day_start + timedelta(days=1)).timestamp()) - 1
+        )
 
+    day_rows = load_day_rows(ref_date)
+    selected_date = ref_date
+    if not day_rows:
+        selected_date = latest_date
+        day_rows = load_day_rows(latest_date)
+
+    ref_end_ts = int(datetime.combine(ref_date + timedelta(days=1), datetime.min.time()).timestamp())
+    days_start_ts = int(datetime.combine(ref_date - timedelta(days=29), datetime.min.time()).timestamp())
+    day_stats = [
+        (datetime.fromtimestamp(bucket_ts).date(), value_sum / sample_count, value_max, value_min)
+        for bucket_ts, sample_count, value_sum, value_min, value_max, _, _ in get_balance_rollups(
+            "1d", days_start_ts, ref_end_ts
+        )
+        if sample_count
+    ]
+
+    # Крайние месяцы окна обрезаны по дням, их собираем из суточных агрегатов; остальные берём готовыми.
+    year_start_ts = int(datetime.combine(ref_date - timedelta(days=364), datetime.min.time()).timestamp())
+    first_month_ts = get_rollup_bucket_ts(year_start_ts, ROLLUP_MONTH_SECONDS)
+    full_months_start_ts = (
+        first_month_ts if first_month_ts == year_start_ts
+        else int((datetime.fromtimestamp(first_month_ts) + timedelta(days=32)).replace(day=1).timestamp())
+    )
+    last_month_ts = get_rollup_bucket_ts(ref_end_ts - 1, ROLLUP_MONTH_SECONDS)
+    month_totals = {}
+    edge_rows = (
+        get_balance_rollups("1d", year_start_ts, min(full_months_start_ts, ref_end_ts))
+        + get_balance_rollups("1d", max(last_month_ts, full_months_start_ts), ref_end_ts)
+    )
+    for bucket_ts, sample_count, value_sum, value_min, value_max, _, _ in edge_rows:
+        month_ts = get_rollup_bucket_ts(bucket_ts, ROLLUP_MONTH_SECONDS)
+        totals = month_totals.get(month_ts)
+        if totals is None:
+            month_totals[month_ts] = [sample_count, value_sum, value_min, value_max]
+        else:
+            totals[0] += sample_count
+            totals[1] += value_sum
+            totals[2] = min(totals[2], value_min)
+            totals[3] = max(totals[3], value_max)
+    for bucket_ts, sample_count, value_sum, value_min, value_max, _, _ in get_balance_rollups(
+        "1mo", full_months_start_ts, last_month_ts
+    ):
+        month_totals[bucket_ts] = [sample_count, value_sum, value_min, value_max]
+    month_stats = [
+        (datetime.fromtimestamp(month_ts).date(), value_sum / sample_count, value_max, value_min)
+        for month_ts, (sample_count, value_sum, value_min, value_max) in sorted(month_totals.items())
+        if sample_count
+    ]
+    return {
+        "selected_date": selected_date,
+        "day_rows": day_rows,
+        "days": split_overview_stats(day_stats),
+        "months": split_overview_stats(month_stats)
+    }
+
+
+def load_overview_series_from_history(selected_date):
     rows = get_effective_balance_history()
     if not rows:
-        return None, "Нет данных."
+        return None
     if selected_date is None:
         all_dates = sorted(list(set(r[0].date() for r in rows)))
         if not all_dates:
-            return None, "Нет данных."
+            return None
         selected_date = all_dates[-1]
-    graph_filename = get_overview_graph_path(selected_date)
-    if os.path.exists(graph_filename) and not force_refresh:
-        return graph_filename, None
 
     ref_date = selected_date
     day_rows = [r for r in rows if r[0].date() == selected_date and r[1] is not None]
@@ -4602,8 +8008,6 @@ def generate_graph_for_date(selected_date=None, bot_obj=None, force_refresh=Fals
         selected_date = all_dates[-1]
         day_rows = [r for r in rows if r[0].date() == selected_date and r[1] is not None]
     day_rows.sort(key=lambda x: x[0])
-    times = [r[0] for r in day_rows]
-    balances_usdt = [r[1] for r in day_rows]
 
     # Группировка по дням для 30-дневного графика (от ref_date - 29 дней до ref_date)
     daily_balances = {}
@@ -4614,16 +8018,12 @@ def generate_graph_for_date(selected_date=None, bot_obj=None, force_refresh=Fals
     all_dates_sorted = sorted([d for d in daily_balances.keys() if d <= ref_date])
     last_30_days = [d for d in all_dates_sorted if d >= (ref_date - timedelta(days=29))]
 
-    avg_30, max_30, min_30, dates_30 = [], [], [], []
+    day_stats = []
     for d in last_30_days:
-        vals = daily_balances[d]
-        vals = [v for v in vals if v is not None]
+        vals = [v for v in daily_balances[d] if v is not None]
         if not vals:
             continue
-        avg_30.append(sum(vals) / len(vals))
-        max_30.append(max(vals))
-        min_30.append(min(vals))
-        dates_30.append(d)
+        day_stats.append((d, sum(vals) / len(vals), max(vals), min(vals)))
 
     # Группировка по месяцам для годового графика (от ref_date - 364 дней до ref_date)
     monthly_balances = {}
@@ -4631,16 +8031,39 @@ def generate_graph_for_date(selected_date=None, bot_obj=None, force_refresh=Fals
         if d <= ref_date and d >= (ref_date - timedelta(days=364)):
             m = d.replace(day=1)
             monthly_balances.setdefault(m, []).extend(vals)
-    avg_year, max_year, min_year, dates_year = [], [], [], []
-    if monthly_balances:
-        for m in sorted(monthly_balances.keys()):
-            vs = [v for v in monthly_balances[m] if v is not None]
-            if not vs:
-                continue
-            avg_year.append(sum(vs) / len(vs))
-            max_year.append(max(vs))
-            min_year.append(min(vs))
-            dates_year.append(m)
+    month_stats = []
+    for m in sorted(monthly_balances.keys()):
+        vs = [v for v in monthly_balances[m] if v is not None]
+        if not vs:
+            continue
+        month_stats.append((m, sum(vs) / len(vs), max(vs), min(vs)))
+    return {
+        "selected_date": selected_date,
+        "day_rows": day_rows,
+        "days": split_overview_stats(day_stats),
+        "months": split_overview_stats(month_stats)
+    }
+
+
+def generate_graph_for_date(selected_date=None, bot_obj=None, force_refresh=False, bots_data=None):
+    if bots_data is None:
+        bots_data = fetch_bot_list_data()[:6]
+
+    if USE_DB and ROLLUP_STATE["backfill_complete"]:
+        overview = load_overview_series_from_rollups(selected_date)
+    else:
+        overview = load_overview_series_from_history(selected_date)
+    if overview is None:
+        return None, "Нет данных."
+    selected_date = overview["selected_date"]
+    graph_filename = get_overview_graph_path(selected_date)
+    if os.path.exists(graph_filename) and not force_refresh:
+        return graph_filename, None
+
+    times = [r[0] for r in overview["day_rows"]]
+    balances_usdt = [r[1] for r in overview["day_rows"]]
+    dates_30, avg_30, max_30, min_30 = overview["days"]
+    dates_year, avg_year, max_year, min_year = overview["months"]
     fig = plt.figure(figsize=(17.2, 10.4))
     fig.patch.set_facecolor("#eef2f7")
     gs = fig.add_gridspec(
@@ -4809,19 +8232,21 @@ threads_started = False
 
 
 def start_threads():
-    global db_update_thread, balance_send_thread, market_alert_thread
+    global db_update_thread, balance_send_thread, market_alert_thread, rub_rate_thread
     global stop_threads, threads_started, thread_run_token
     if threads_started:
         return
     stop_threads = False
     thread_run_token += 1
     run_token = thread_run_token
-    db_update_thread = threading.Thread(target=db_update_loop, args=(run_token,), daemon=True)
-    balance_send_thread = threading.Thread(target=balance_send_loop, args=(run_token,), daemon=True)
-    market_alert_thread = threading.Thread(target=market_alert_loop, args=(run_token,), daemon=True)
+    db_update_thread = threading.Thread(target=run_with_db_cleanup, args=(db_update_loop, run_token), daemon=True)
+    balance_send_thread = threading.Thread(target=run_with_db_cleanup, args=(balance_send_loop, run_token), daemon=True)
+    market_alert_thread = threading.Thread(target=run_with_db_cleanup, args=(market_alert_loop, run_token), daemon=True)
+    rub_rate_thread = threading.Thread(target=run_with_db_cleanup, args=(rub_rate_loop, run_token), daemon=True)
     db_update_thread.start()
     balance_send_thread.start()
     market_alert_thread.start()
+    rub_rate_thread.start()
     threads_started = True
 
 
@@ -4837,22 +8262,37 @@ def db_update_loop(run_token):
         try:
             wait_minutes = min(max(1, int(db_update_interval)), BOT_ARCHIVE_SYNC_INTERVAL_MINUTES)
             if claim_schedule_slot("db_slot", db_update_interval):
-                fetch_balance()
+                with request_profile("sampling"):
+                    fetch_balance()
             sync_bot_archive(include_active=False, include_history=True)
             repair_bot_archive_metrics()
             dispatch_active_bot_risk_alerts()
             dispatch_bot_close_notifications()
+            if claim_schedule_slot("retention_slot", 60):
+                prune_raw_history()
         except Exception:
             logging.exception("Ошибка цикла обновления БД")
         if not wait_until_next_interval(wait_minutes, run_token=run_token):
             break
 
 
+def rub_rate_loop(run_token):
+    while not stop_threads and run_token == thread_run_token:
+        try:
+            if usdt_to_rub_needs_refresh():
+                refresh_usdt_to_rub()
+        except Exception:
+            logging.exception("Ошибка обновления курса USDT/RUB")
+        if not wait_until_next_interval(1, run_token=run_token):
+            break
+
+
 def balance_send_loop(run_token):
     while not stop_threads and run_token == thread_run_token:
         try:
             if claim_schedule_slot("balance_slot", balance_send_interval):
-                balance_info = fetch_balance(add_to_db=False)
+                with request_profile("sampling"):
+                    balance_info = fetch_balance(add_to_db=False)
                 if isinstance(balance_info, str) and chat_id:
                     try:
                         bot.send_message(chat_id, balance_info)
@@ -4979,7 +8419,11 @@ def callback_admin(call):
         bot.send_message(user_id, f"Отправьте новое значение для: {field_name}")
     elif call.data == "download_db":
         if os.path.exists(DB_FILE):
-            bot.send_document(user_id, types.InputFile(DB_FILE))
+            export_path = export_db_copy()
+            try:
+                bot.send_document(user_id, types.InputFile(export_path))
+            finally:
+                os.remove(export_path)
         else:
             bot.send_message(user_id, MESSAGES['admin_download_not_found'])
     elif call.data == "show_config":
@@ -5133,6 +8577,8 @@ def apply_runtime_config(config_data):
     db_update_interval = config.get('db_update_interval', 30)
     balance_send_interval = config.get('balance_send_interval', 30)
     chat_id = config.get('chat_id', '')
+    refresh_http_sessions()
+    apply_endpoint_overrides()
     try:
         if TOKEN:
             bot.token = TOKEN
@@ -5148,7 +8594,10 @@ def reload_config(bot_obj=None):
 def update_config_entries(updates):
     current = load_config()
     for key, value in (updates or {}).items():
-        if key in {"notification_settings", "risk_settings", "api_settings"} and isinstance(value, dict):
+        if key in {
+            "notification_settings", "risk_settings", "api_settings", "http_settings", "bybit_api_settings",
+            "endpoint_settings", "recorder_settings", "db_settings"
+        } and isinstance(value, dict):
             merged_value = dict(current.get(key) or {})
             merged_value.update(value)
             current[key] = merged_value
@@ -5168,6 +8617,28 @@ def sanitize_config_for_output(config_data):
     return sanitized
 
 
+def collect_runtime_metrics():
+    return {
+        "http": get_http_client_stats(),
+        "bot_pages": BOT_PAGE_FETCH_STATE["last_reports"],
+        "active_bots_snapshot": get_active_bots_snapshot_stats(),
+        "samples": get_sample_timing_stats(),
+        "retry": get_retry_stats(),
+        "rate_limit": get_rate_limit_stats(),
+        "usdt_rub": get_usdt_to_rub_info(),
+        "bot_changes": get_bot_change_stats(),
+        "bybit_api": get_bybit_api_stats(),
+        "klines": get_kline_store_stats(),
+        "db_connections": get_db_connection_stats(),
+        "schema": get_schema_stats(),
+        "db_writer": get_db_writer_stats(),
+        "epoch_backfill": get_epoch_backfill_stats(),
+        "rollups": get_rollup_stats(),
+        "balance_history_cache": get_balance_history_cache_stats(),
+        "balance_repair": get_balance_repair_stats()
+    }
+
+
 def collect_active_bot_records():
     records = []
     for bot_data in fetch_bot_list_data():
@@ -5212,6 +8683,21 @@ def collect_latest_balance_snapshot():
     return dict(row) if row else None
 
 
+def collect_balance_history(hours=24):
+    if not USE_DB:
+        return []
+    end_ts = int(time.time())
+    ts_values, balance_values = get_balance_history_arrays(end_ts - int(max(0.0, hours) * 3600), end_ts)
+    return [
+        {
+            "ts": date_ts,
+            "date": datetime.fromtimestamp(date_ts).strftime('%Y-%m-%d %H:%M:%S'),
+            "balance": balance_value
+        }
+        for date_ts, balance_value in zip(ts_values, balance_values)
+    ]
+
+
 def execute_readonly_query(sql, params=None):
     query_text = str(sql or "").strip()
     if not query_text:
@@ -5239,6 +8725,12 @@ class LocalApiHandler(BaseHTTPRequestHandler):
     def log_message(self, format_string, *args):
         logging.info("API: " + format_string, *args)
 
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            close_thread_db_connections()
+
     def _read_json(self):
         content_length = int(self.headers.get("Content-Length", "0") or 0)
         if content_length <= 0:
@@ -5271,6 +8763,7 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             self._send_json(401, {"ok": False, "error": "unauthorized"})
             return
         path, query = self._route()
+        REQUEST_PROFILE.set("interactive")
         try:
             if path == "/api/health":
                 self._send_json(200, {"ok": True, "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
@@ -5278,9 +8771,19 @@ class LocalApiHandler(BaseHTTPRequestHandler):
             if path == "/api/config":
                 self._send_json(200, {"ok": True, "config": sanitize_config_for_output(config)})
                 return
+            if path == "/api/metrics":
+                self._send_json(200, {"ok": True, "metrics": collect_runtime_metrics()})
+                return
             if path == "/api/balance/latest":
                 self._send_json(200, {"ok": True, "balance": collect_latest_balance_snapshot()})
                 return
+            if path == "/api/balance/history":
+                hours = safe_float((query.get("hours") or ["24"])[0])
+                if hours is None or not math.isfinite(hours) or hours <= 0:
+                    hours = 24.0
+                hours = min(hours, BALANCE_HISTORY_API_MAX_HOURS)
+                self._send_json(200, {"ok": True, "items": collect_balance_history(hours=hours)})
+                return
             if path == "/api/bots/active":
                 self._send_json(200, {"ok": True, "items": collect_active_bot_records()})
                 return
@@ -5292,9 +8795,20 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 scope = (query.get("scope") or ["active"])[0]
                 if scope == "history":
                     data = fetch_historical_bot_list_data()
-                else:
-                    data = fetch_bot_list_data()
-                self._send_json(200, {"ok": True, "scope": scope, "items": data})
+                    self._send_json(200, {"ok": True, "scope": scope, "items": data})
+                    return
+                max_age = (query.get("max_age") or [None])[0]
+                snapshot = get_active_bots_snapshot(max_age_seconds=safe_float(max_age))
+                self._send_json(
+                    200,
+                    {
+                        "ok": True,
+                        "scope": scope,
+                        "items": snapshot["bots"],
+                        "fetched_at": snapshot["fetched_at"],
+                        "stale": snapshot["stale"]
+                    }
+                )
                 return
             if path == "/api/report/day":
                 end_dt = datetime.now()
@@ -5321,7 +8835,8 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 allowed_updates = {}
                 for key in (
                     "TOKEN", "cookies", "admins", "db_update_interval", "balance_send_interval", "chat_id",
-                    "notification_settings", "risk_settings", "api_settings"
+                    "notification_settings", "risk_settings", "api_settings", "http_settings",
+                    "bybit_api_settings", "USE_API", "endpoint_settings", "recorder_settings", "db_settings"
                 ):
                     if key in payload:
                         allowed_updates[key] = payload[key]
@@ -5333,10 +8848,17 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                 self._send_json(200, {"ok": True, "rows": rows})
                 return
             if path == "/api/actions/sync":
-                sync_saved = sync_bot_archive(force=True, include_active=True, include_history=True)
-                repaired = repair_bot_archive_metrics()
-                risk_alerts = dispatch_active_bot_risk_alerts()
-                close_alerts = dispatch_bot_close_notifications()
+                # Полная синхронизация — долгая фоновая работа, интерактивный профиль ей не положен.
+                with request_profile("background"):
+                    sync_saved = sync_bot_archive(
+                        force=True,
+                        include_active=True,
+                        include_history=True,
+                        full_history=bool(payload.get("full_history"))
+                    )
+                    repaired = repair_bot_archive_metrics()
+                    risk_alerts = dispatch_active_bot_risk_alerts()
+                    close_alerts = dispatch_bot_close_notifications()
                 self._send_json(
                     200,
                     {
@@ -5348,6 +8870,23 @@ class LocalApiHandler(BaseHTTPRequestHandler):
                     }
                 )
                 return
+            if path == "/api/actions/db_upgrade":
+                if not USE_DB:
+                    self._send_json(409, {"ok": False, "error": "db_disabled"})
+                    return
+                self._send_json(200, {"ok": True, "schema": run_schema_migrations()})
+                return
+            if path == "/api/actions/repair_rescan":
+                with request_profile("background"):
+                    started = start_balance_repair_rescan()
+                if started is None:
+                    self._send_json(409, {"ok": False, "error": "db_disabled"})
+                    return
+                self._send_json(
+                    202 if started else 409,
+                    {"ok": started, "balance_repair": get_balance_repair_stats()}
+                )
+                return
             self._send_json(404, {"ok": False, "error": "not_found"})
         except Exception as e:
             self._send_json(500, {"ok": False, "error": str(e)})
@@ -5528,6 +9067,25 @@ def migrate_excel_command(message):
         bot.send_message(message.chat.id, MESSAGES['migrate_ok'])
     else:
         bot.send_message(message.chat.id, MESSAGES['migrate_fail'])
+
+
+@bot.message_handler(commands=['repair_history'])
+@handler_guard
+def repair_history_command(message):
+    if not is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, MESSAGES['admin_no_access'])
+        return
+    started = start_balance_repair_rescan()
+    if started is None:
+        bot.send_message(message.chat.id, "БД не используется, проверять нечего.")
+        return
+    progress = get_balance_repair_stats()["rescan"] or {}
+    state_text = "запущена" if started else "уже идёт"
+    bot.send_message(
+        message.chat.id,
+        f"Полная проверка истории баланса {state_text}: {progress.get('progress_pct', 0.0)}%, "
+        f"удалено {progress.get('deleted', 0)}, исправлено {progress.get('updated', 0)}."
+    )
 
 
 @bot.message_handler(commands=['generate_images'])
@@ -5771,11 +9329,19 @@ if __name__ == '__main__':
         raise SystemExit(1)
     if USE_DB:
         create_db()
-        ensure_db_schema()
+        start_epoch_backfill()
+        start_rollup_backfill()
+        ensure_balance_history_cache()
         repair_balance_history()
         repair_duplicate_bot_balance_spikes(limit_rows=None)
         repair_bot_archive_metrics()
+        recompute_missing_balance_rub()
         bootstrap_bot_close_notifications()
+    apply_endpoint_overrides()
+    try:
+        load_persisted_calibrations()
+    except Exception as e:
+        logging.error(f"Ошибка загрузки сохранённой калибровки: {e}")
     start_api_server()
     start_threads()
     run_bot_polling()